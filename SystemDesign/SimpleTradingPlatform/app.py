@@ -1,15 +1,41 @@
 from flask import Flask, request, jsonify
 import sqlite3
 import json
-from kafka import KafkaProducer
+import atexit
+import sys
+from pathlib import Path
+
+# The shared modules (lazy.py, ...) live at the root of the repository
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from lazy import lazy
+from tracing import OtlpHttpExporter, TailSampling, Tracer, set_tracer, trace_flask, trace_kafka
 
 app = Flask(__name__)
 
-# Initialize Kafka producer
-producer = KafkaProducer(
-    bootstrap_servers=['localhost:9092'],
-    value_serializer=lambda v: json.dumps(v).encode('utf-8')
-)
+# Tracing (tracing.py): a span per request and per Kafka send, with the
+# trace context in the message headers so consumers continue the trace.
+# 1% of requests are traced, plus every one that fails or takes over 500 ms.
+tracer = set_tracer(Tracer(
+    'trading-platform', OtlpHttpExporter('http://localhost:4318/v1/traces'),
+    sample_ratio=0.01, tail=TailSampling(latency=0.5),
+))
+atexit.register(tracer.shutdown)
+trace_flask(app)
+
+# Kafka producer, created by the first trade rather than at import: the
+# constructor connects to the brokers (and raises NoBrokersAvailable when
+# they are down), so creating it here would keep the app from starting at
+# all. One producer per process, shared by all request threads; while the
+# brokers are down, trades fail fast for 5 s instead of each waiting to
+# connect (lazy.py).
+def make_producer():
+    from kafka import KafkaProducer  # imported with the first trade too
+    return trace_kafka(KafkaProducer(
+        bootstrap_servers=['localhost:9092'],
+        value_serializer=lambda v: json.dumps(v).encode('utf-8')
+    ))
+
+producer = lazy(make_producer)
 
 def get_db():
     conn = sqlite3.connect('trading.db')
@@ -1,15 +1,35 @@
 from flask import Flask, jsonify, request
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, inspect, select, text
 from datetime import datetime
+import math
+import os
+import threading
+import time
+
+from session_router import RoutingSession, init_router, read_only, replica_binds
 
 app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///travel_routes.db'
-db = SQLAlchemy(app)
+# Comma separated, e.g. "sqlite:///travel_routes_replica_0.db,sqlite:///travel_routes_replica_1.db"
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('SQLALCHEMY_REPLICA_URIS', '').split(',') if uri
+]
+app.config['SQLALCHEMY_REPLICA_STICKY_SECONDS'] = 5.0
+app.config['SQLALCHEMY_BINDS'] = replica_binds(app.config['SQLALCHEMY_REPLICA_URIS'])
+# Writes go to the primary, reads of @read_only handlers go to a replica
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
+init_router(app, db)
 
 # Models
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
+    # Materialized counters, kept in the same transaction as the insert/delete
+    # of a Route / RouteShare (see the mapper events below). They let the
+    # paginated endpoints return `total` without a COUNT(*) per page.
+    routes_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    shared_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     routes = db.relationship('Route', backref='user', lazy=True)
 
 class Route(db.Model):
@@ -25,8 +45,98 @@ class RouteShare(db.Model):
     route_id = db.Column(db.Integer, db.ForeignKey('route.id'), nullable=False)
     shared_with_user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
 
+# Counter maintenance
+# The events run inside the flush, on the same connection/transaction as the
+# INSERT/DELETE itself, so a rollback rolls the counter back too.
+def _bump(connection, column, user_id, delta):
+    users = User.__table__
+    connection.execute(
+        users.update()
+        .where(users.c.id == user_id)
+        .values({column: users.c[column] + delta})
+    )
+
+@event.listens_for(Route, 'after_insert')
+def _route_inserted(mapper, connection, route):
+    _bump(connection, 'routes_count', route.user_id, 1)
+
+@event.listens_for(Route, 'after_delete')
+def _route_deleted(mapper, connection, route):
+    _bump(connection, 'routes_count', route.user_id, -1)
+
+@event.listens_for(RouteShare, 'after_insert')
+def _share_inserted(mapper, connection, share):
+    _bump(connection, 'shared_count', share.shared_with_user_id, 1)
+
+@event.listens_for(RouteShare, 'after_delete')
+def _share_deleted(mapper, connection, share):
+    _bump(connection, 'shared_count', share.shared_with_user_id, -1)
+
+def reconcile_counters():
+    """Recompute the counters from the source tables and fix any drift.
+
+    Drift can come from writes that bypass the ORM (raw SQL, manual fixes).
+    Returns the number of users that were corrected.
+    """
+    routes_count = (
+        select(func.count(Route.id)).where(Route.user_id == User.id).scalar_subquery()
+    )
+    shared_count = (
+        select(func.count(RouteShare.id))
+        .where(RouteShare.shared_with_user_id == User.id)
+        .scalar_subquery()
+    )
+    # UPDATE user SET routes_count = (SELECT COUNT(*) ...), shared_count = (...)
+    # WHERE routes_count != (...) OR shared_count != (...)
+    result = db.session.execute(
+        db.update(User)
+        .where((User.routes_count != routes_count) | (User.shared_count != shared_count))
+        .values(routes_count=routes_count, shared_count=shared_count)
+    )
+    db.session.commit()
+    return result.rowcount
+
+def ensure_counter_columns():
+    """Add routes_count / shared_count to a `user` table created before they existed.
+
+    create_all() only creates missing tables, it never alters one. The new
+    columns start at 0; run reconcile_counters() afterwards to fill them.
+    """
+    table = User.__table__
+    existing = {column['name'] for column in inspect(db.engine).get_columns(table.name)}
+    quote = db.engine.dialect.identifier_preparer.quote
+    with db.engine.begin() as connection:
+        for name in ('routes_count', 'shared_count'):
+            if name not in existing:
+                connection.execute(text(
+                    f'ALTER TABLE {quote(table.name)} ADD COLUMN {quote(name)} INTEGER NOT NULL DEFAULT 0'
+                ))
+
+def start_counter_reconciler(interval_seconds=300):
+    """Run reconcile_counters() every `interval_seconds` in a daemon thread."""
+    def loop():
+        while True:
+            time.sleep(interval_seconds)
+            with app.app_context():
+                try:
+                    fixed = reconcile_counters()
+                    if fixed:
+                        app.logger.warning('Reconciled route counters for %d users', fixed)
+                except Exception:
+                    app.logger.exception('Route counter reconciliation failed')
+
+    thread = threading.Thread(target=loop, name='counter-reconciler', daemon=True)
+    thread.start()
+    return thread
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Fix drifted routes_count / shared_count values."""
+    print(f'Corrected {reconcile_counters()} users')
+
 # API Endpoints
 @app.route('/api/routes', methods=['GET'])
+@read_only
 def get_routes():
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
@@ -43,7 +153,18 @@ def get_routes():
     # ORDER BY created_at DESC 
     # LIMIT :per_page
     # OFFSET (:page - 1) * :per_page
-    routes = query.order_by(Route.created_at.desc()).paginate(page=page, per_page=per_page)
+    #
+    # With a user_id the total comes from the user's routes_count (a primary key
+    # lookup) instead of a SELECT COUNT(*) over the user's routes on every page.
+    if user_id:
+        routes = query.order_by(Route.created_at.desc()).paginate(
+            page=page, per_page=per_page, count=False
+        )
+        user = db.session.get(User, user_id)
+        total = user.routes_count if user else 0
+    else:
+        routes = query.order_by(Route.created_at.desc()).paginate(page=page, per_page=per_page)
+        total = routes.total
     
     return jsonify({
         'routes': [{
@@ -53,8 +174,8 @@ def get_routes():
             'created_at': route.created_at.isoformat(),
             'user_id': route.user_id
         } for route in routes.items],
-        'total': routes.total,
-        'pages': routes.pages,
+        'total': total,
+        'pages': math.ceil(total / routes.per_page) if total else 0,
         'current_page': routes.page
     })
 
@@ -83,6 +204,7 @@ def share_route(route_id):
     return jsonify({'message': 'Route shared successfully'}), 201
 
 @app.route('/api/routes/shared-with-me', methods=['GET'])
+@read_only
 def get_shared_routes():
     page = request.args.get('page', 1, type=int)
     per_page = request.args.get('per_page', 10, type=int)
@@ -94,7 +216,10 @@ def get_shared_routes():
     shared_routes = db.session.query(Route)\
         .join(RouteShare)\
         .filter(RouteShare.shared_with_user_id == user_id)\
-        .paginate(page=page, per_page=per_page)
+        .paginate(page=page, per_page=per_page, count=False)
+    # Every share of this user is one row of the join, so shared_count is the total
+    user = db.session.get(User, user_id)
+    total = user.shared_count if user else 0
     
     return jsonify({
         'routes': [{
@@ -104,11 +229,19 @@ def get_shared_routes():
             'created_at': route.created_at.isoformat(),
             'shared_by': route.user_id
         } for route in shared_routes.items],
-        'total': shared_routes.total,
-        'pages': shared_routes.pages,
+        'total': total,
+        'pages': math.ceil(total / shared_routes.per_page) if total else 0,
         'current_page': shared_routes.page
     })
 
 if __name__ == '__main__':
-    db.create_all()
+    with app.app_context():
+        db.create_all()
+        ensure_counter_columns()
+        # Before serving: the counters of existing users (or of a database
+        # that just got the columns) are right from the first request
+        fixed = reconcile_counters()
+        if fixed:
+            app.logger.warning('Reconciled route counters for %d users', fixed)
+    start_counter_reconciler()
     app.run(debug=True)
@@ -0,0 +1,149 @@
+"""
+Read-replica session routing for Flask-SQLAlchemy.
+
+One primary takes every write, a pool of replicas serves the read-only handlers:
+
+    handler marked @read_only ──► RoutingSession.get_bind() ──► replica_0 / replica_1 / ...
+    any other handler / flush  ──► RoutingSession.get_bind() ──► primary
+
+Replicas lag behind the primary, so a user that just wrote something could
+read a stale replica and "lose" their own write. To avoid that we keep
+read-your-writes stickiness: after a user writes, their reads go to the primary
+for STICKY_SECONDS.
+
+Config (app.config):
+    SQLALCHEMY_DATABASE_URI        primary
+    SQLALCHEMY_REPLICA_URIS        list of replica URIs (empty -> everything hits the primary)
+    SQLALCHEMY_REPLICA_STICKY_SECONDS
+
+Locally the replicas can be plain SQLite files; `flask sync-replicas` copies the
+primary into them, which is our stand-in for streaming replication (and makes
+replication lag easy to reproduce: write, don't sync, read).
+"""
+import itertools
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+from flask import g, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+REPLICA_BIND_PREFIX = 'replica_'
+DEFAULT_STICKY_SECONDS = 5.0
+
+
+def replica_binds(replica_uris):
+    """Turn a list of replica URIs into SQLALCHEMY_BINDS entries."""
+    return {f'{REPLICA_BIND_PREFIX}{i}': uri for i, uri in enumerate(replica_uris)}
+
+
+def sticky_key():
+    # Who "the user" is for read-your-writes. The routes API has no auth yet,
+    # so we use the User-Id header and fall back to the client address.
+    return request.headers.get('User-Id') or request.remote_addr
+
+
+class ReplicaRouter:
+    """Picks a replica round-robin and remembers who wrote recently."""
+
+    def __init__(self, replica_keys, sticky_seconds=DEFAULT_STICKY_SECONDS):
+        self.replica_keys = list(replica_keys)
+        self.sticky_seconds = sticky_seconds
+        self._cycle = itertools.cycle(self.replica_keys)
+        self._last_write = {}  # sticky key -> monotonic time of the last write
+        self._lock = threading.Lock()
+
+    def next_replica(self):
+        with self._lock:
+            return next(self._cycle)
+
+    def record_write(self, key):
+        with self._lock:
+            self._last_write[key] = time.monotonic()
+
+    def is_sticky(self, key):
+        with self._lock:
+            last = self._last_write.get(key)
+            if last is None:
+                return False
+            if time.monotonic() - last < self.sticky_seconds:
+                return True
+            # Window is over, forget the user so the dict doesn't grow forever
+            del self._last_write[key]
+            return False
+
+
+class RoutingSession(Session):
+    """Session that sends reads of @read_only handlers to replicas."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+
+        router = self._db.router
+        is_write = self._flushing or isinstance(clause, UpdateBase)
+
+        if is_write and g:
+            g.db_wrote = True
+
+        if (
+            not is_write
+            and router.replica_keys
+            and g
+            and g.get('db_read_only')
+            and not router.is_sticky(sticky_key())
+        ):
+            # Remember the replica for the whole request, so all queries of one
+            # handler (e.g. the page and its count) see the same snapshot
+            if 'db_replica' not in g:
+                g.db_replica = router.next_replica()
+            return self._db.engines[g.db_replica]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(f):
+    """Mark a handler as safe to serve from a replica."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def init_router(app, db):
+    """Attach the router to `db` and start the stickiness window after writes."""
+    replica_uris = app.config.get('SQLALCHEMY_REPLICA_URIS', [])
+    db.router = ReplicaRouter(
+        replica_binds(replica_uris).keys(),
+        app.config.get('SQLALCHEMY_REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS),
+    )
+
+    @app.after_request
+    def _remember_write(response):
+        if g.get('db_wrote'):
+            db.router.record_write(sticky_key())
+        return response
+
+    @app.cli.command('sync-replicas')
+    def sync_replicas_command():
+        """Copy the primary SQLite database into every replica."""
+        sync_sqlite_replicas(db)
+
+    return db.router
+
+
+def sync_sqlite_replicas(db):
+    """Local stand-in for replication: online-backup the primary into each replica."""
+    primary = sqlite3.connect(db.engine.url.database)
+    try:
+        for key in db.router.replica_keys:
+            replica = sqlite3.connect(db.engines[key].url.database)
+            try:
+                primary.backup(replica)
+            finally:
+                replica.close()
+    finally:
+        primary.close()
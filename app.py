@@ -1,86 +1,128 @@
 from flask import Flask, request
+import atexit
+import os
 import logging
 import time
 import random
-from prometheus_client import Counter, Histogram, Gauge, start_http_server
-import redis
-from elasticsearch import Elasticsearch
-import psycopg2
+from prometheus_client import Gauge
+from lazy import lazy
+from log_pipeline import setup_logging
+from flask_metrics import RequestMetrics
+from pg_pool import HealthProbe, create_pool
+from redis_cache import RedisCache
+from es_bulk import BulkIndexer
+from tracing import OtlpHttpExporter, TailSampling, Tracer, set_tracer, trace_flask, trace_redis
+from profiler import ContinuousProfiler, profile_flask
 
 # Initialize Flask app
 app = Flask(__name__)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging: JSON lines to Logstash (and text to the console), sent
+# from a background thread so a request never waits on a log call
+setup_logging('logstash', 5044, service='travel-app')
 logger = logging.getLogger(__name__)
 
-# Initialize Prometheus metrics
-REQUEST_COUNT = Counter('app_requests_total', 'Total app requests')
-REQUEST_LATENCY = Histogram('app_request_latency_seconds', 'Request latency')
-ACTIVE_USERS = Gauge('app_active_users', 'Number of active users')
+# Initialize Prometheus metrics: request rate, errors and duration of every
+# route come from RequestMetrics, which also serves GET /metrics with the
+# values of all gunicorn workers (flask_metrics.py)
+metrics = RequestMetrics(app)
+
+# Tracing: spans for requests, PostgreSQL queries and Redis commands, sent to
+# the OpenTelemetry Collector. 1% of requests are traced, plus every one that
+# fails or takes over 500 ms (tracing.py)
+tracer = set_tracer(Tracer(
+    'travel-app', OtlpHttpExporter('http://otel-collector:4318/v1/traces'),
+    sample_ratio=0.01, tail=TailSampling(latency=0.5),
+))
+atexit.register(tracer.shutdown)
+trace_flask(app)
+
+# Sampling profiler (profiler.py), off unless DEBUG_PROFILE is set. Workers
+# are single-threaded, so set PROFILE_CONTINUOUS too and ask for
+# GET /debug/profile?seconds=300&recent=1; each worker also writes one file a
+# minute to /tmp/profiles.
+if os.environ.get('DEBUG_PROFILE'):
+    continuous = None
+    if os.environ.get('PROFILE_CONTINUOUS'):
+        continuous = ContinuousProfiler(dump_dir='/tmp/profiles').start()
+    profile_flask(app, continuous)
+
+ACTIVE_USERS = Gauge('app_active_users', 'Number of active users', multiprocess_mode='livesum')
 
 # Initialize connections
-redis_client = redis.Redis(host='redis', port=6379)
-es_client = Elasticsearch(['http://elasticsearch:9200'])
+# Clients are created by the first request that uses them (lazy.py), not
+# while the worker boots: a worker that has only answered /metrics or
+# /db-test hasn't imported redis (~80 ms) or started the indexer's thread.
+def make_redis():
+    import redis
+    from redis.backoff import NoBackoff
+    from redis.retry import Retry
+    # Short timeouts and no retries (redis-py's default retries with backoff
+    # take ~5 s to give up): the cache computes the response itself when Redis
+    # is slow or down, it shouldn't wait to find out
+    return trace_redis(redis.Redis(
+        host='redis', port=6379, socket_timeout=0.1, socket_connect_timeout=0.1,
+        retry=Retry(NoBackoff(), 0),
+    ))
+
+redis_client = lazy(make_redis)
+cache = RedisCache(redis_client)
+
+# Elasticsearch: documents are buffered and sent with _bulk from a background
+# thread (es_bulk.py). In a handler, don't wait for room when Elasticsearch
+# falls behind: es_indexer.index(index, doc, id=..., block=False) raises
+# IndexerFull instead.
+def make_es_indexer():
+    indexer = BulkIndexer('http://elasticsearch:9200')
+    atexit.register(indexer.close, 5.0)
+    return indexer
 
-def get_db_connection():
-    return psycopg2.connect(
-        dbname="travelapp",
-        user="postgres",
-        password="postgres",
-        host="db"
-    )
+es_indexer = lazy(make_es_indexer)
+
+# PostgreSQL: one pool per worker process, shared by all handlers
+# (`with db.connection() as conn:`), see pg_pool.py
+db = create_pool()
+db_probe = HealthProbe(db).start()
 
 @app.route('/')
 def home():
-    REQUEST_COUNT.inc()
-    start_time = time.time()
-    
     # Simulate some work and generate logs
     sleep_time = random.uniform(0.1, 0.5)
     time.sleep(sleep_time)
     
     # Log the request
-    logger.info(f'Home page accessed. Processing time: {sleep_time:.2f} seconds')
-    
-    # Record request latency
-    REQUEST_LATENCY.observe(time.time() - start_time)
+    logger.info('Home page accessed. Processing time: %.2f seconds', sleep_time,
+                extra={'processing_time': sleep_time})
     
     return 'Hello World!'
 
+@app.route('/db-version')
+@cache.view(ttl=300)
+def db_version():
+    # The same for every user and until the next upgrade: one query per
+    # 5 minutes for all workers, the rest are Redis hits (redis_cache.py)
+    with db.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SELECT version()')
+            return cur.fetchone()[0]
+
 @app.route('/error')
 def error():
     logger.error('This is a sample error!')
     return 'Error generated', 500
 
-# We don't need this endpoint because we are
-# already exposing metrics using start_http_server
-# prometheus will scrape this endpoint automatically
-# from that server (on port 4444)
-
-# @app.route('/metrics')
-# def metrics():
-#     return generate_latest(), 200, {'Content-Type': CONTENT_TYPE_LATEST}
+# GET /metrics is added by RequestMetrics, on the app's own port. A separate
+# start_http_server(4444) would only report the worker process it runs in
+# (and every worker would try to bind the port).
 
 @app.route('/db-test')
 def db_test():
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT 1')
-        logger.info('Database connection successful')
-        cur.close()
-        conn.close()
+    # The last result of the background probe: health checks hitting this
+    # endpoint every few seconds cost no database round trip
+    if db_probe.healthy():
         return 'DB Connection OK'
-    except Exception as e:
-        logger.error(f'Database error: {str(e)}')
-        return 'DB Connection Failed', 500
+    return 'DB Connection Failed', 500
 
 if __name__ == '__main__':
-    import threading
-    thread = threading.Thread(target=start_http_server, args=(4444,))
-    thread.start()
+    # Development server; in the container: gunicorn -c gunicorn.conf.py app:app
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,279 @@
+"""
+Non-blocking SQLite access for async (FastAPI) code.
+
+sqlite3 is a blocking C library: calling it inside `async def` freezes the
+event loop for the whole query, so one slow query stalls every in-flight
+request. We can't make sqlite3 async, but we can move it off the loop:
+
+    event loop ──await──► bounded ThreadPoolExecutor (N threads)
+                              └─ borrows a connection from a ConnectionPool (db_pool.py)
+
+- Bounded: at most N queries run at once, the rest wait in the executor queue
+  instead of spawning threads without limit. Keep N above the number of slow
+  queries you expect at once, or fast queries queue behind them.
+- Pooled connections: opened once at startup and reused, so the connect cost
+  is not paid per request; only one thread uses a connection at a time.
+- WAL journal mode: readers don't block the writer and vice versa, so the
+  worker threads actually run in parallel (sqlite3 releases the GIL while it works).
+
+Usage:
+    db = AsyncSQLite(sqlite_pool('travel.db'), max_workers=8)
+    row = await db.fetchone("SELECT * FROM users WHERE id = ?", (1,))
+    rows = await db.fetchall("SELECT * FROM trips LIMIT ?", (10,))
+    row = await db.write("INSERT INTO users (email, name) VALUES (?, ?) RETURNING *", (...))
+
+    # or keep one connection for a whole request / transaction
+    async with db.connection() as conn:
+        rows = await conn.fetchall(...)
+
+Run this file to benchmark blocking vs. executor access under a mixed load:
+    python async_db.py            (WORKERS=16 python async_db.py to change the pool size)
+
+On a 1 CPU box with 8 workers, fast reads went from p50 29 ms / p99 129 ms
+(blocking) to p50 5 ms / p99 15 ms (executor).
+"""
+import asyncio
+import contextvars
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from db_pool import ConnectionPool
+from tracing import TracedSQLiteConnection
+
+
+def connect_sqlite(database, timeout=5.0, cached_statements=256):
+    """Open a connection ready to be shared through a pool.
+
+    cached_statements is sqlite3's per-connection prepared statement cache:
+    a pooled connection that runs the same queries again skips re-parsing them.
+    """
+    # check_same_thread=False because a pooled connection is used by whichever
+    # worker thread borrows it; the pool guarantees one borrower at a time.
+    conn = sqlite3.connect(
+        database,
+        timeout=timeout,
+        check_same_thread=False,
+        cached_statements=cached_statements,
+        factory=TracedSQLiteConnection,  # a span per query inside a traced request
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    return conn
+
+
+def ping_sqlite(conn):
+    conn.execute('SELECT 1').fetchone()
+
+
+def reset_sqlite(conn):
+    # Don't hand a half-finished transaction to the next borrower
+    if conn.in_transaction:
+        conn.rollback()
+
+
+def sqlite_pool(database, min_size=8, max_size=16, **kwargs):
+    return ConnectionPool(
+        lambda: connect_sqlite(database),
+        min_size=min_size,
+        max_size=max_size,
+        health_check=ping_sqlite,
+        reset=reset_sqlite,
+        **kwargs,
+    )
+
+
+class _Queries:
+    """fetchone/fetchall/write on top of run(fn) -- shared by both classes below."""
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def write(self, sql, params=()):
+        """Execute a write, commit, and return the first RETURNING row (if any)."""
+        def _write(conn):
+            try:
+                row = conn.execute(sql, params).fetchone()
+                conn.commit()
+                return row
+            except Exception:
+                conn.rollback()
+                raise
+        return await self.run(_write)
+
+
+class AsyncConnection(_Queries):
+    """One pooled connection, checked out for the duration of a request."""
+
+    def __init__(self, conn, executor):
+        self._conn = conn
+        self._executor = executor
+
+    async def run(self, fn, *args):
+        """Run fn(conn, *args) on a worker thread and await its result.
+
+        Use this for several statements that must share one transaction
+        (e.g. a check and an insert).
+        """
+        loop = asyncio.get_running_loop()
+        # run_in_executor doesn't carry contextvars over (the current span)
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, fn, self._conn, *args)
+
+
+class AsyncSQLite(_Queries):
+    def __init__(self, pool, max_workers=8):
+        self.pool = pool
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='sqlite'
+        )
+        self._slots = None
+
+    def _call(self, fn, args):
+        with self.pool.connection() as conn:
+            return fn(conn, *args)
+
+    async def run(self, fn, *args):
+        """Run fn(conn, *args) on a worker thread with a connection borrowed just for it."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        async with self._slot():
+            return await loop.run_in_executor(self._executor, context.run, self._call, fn, args)
+
+    @asynccontextmanager
+    async def _slot(self):
+        # Wait for a free connection here, on the loop, and not inside pool.acquire():
+        # a worker thread blocked in acquire() could wait on a connection whose
+        # request needs that very worker to finish -- a deadlock until timeout.
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.pool.max_size)
+        async with self._slots:
+            yield
+
+    @asynccontextmanager
+    async def connection(self):
+        """Check a connection out of the pool and back in when the block exits."""
+        loop = asyncio.get_running_loop()
+        async with self._slot():
+            conn = await loop.run_in_executor(self._executor, self.pool.acquire)
+            try:
+                yield AsyncConnection(conn, self._executor)
+            finally:
+                self.pool.release(conn)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+
+# Benchmark
+# A mixed load: a few slow full-scan searches (LIKE '%x%') plus many fast
+# point reads and inserts, arriving spread over ~1 second like real traffic.
+# "blocking" runs sqlite3 directly inside the coroutines (what warmup.py did),
+# "executor" goes through AsyncSQLite. We report latency of the fast requests:
+# with blocking access they queue behind every slow scan.
+if __name__ == '__main__':
+    import os
+    import random
+    import statistics
+    import tempfile
+    import time
+
+    TRIPS = 300_000
+    SLOW, FAST_READS, WRITES = 8, 400, 100
+    DURATION = 1.0  # seconds over which the requests arrive
+    WORKERS = int(os.environ.get('WORKERS', 8))
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    setup = sqlite3.connect(path)
+    setup.execute('PRAGMA journal_mode=WAL')
+    setup.execute(
+        'CREATE TABLE trips (id INTEGER PRIMARY KEY, user_id INTEGER, title TEXT, '
+        'description TEXT, start_date TEXT, end_date TEXT)'
+    )
+    setup.executemany(
+        'INSERT INTO trips (user_id, title, description, start_date, end_date) VALUES (?, ?, ?, ?, ?)',
+        (
+            (i % 1000, f'Trip {i} to city {random.randint(0, 10_000)}', 'x' * 80,
+             '2023-06-01 00:00:00', '2023-06-10 00:00:00')
+            for i in range(TRIPS)
+        ),
+    )
+    setup.commit()
+    setup.close()
+
+    SLOW_SQL = "SELECT * FROM trips WHERE title LIKE ?"
+    READ_SQL = "SELECT * FROM trips WHERE id = ?"
+    WRITE_SQL = (
+        "INSERT INTO trips (user_id, title, description, start_date, end_date) "
+        "VALUES (1, 'new', NULL, '2023-01-01', '2023-01-02') RETURNING *"
+    )
+
+    def workload():
+        jobs = [('slow', SLOW_SQL, ('%city 42%',)) for _ in range(SLOW)]
+        jobs += [('read', READ_SQL, (random.randint(1, TRIPS),)) for _ in range(FAST_READS)]
+        jobs += [('write', WRITE_SQL, ()) for _ in range(WRITES)]
+        # (arrival offset, kind, sql, params)
+        return [(random.uniform(0, DURATION),) + job for job in jobs]
+
+    async def arrive(offset):
+        # Requests arrive on a schedule; latency is measured from the arrival
+        # time, so time spent waiting for a blocked loop counts.
+        await asyncio.sleep(offset)
+
+    async def run_blocking(jobs):
+        conn = sqlite3.connect(path, timeout=5.0)
+        conn.row_factory = sqlite3.Row
+
+        t0 = time.perf_counter()
+
+        async def request(offset, kind, sql, params):
+            await arrive(offset)
+            start = t0 + offset
+            rows = conn.execute(sql, params).fetchall()
+            if kind == 'write':
+                conn.commit()
+            return kind, time.perf_counter() - start, rows
+
+        try:
+            return await asyncio.gather(*(request(*job) for job in jobs))
+        finally:
+            conn.close()
+
+    async def run_executor(jobs):
+        db = AsyncSQLite(sqlite_pool(path, min_size=WORKERS, max_size=WORKERS), max_workers=WORKERS)
+
+        t0 = time.perf_counter()
+
+        async def request(offset, kind, sql, params):
+            await arrive(offset)
+            start = t0 + offset
+            if kind == 'write':
+                rows = await db.write(sql, params)
+            else:
+                rows = await db.fetchall(sql, params)
+            return kind, time.perf_counter() - start, rows
+
+        try:
+            return await asyncio.gather(*(request(*job) for job in jobs))
+        finally:
+            db.close()
+
+    def report(name, results, wall):
+        print(f'{name:>9}: wall {wall * 1000:8.1f} ms')
+        for kind in ('read', 'write', 'slow'):
+            lat = sorted(t for k, t, _ in results if k == kind)
+            p99 = lat[int(len(lat) * 0.99) - 1] if len(lat) >= 100 else lat[-1]
+            print(
+                f'           {kind:<5} n={len(lat):4d}  p50 {statistics.median(lat) * 1000:8.2f} ms'
+                f'  p99 {p99 * 1000:8.2f} ms'
+            )
+
+    for name, runner in (('blocking', run_blocking), ('executor', run_executor)):
+        jobs = workload()
+        start = time.perf_counter()
+        results = asyncio.run(runner(jobs))
+        report(name, results, time.perf_counter() - start)
@@ -0,0 +1,97 @@
+"""
+Request-scoped batching loader (the DataLoader pattern).
+
+Expanding `user_id` into a user record for a page of trips is the classic
+N+1: one query for the trips, then one `SELECT * FROM users WHERE id = ?`
+per trip. A DataLoader collects the keys asked for during one tick of the
+event loop and fetches them together:
+
+    loader.load(3), loader.load(7), loader.load(3)     same tick
+          └──────────── call_soon ─────────────┘
+                  batch_load([3, 7])   ──►  SELECT * FROM users WHERE id IN (3, 7)
+
+- Keys are deduplicated and memoized: asking again for a key later in the
+  same request returns the stored result without a query.
+- One loader per request (a FastAPI dependency), so the memo never serves
+  data across requests or users.
+- Batching only happens for loads issued before the code awaits: use
+  load_many() or asyncio.gather(), not `await load()` inside a loop.
+- One batch_load at a time: a request's batches usually share its one
+  connection, which can't run two queries at once (a page of 1000 keys is
+  two batches of 500, run one after the other). `await loader.close()`
+  before that connection goes back to the pool: it waits for the running
+  batch and cancels the rest.
+"""
+import asyncio
+
+
+class DataLoader:
+    def __init__(self, batch_load, max_batch_size=500):
+        # batch_load(keys) -> {key: value}; keys missing from the dict load as None
+        self.batch_load = batch_load
+        self.max_batch_size = max_batch_size
+        self._futures = {}  # key -> Future, the memo
+        self._queue = []
+        self._tasks = set()  # referenced until done, or the event loop may drop them
+        self._lock = None  # created on the event loop, see _load_batches
+        self._closed = False
+        self.batches = 0  # number of batch_load calls, for tests and logs
+
+    def load(self, key):
+        future = self._futures.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = self._futures[key] = loop.create_future()
+            if self._closed:
+                future.cancel()
+                return future
+            if not self._queue:
+                loop.call_soon(self._dispatch)
+            self._queue.append(key)
+        return future
+
+    async def load_many(self, keys):
+        return await asyncio.gather(*(self.load(key) for key in keys))
+
+    def _dispatch(self):
+        keys, self._queue = self._queue, []
+        task = asyncio.ensure_future(self._load_batches(keys))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _load_batches(self, keys):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        for i in range(0, len(keys), self.max_batch_size):
+            batch = keys[i:i + self.max_batch_size]
+            async with self._lock:
+                if self._closed:
+                    for key in batch:
+                        self._futures.pop(key).cancel()
+                    continue
+                await self._load_batch(batch)
+
+    async def close(self):
+        """Wait for the running batch, cancel the ones not started; later loads are cancelled."""
+        self._closed = True
+        for key in self._queue:
+            self._futures.pop(key).cancel()
+        self._queue = []
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _load_batch(self, keys):
+        self.batches += 1
+        try:
+            values = await self.batch_load(keys)
+        except Exception as e:
+            for key in keys:
+                # Forget failed keys, so a later load() can try again
+                future = self._futures.pop(key)
+                if not future.done():  # done = cancelled with its request
+                    future.set_exception(e)
+            return
+        for key in keys:
+            future = self._futures[key]
+            if not future.done():
+                future.set_result(values.get(key))
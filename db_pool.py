@@ -0,0 +1,194 @@
+"""
+A small thread-safe database connection pool.
+
+Opening a connection is expensive (file open + schema read for SQLite, TCP +
+TLS + auth for PostgreSQL). Doing it per request puts that cost on every
+request. A pool opens connections once and lends them out:
+
+    acquire() ──► idle connection? ──yes──► health check if it sat idle too long ──► use it
+                        │ no
+                        ▼
+                  size < max_size? ──yes──► open a new one
+                        │ no
+                        ▼
+                  wait (up to `timeout`) for someone to release()
+
+- LIFO: the most recently used connection is handed out first, so hot
+  connections stay hot and extra ones stay idle.
+- Health check: a connection that sat idle longer than `health_check_interval`
+  is pinged before it's handed out; a broken one is replaced transparently.
+- `reset` runs on release (e.g. rollback of a half-finished transaction), so
+  the next borrower never sees someone else's state.
+- `idle_timeout`: connections idle for longer are closed (down to min_size),
+  so a burst doesn't keep max_size server connections open for good.
+  Checked on release, so a pool nobody uses keeps its connections.
+
+The pool doesn't know which database it talks to, you pass `connect`:
+
+    pool = ConnectionPool(lambda: sqlite3.connect('travel.db'), min_size=2, max_size=10)
+    with pool.connection() as conn:
+        conn.execute('SELECT 1')
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class PoolTimeout(Exception):
+    """No connection became available within the timeout."""
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        connect,
+        min_size=1,
+        max_size=10,
+        timeout=5.0,
+        health_check=None,
+        health_check_interval=30.0,
+        reset=None,
+        idle_timeout=None,
+    ):
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self._health_check = health_check
+        self.health_check_interval = health_check_interval
+        self._reset = reset
+        self.idle_timeout = idle_timeout
+
+        self._idle = deque()  # (connection, released_at), most recent on the right
+        self._size = 0  # idle + in use
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # Open min_size connections now, so the first requests don't pay for it
+        for _ in range(min_size):
+            self._idle.append((self._open(), time.monotonic()))
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def in_use(self):
+        return self._size - len(self._idle)
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def _expired(self):
+        """Take idle connections past idle_timeout out of the pool; call with the lock held."""
+        expired = []
+        if self.idle_timeout is not None:
+            cutoff = time.monotonic() - self.idle_timeout
+            # LIFO: the leftmost connection is the one idle the longest
+            while self._idle and self._size > self.min_size and self._idle[0][1] < cutoff:
+                expired.append(self._idle.popleft()[0])
+                self._size -= 1
+        return expired
+
+    def _open(self):
+        conn = self._connect()
+        with self._cond:
+            self._size += 1
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        self._close_quietly(conn)
+
+    def _is_healthy(self, conn):
+        try:
+            self._health_check(conn)
+            return True
+        except Exception:
+            return False
+
+    def acquire(self):
+        deadline = time.monotonic() + self.timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise PoolTimeout('Pool is closed')
+                if self._idle:
+                    conn, released_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # Reserve the slot now, open the connection outside the lock
+                    self._size += 1
+                    conn = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout(
+                        f'No connection available after {self.timeout}s '
+                        f'({self._size} open, all in use)'
+                    )
+                self._cond.wait(remaining)
+
+        if conn is not None:
+            idle_for = time.monotonic() - released_at
+            if (
+                self._health_check is None
+                or idle_for <= self.health_check_interval
+                or self._is_healthy(conn)
+            ):
+                return conn
+            # Broken (server restarted, socket timed out...): replace it in the same slot
+            self._close_quietly(conn)
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        if not discard and self._reset is not None:
+            try:
+                self._reset(conn)
+            except Exception:
+                discard = True
+        if discard or self._closed:
+            self._discard(conn)
+            return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            expired = self._expired()
+            self._cond.notify()
+        for old in expired:
+            self._close_quietly(old)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,482 @@
+"""
+Buffered bulk indexing into Elasticsearch.
+
+One HTTP request per document costs Elasticsearch a request parse, a
+translog write and a refresh-tracking entry each, and costs us a round
+trip. BulkIndexer buffers documents and sends them with the _bulk API from
+a background thread:
+
+    indexer = BulkIndexer('http://elasticsearch:9200')
+    indexer.index('trips', {'title': 'Reykjavik', ...}, id=trip_id)   # returns at once
+    ...
+    indexer.close()                                                    # sends what's left
+
+    index() ──► buffer ──► flush when max_docs or max_bytes are buffered,
+                              or the oldest document waited flush_interval
+                                   │
+                        POST /_bulk (one NDJSON body)
+                                   │
+              per item:  2xx ─► done
+                         429, 5xx ─► retried with exponential backoff
+                                     (up to max_retries, then dropped)
+                         other 4xx (mapping error...) ─► dropped
+              whole request failed (connection, 429, 5xx) ─► every item retried
+
+- Back-pressure: at most `max_pending` documents are in the indexer
+  (buffered, in flight or waiting for a retry). index() then blocks until
+  some are done, up to `timeout`, and raises IndexerFull after that; with
+  block=False it raises at once. Elasticsearch being slow or rejecting
+  (429) thus slows producers down instead of growing memory without bound.
+- Documents are serialized in index(), on the producer's thread: a document
+  that isn't JSON-serializable fails there, not later on the sender thread.
+- Retried items go out before new ones. A retry after a lost response
+  indexes the document again: pass `id` to make it an overwrite, not a
+  duplicate.
+- flush() sends the buffer now and waits until every document added before
+  is done.
+
+It talks HTTP directly (http.client, one keep-alive connection), not through
+the elasticsearch package: its current client (9.x) sends `compatible-with=9`
+headers, newer than the 7.17 server in docker-compose.yml, and pinning an old
+client for one endpoint isn't worth it. It also means a local stand-in that
+implements _bulk is all a test needs (see the benchmark below).
+
+Metrics (multiprocess-safe, see flask_metrics.py):
+
+    es_bulk_docs_total{result}       indexed | retried | failed | rejected
+                                     (rejected: IndexerFull raised to a producer)
+    es_bulk_request_seconds          duration of _bulk requests
+    es_bulk_pending                  documents in the indexers, summed over workers
+
+Run this file for a benchmark against a local _bulk stand-in (ThreadingHTTPServer):
+    python es_bulk.py
+
+    20000 documents, local stand-in
+        one request each            ~2,900-3,300 docs/s
+        BulkIndexer (1000/request) ~44,000-54,000 docs/s
+    20% of items rejected (429): 19990 of 20000 indexed, ~5000 retries,
+        10 failed (mapping errors)
+    _bulk takes 1 s, max_pending=2000: 5000 index() calls took 3.1 s,
+        peak pending 2000, non-blocking index() when full: IndexerFull
+
+The stand-in parses JSON in Python, so it's slower than Elasticsearch on
+both paths; the ratio is what carries over.
+"""
+import http.client
+import json
+import logging
+import random
+import threading
+import time
+from collections import deque
+from heapq import heappop, heappush
+from itertools import count
+from urllib.parse import urlsplit
+
+from prometheus_client import Counter, Gauge, Histogram
+
+try:
+    import orjson
+except ImportError:  # optional: json gives the same documents, a bit slower
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+DOCS = Counter('es_bulk_docs_total', 'Documents by outcome', ['result'])
+REQUEST = Histogram(
+    'es_bulk_request_seconds', 'Duration of _bulk requests',
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+PENDING = Gauge('es_bulk_pending', 'Documents buffered, in flight or waiting for a retry',
+                multiprocess_mode='livesum')
+
+
+class IndexerFull(Exception):
+    """max_pending documents are already in the indexer."""
+
+
+def _retryable(status):
+    # 429: a full write queue (back off and retry), 5xx: node restarting, shard moving...
+    return status == 429 or status >= 500
+
+
+def _dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':'), default=str).encode('utf-8')
+
+
+class HttpTransport:
+    """POSTs NDJSON bodies to <url>/_bulk over one keep-alive connection (one thread only)."""
+
+    def __init__(self, url, timeout=30.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 9200)
+        self.https = parts.scheme == 'https'
+        self.timeout = timeout
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self._conn = cls(self.host, self.port, timeout=self.timeout)
+        return self._conn
+
+    def __call__(self, body):
+        """(status, parsed JSON response); raises OSError / HTTPException if the request failed."""
+        conn = self._connection()
+        try:
+            conn.request('POST', '/_bulk', body, {'Content-Type': 'application/x-ndjson'})
+            response = conn.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            self.close()  # reconnect on the next request
+            raise
+        try:
+            return response.status, json.loads(data)
+        except ValueError:
+            return response.status, None
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class _Action:
+    __slots__ = ('lines', 'attempts')
+
+    def __init__(self, lines):
+        self.lines = lines  # action + source lines of the NDJSON body
+        self.attempts = 0
+
+
+class BulkIndexer:
+    def __init__(
+        self,
+        url_or_transport,
+        max_docs=1000,
+        max_bytes=5 * 1024 * 1024,
+        flush_interval=1.0,
+        max_pending=10000,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=30.0,
+    ):
+        if callable(url_or_transport):
+            self._transport = url_or_transport
+        else:
+            self._transport = HttpTransport(url_or_transport)
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self._buffer = deque()  # actions to send, retries first
+        self._buffer_bytes = 0
+        self._oldest = None  # monotonic time the oldest buffered action was added
+        self._retries = []  # heap of (due, seq, [action, ...])
+        self._seq = count()
+        self._pending = 0  # buffered + in flight + waiting for a retry
+        self._flushing = 0  # flush() calls waiting
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='es-bulk', daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def index(self, index, doc, id=None, block=True, timeout=None):
+        """Queue `doc` for indexing into `index`; blocks while max_pending are in the indexer."""
+        meta = {'_index': index}
+        if id is not None:
+            meta['_id'] = id
+        action = _Action(_dumps({'index': meta}) + b'\n' + _dumps(doc) + b'\n')
+
+        with self._cond:
+            if self._closing:
+                raise RuntimeError('BulkIndexer is closed')
+            if self._pending >= self.max_pending:
+                deadline = None if timeout is None else time.monotonic() + timeout
+                while self._pending >= self.max_pending:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if not block or (remaining is not None and remaining <= 0):
+                        DOCS.labels('rejected').inc()
+                        raise IndexerFull(f'{self._pending} documents pending')
+                    self._cond.wait(remaining)
+            self._pending += 1
+            self._append(action)
+        PENDING.inc()
+
+    def _append(self, action, first=False):
+        if first:
+            self._buffer.appendleft(action)
+        else:
+            self._buffer.append(action)
+        self._buffer_bytes += len(action.lines)
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if len(self._buffer) >= self.max_docs or self._buffer_bytes >= self.max_bytes:
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """Send everything now; True once all documents added so far are done."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushing -= 1
+
+    def close(self, timeout=30.0):
+        """Stop accepting documents, send what's left (retries included) for up to `timeout`."""
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if isinstance(self._transport, HttpTransport):
+            self._transport.close()
+
+    # Sender thread
+
+    def _next_batch(self):
+        """Wait until a batch is due and take it; None once closed and empty."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                # Due retries go first (their documents are the oldest)
+                while self._retries and (self._retries[0][0] <= now or self._closing):
+                    for action in reversed(heappop(self._retries)[2]):
+                        self._append(action, first=True)
+                if self._buffer and (
+                    len(self._buffer) >= self.max_docs
+                    or self._buffer_bytes >= self.max_bytes
+                    or now - self._oldest >= self.flush_interval
+                    or self._flushing
+                    or self._closing
+                ):
+                    break
+                if self._closing and not self._pending:
+                    return None
+                wake = []
+                if self._buffer:
+                    wake.append(self._oldest + self.flush_interval)
+                if self._retries:
+                    wake.append(self._retries[0][0])
+                self._cond.wait(min(wake) - now if wake else None)
+
+            batch, size = [], 0
+            while self._buffer and len(batch) < self.max_docs:
+                action = self._buffer[0]
+                if batch and size + len(action.lines) > self.max_bytes:
+                    break
+                batch.append(self._buffer.popleft())
+                size += len(action.lines)
+            self._buffer_bytes -= size
+            self._oldest = time.monotonic() if self._buffer else None
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                self._send(batch)
+            except Exception:
+                # A bug here must not kill the thread and leave producers blocked
+                logger.exception('Bulk request failed')
+                self._done(batch, 'failed')
+
+    def _send(self, batch):
+        body = b''.join(action.lines for action in batch)
+        start = time.perf_counter()
+        try:
+            status, response = self._transport(body)
+        except (OSError, http.client.HTTPException) as e:
+            logger.warning('Bulk request of %d documents failed: %s', len(batch), e)
+            return self._retry(batch)
+        finally:
+            REQUEST.observe(time.perf_counter() - start)
+
+        if _retryable(status):
+            logger.warning('Bulk request of %d documents: HTTP %d', len(batch), status)
+            return self._retry(batch)
+        if status != 200 or not response or len(response.get('items', ())) != len(batch):
+            logger.error('Bulk request of %d documents rejected: HTTP %d %s',
+                         len(batch), status, str(response)[:500])
+            return self._done(batch, 'failed')
+        if not response.get('errors'):
+            return self._done(batch, 'indexed')
+
+        indexed, retry, failed = [], [], []
+        for action, item in zip(batch, response['items']):
+            result = next(iter(item.values()))
+            item_status = result.get('status', 500)
+            if item_status < 300:
+                indexed.append(action)
+            elif _retryable(item_status):
+                retry.append(action)
+            else:
+                failed.append(action)
+                logger.error('Document rejected (%d): %s', item_status, result.get('error'))
+        self._done(indexed, 'indexed')
+        self._done(failed, 'failed')
+        self._retry(retry)
+
+    def _retry(self, actions):
+        retry, give_up = [], []
+        for action in actions:
+            action.attempts += 1
+            (give_up if action.attempts > self.max_retries else retry).append(action)
+        if retry:
+            # Exponential backoff with jitter; the items of a batch stay together,
+            # so a retry is one _bulk request again, not one per document
+            attempts = max(action.attempts for action in retry)
+            delay = min(self.max_backoff, self.backoff * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+            with self._cond:
+                heappush(self._retries, (time.monotonic() + delay, next(self._seq), retry))
+                self._cond.notify_all()
+            DOCS.labels('retried').inc(len(retry))
+        if give_up:
+            logger.error('Dropping %d documents after %d retries', len(give_up), self.max_retries)
+            self._done(give_up, 'failed')
+
+    def _done(self, actions, result):
+        if not actions:
+            return
+        DOCS.labels(result).inc(len(actions))
+        PENDING.dec(len(actions))
+        with self._cond:
+            self._pending -= len(actions)
+            self._cond.notify_all()  # producers blocked on max_pending, flush()
+
+
+# Benchmark
+if __name__ == '__main__':
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StandIn(BaseHTTPRequestHandler):
+        """POST /_bulk and POST /<index>/_doc, storing documents in memory.
+
+        server.reject: fraction of bulk items answered 429; documents with a
+        "bad" field get a 400 mapping error; server.stall: seconds to wait
+        before answering.
+        """
+        protocol_version = 'HTTP/1.1'  # keep-alive, like Elasticsearch
+        wbufsize = -1  # headers and body in one send, no Nagle / delayed ACK stall
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            time.sleep(self.server.stall)
+            docs = self.server.docs
+            if self.path != '/_bulk':
+                docs[(self.path.split('/')[1], len(docs))] = json.loads(body)
+                return self._reply(201, {'result': 'created'})
+            lines = body.splitlines()
+            items = []
+            for meta_line, source_line in zip(lines[::2], lines[1::2]):
+                meta = json.loads(meta_line)['index']
+                source = json.loads(source_line)
+                if 'bad' in source:
+                    status = 400
+                elif random.random() < self.server.reject:
+                    status = 429
+                else:
+                    status = 201
+                    docs[(meta['_index'], meta.get('_id', len(docs)))] = source
+                item = {'_index': meta['_index'], 'status': status}
+                if status >= 300:
+                    item['error'] = {'type': 'mapper_parsing_exception' if status == 400
+                                     else 'es_rejected_execution_exception'}
+                items.append({'index': item})
+            self._reply(200, {'took': 1, 'errors': any(i['index']['status'] >= 300 for i in items),
+                              'items': items})
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandIn)
+    server.docs, server.reject, server.stall = {}, 0.0, 0.0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    logging.basicConfig(level=logging.CRITICAL)
+    N = 20000
+    doc = {'trip_id': 1, 'title': 'Reykjavik to Vik', 'lat': 64.1466, 'lon': -21.9426,
+           'started_at': '2024-06-01T10:00:00Z', 'tags': ['iceland', 'roadtrip']}
+
+    conn = http.client.HTTPConnection('127.0.0.1', server.server_address[1])
+    start = time.perf_counter()
+    for i in range(N):
+        conn.request('POST', '/trips/_doc', json.dumps(doc), {'Content-Type': 'application/json'})
+        conn.getresponse().read()
+    one_by_one = time.perf_counter() - start
+    conn.close()
+
+    server.docs.clear()
+    indexer = BulkIndexer(url)
+    start = time.perf_counter()
+    for i in range(N):
+        indexer.index('trips', doc, id=i)
+    indexer.flush()
+    bulk = time.perf_counter() - start
+    indexer.close()
+    assert len(server.docs) == N
+    print(f'{N} documents, local stand-in')
+    print(f'    {"one request each":<28}{N / one_by_one:>8,.0f} docs/s')
+    print(f'    {"BulkIndexer (1000/request)":<28}{N / bulk:>8,.0f} docs/s')
+
+    # 20% of items rejected with 429, plus 10 unindexable documents
+    server.docs.clear()
+    server.reject = 0.2
+    indexer = BulkIndexer(url, backoff=0.05)
+    for i in range(N):
+        indexer.index('trips', {**doc, 'bad': True} if i % 2000 == 0 else doc, id=i)
+    indexer.flush()
+    indexer.close()
+    print(f'20% of items rejected (429): {len(server.docs)} of {N} indexed, '
+          f'{int(DOCS.labels("retried")._value.get())} retries, '
+          f'{int(DOCS.labels("failed")._value.get())} failed (mapping errors)')
+
+    # Back-pressure: every _bulk request takes 1 s, producers block at max_pending
+    server.docs.clear()
+    server.reject, server.stall = 0.0, 1.0
+    indexer = BulkIndexer(url, max_pending=2000)
+    start = time.perf_counter()
+    peak = 0
+    for i in range(5000):
+        indexer.index('trips', doc, id=i)
+        peak = max(peak, indexer.pending)
+    produce = time.perf_counter() - start
+    try:
+        indexer.index('trips', doc, block=False)
+    except IndexerFull:
+        full = 'IndexerFull'
+    else:
+        full = 'accepted'
+    indexer.close()
+    print(f'_bulk takes 1 s, max_pending=2000: 5000 index() calls took {produce:.1f} s, '
+          f'peak pending {peak}, non-blocking index() when full: {full}')
+    server.shutdown()
@@ -0,0 +1,200 @@
+"""
+Fast JSON responses for list endpoints.
+
+The default path for `GET /trips/?limit=1000` does, per row:
+
+    sqlite3.Row -> dict(row) -> Pydantic validates a Trip -> Trip dumped to
+    a dict -> json.dumps
+
+Validation re-checks data our own writes already validated, and it dominates
+the CPU time of large pages. RowEncoder does the schema work once per query
+shape (the tuple of column names of a cursor) instead of once per row:
+
+    - check that every required model field is a column, pick the defaults
+      of the missing optional ones, find the datetime fields
+    - generate a function `row -> dict` for exactly that shape, e.g.
+          lambda row: {'id': row[0], 'start_date': _iso(row[4]), ...}
+      (code generation, like dataclasses does for __init__)
+
+Rows then only go through that function and one json.dumps (orjson if it is
+installed) for the whole page. The output is byte-for-byte what the Pydantic
+path returns, as long as the stored data is valid, which is what we trust the
+database for. Encoding runs on the database thread (RowEncoder.query), so
+the event loop only gets the finished bytes.
+
+Run this file for rows/second of each path (pages of 1000 rows, fetch
+included):
+    python fast_json.py
+
+    dict(row) + Pydantic List[Trip]   (list_trips)      ~105k rows/s
+    RowEncoder(Trip)                                ~240-300k rows/s
+    dict(row) + jsonable_encoder      (search_trips)     ~35k rows/s
+    RowEncoder() raw columns                        ~260-300k rows/s
+"""
+import json
+import typing
+from datetime import datetime
+
+try:
+    import orjson
+except ImportError:  # optional: json produces the same bytes, a bit slower
+    orjson = None
+
+
+class SchemaMismatch(TypeError):
+    """A query's columns can't produce the response model."""
+
+
+def dumps(obj):
+    """Same bytes as FastAPI's JSONResponse (compact, UTF-8, no NaN)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(
+        obj, ensure_ascii=False, allow_nan=False, separators=(',', ':')
+    ).encode('utf-8')
+
+
+def _iso(value):
+    # sqlite3 stores datetimes as 'YYYY-MM-DD HH:MM:SS[.ffffff][+HH:MM]';
+    # Pydantic would parse that and print it back with a 'T', and a zero
+    # offset as 'Z'
+    if not isinstance(value, str):
+        return value
+    value = value.replace(' ', 'T', 1)
+    if value.endswith(('+00:00', '-00:00')):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def _is_datetime(annotation):
+    return annotation is datetime or datetime in typing.get_args(annotation)
+
+
+class RowEncoder:
+    """Encodes cursors as the JSON list of `model` (or of the raw columns if None)."""
+
+    def __init__(self, model=None):
+        self.model = model
+        self._shapes = {}  # column names -> compiled row -> dict function
+
+    def _compile(self, columns):
+        namespace = {'_iso': _iso}
+        items = []
+        if self.model is None:
+            for i, name in enumerate(columns):
+                items.append((name, f'row[{i}]'))
+        else:
+            for name, field in self.model.model_fields.items():
+                if name in columns:
+                    expr = f'row[{columns.index(name)}]'
+                    if _is_datetime(field.annotation):
+                        expr = f'_iso({expr})'
+                elif not field.is_required():
+                    namespace[f'_default_{name}'] = field.get_default(call_default_factory=True)
+                    expr = f'_default_{name}'
+                else:
+                    raise SchemaMismatch(
+                        f'{self.model.__name__}.{name} is required but the query has no such column'
+                    )
+                items.append((name, expr))
+        body = ', '.join(f'{name!r}: {expr}' for name, expr in items)
+        exec(f'def to_dict(row):\n    return {{{body}}}', namespace)
+        return namespace['to_dict']
+
+    def _to_dict(self, columns):
+        to_dict = self._shapes.get(columns)
+        if to_dict is None:
+            to_dict = self._shapes[columns] = self._compile(columns)
+        return to_dict
+
+    def to_dicts(self, cursor):
+        """All rows of an executed cursor as JSON-ready dicts."""
+        to_dict = self._to_dict(tuple(d[0] for d in cursor.description))
+        return [to_dict(row) for row in cursor]
+
+    def encode(self, cursor):
+        """JSON bytes of all rows of an executed cursor."""
+        return dumps(self.to_dicts(cursor))
+
+    def query(self, conn, sql, params=()):
+        """Run a query and encode it; meant for AsyncSQLite/AsyncConnection.run."""
+        return self.encode(conn.execute(sql, params))
+
+    def query_dicts(self, conn, sql, params=()):
+        """Like query(), but returns the dicts, to add to them before encoding."""
+        return self.to_dicts(conn.execute(sql, params))
+
+
+# Benchmark
+# 100k trips, read in pages of 1000 rows, through each serialization path.
+if __name__ == '__main__':
+    import sqlite3
+    import time
+    from typing import List, Optional
+
+    from fastapi.encoders import jsonable_encoder
+    from fastapi.responses import JSONResponse
+    from pydantic import BaseModel, TypeAdapter
+
+    class Trip(BaseModel):  # same as warmup.Trip
+        id: Optional[int] = None
+        user_id: int
+        title: str
+        description: Optional[str] = None
+        start_date: datetime
+        end_date: datetime
+
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute("""CREATE TABLE trips (
+        id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, title TEXT NOT NULL,
+        description TEXT, start_date TIMESTAMP, end_date TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+    conn.executemany(
+        'INSERT INTO trips (user_id, title, description, start_date, end_date) VALUES (?, ?, ?, ?, ?)',
+        ((i % 5000, f'Trip {i} to Lisboa', f'Café, pastéis and fado, day {i}' if i % 3 else None,
+          f'2023-{i % 12 + 1:02d}-01 00:00:00', f'2023-{i % 12 + 1:02d}-15 12:30:00')
+         for i in range(100_000)),
+    )
+    PAGE, PAGES = 1000, 100
+    SQL = 'SELECT * FROM trips LIMIT ? OFFSET ?'
+    adapter = TypeAdapter(List[Trip])
+    render = JSONResponse(None).render  # what FastAPI sends: json.dumps
+
+    def pydantic_path(offset):  # list_trips today (response_model=List[Trip])
+        content = [dict(row) for row in conn.execute(SQL, (PAGE, offset))]
+        return render(adapter.dump_python(adapter.validate_python(content), mode='json'))
+
+    def jsonable_path(offset):  # search_trips today (no response_model)
+        content = [dict(row) for row in conn.execute(SQL, (PAGE, offset))]
+        return render(jsonable_encoder(content))
+
+    trip_encoder, raw_encoder = RowEncoder(Trip), RowEncoder()
+
+    def fast_path(offset):
+        return trip_encoder.query(conn, SQL, (PAGE, offset))
+
+    def fast_raw_path(offset):
+        return raw_encoder.query(conn, SQL, (PAGE, offset))
+
+    assert pydantic_path(0) == fast_path(0)
+    assert jsonable_path(0) == fast_raw_path(0)
+
+    def rows_per_second(path):
+        best = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            for page in range(PAGES):
+                path(page * PAGE)
+            best = min(best, time.perf_counter() - start)
+        return PAGES * PAGE / best
+
+    print(f'encoder: {"orjson" if orjson else "json"}')
+    print(f'{"path":<44}{"rows/s":>12}')
+    for label, path in (
+        ('dict(row) + Pydantic List[Trip] (list_trips)', pydantic_path),
+        ('RowEncoder(Trip)', fast_path),
+        ('dict(row) + jsonable_encoder (search_trips)', jsonable_path),
+        ('RowEncoder() raw columns', fast_raw_path),
+    ):
+        print(f'{label:<44}{rows_per_second(path):>12,.0f}')
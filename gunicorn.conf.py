@@ -0,0 +1,28 @@
+# gunicorn -c gunicorn.conf.py app:app
+#
+# Several worker processes serve app.py. Prometheus metrics are per process,
+# so prometheus_client runs in multiprocess mode (flask_metrics.py): each
+# worker writes its values to files in PROMETHEUS_MULTIPROC_DIR (set in the
+# Dockerfile, before anything imports prometheus_client) and GET /metrics
+# adds up the files of all workers.
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+bind = '0.0.0.0:5000'
+workers = int(os.environ.get('WEB_CONCURRENCY', 4))
+# No preload_app: the log listener thread (log_pipeline.py) must start in
+# each worker, threads don't survive the fork
+
+
+def on_starting(server):
+    # Files of a previous run would add their counts to this one's
+    directory = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def child_exit(server, worker):
+    # Drop the dead worker's live gauges (counters and histograms are kept)
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,83 @@
+"""
+Conditional GET helpers: ETags, If-None-Match and an in-memory version map.
+
+REST's "Cacheable" constraint (Web/RESTful-principles.py): a client that
+already has the current representation of a resource should not make us
+query and serialize it again. Every user and trip row has a `revision`
+counter, bumped on each UPDATE, and its ETag is derived from it:
+
+    ETag: "trip-42-r3"          Cache-Control: private, no-cache
+
+    GET /trips/42  If-None-Match: "trip-42-r3"
+        version map has ("trip", 42) -> 3   ──►  304, SQLite not touched
+        not in the map                      ──►  read the row, 200 or 304
+
+Ids come from AUTOINCREMENT and are never reused, so (kind, id, revision)
+identifies one representation: a strong ETag without hashing the body.
+
+The map only learns revisions from this process (the writes it makes, the
+rows it reads). Like trip_stats.py, it assumes one process writes; with
+several, a process could answer 304 for a row another one changed.
+"""
+from collections import OrderedDict
+
+CACHE_CONTROL = 'private, no-cache'  # always revalidate, the 304 is cheap
+
+_DELETED = object()
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match check (weak comparison, as RFC 9110 asks for this header)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = (tag.strip().removeprefix('W/') for tag in if_none_match.split(','))
+    return etag.removeprefix('W/') in tags
+
+
+def revision_etag(kind, id, revision):
+    return f'"{kind}-{id}-r{revision}"'
+
+
+class VersionMap:
+    """LRU of (kind, id) -> latest revision. Only used from the event loop, no lock."""
+
+    def __init__(self, max_entries=100_000):
+        self.max_entries = max_entries
+        self._revisions = OrderedDict()
+
+    def get(self, kind, id):
+        """Latest known revision, or None if unknown or deleted."""
+        revision = self._revisions.get((kind, id))
+        if revision is None:
+            return None
+        self._revisions.move_to_end((kind, id))
+        return None if revision is _DELETED else revision
+
+    def set(self, kind, id, revision):
+        # Never move backwards: a read that started before a concurrent update
+        # (or delete) finishes after it and must not bring the old revision back
+        current = self._revisions.get((kind, id))
+        if current is _DELETED or (current is not None and current >= revision):
+            return
+        self._store((kind, id), revision)
+
+    def delete(self, kind, id):
+        self._store((kind, id), _DELETED)
+
+    def _store(self, key, value):
+        self._revisions[key] = value
+        self._revisions.move_to_end(key)
+        if len(self._revisions) > self.max_entries:
+            self._revisions.popitem(last=False)
+
+    def not_modified(self, kind, id, if_none_match):
+        """The ETag to answer 304 with if the client's copy is current, else None."""
+        if not if_none_match:
+            return None
+        revision = self.get(kind, id)
+        if revision is None:
+            return None
+        etag = revision_etag(kind, id, revision)
+        return etag if etag_matches(if_none_match, etag) else None
@@ -0,0 +1,150 @@
+"""
+Clients and modules created on first use instead of at import.
+
+    redis_client = lazy(make_redis)          # nothing imported or connected yet
+    redis_client.get('key')                  # make_redis() runs here, once
+
+    redis = lazy_import('redis')             # `import redis` on first attribute
+    except redis.RedisError: ...             # (an except clause is only evaluated
+                                             # when an exception reaches it)
+
+A worker that builds every client while importing app.py pays for all of
+them before it serves anything, even for the endpoints that use none (GET
+/metrics, health checks), and doesn't boot at all when a constructor talks
+to a server that is down (KafkaProducer). lazy() defers that to the first
+attribute access, from whichever thread gets there first: the others wait
+for the same object, the factory runs once per process.
+
+The object is a proxy: attributes are forwarded, so code written for the
+client works unchanged. Only attribute access is, though; isinstance(), with
+and operators see the proxy. lazy.resolve(proxy) returns the real object.
+
+A factory that fails isn't retried at every access: its exception is raised
+again for `retry_after` seconds, so requests don't each wait for a broker's
+connect timeout. After that the next access tries again.
+
+Cleanup belongs in the factory (atexit.register(client.close) next to the
+constructor): a client that was never created has nothing to close.
+
+Measure what import costs with startup_profile.py. Run this file for the
+cost of the proxy:
+    python lazy.py
+
+    attribute access, direct              85 ns
+    attribute access, through lazy()     450 ns
+    64 threads, first use at once         1 factory call
+
+Under half a microsecond per call, against a Redis or Kafka round trip.
+"""
+import importlib
+import threading
+import time
+
+__all__ = ['lazy', 'lazy_import', 'resolve']
+
+_UNSET = object()
+_get = object.__getattribute__
+
+
+class _Lazy:
+    # Every attribute read is forwarded, the proxy's own included: its code
+    # reads them with _get. Overriding __getattribute__ rather than
+    # __getattr__ skips the failed lookup (and the AttributeError raised
+    # and caught) that precedes each __getattr__ call: 3x faster.
+    __slots__ = ('_factory', '_retry_after', '_value', '_error', '_traceback', '_failed_at', '_lock')
+
+    def __init__(self, factory, retry_after):
+        self._factory = factory
+        self._retry_after = retry_after
+        self._value = _UNSET
+        self._error = self._traceback = None
+        self._failed_at = 0.0
+        self._lock = threading.Lock()
+
+    def __getattribute__(self, name):
+        value = _get(self, '_value')
+        if value is _UNSET:
+            value = _create(self)
+        return getattr(value, name)
+
+    def __repr__(self):
+        value = _get(self, '_value')
+        if value is _UNSET:
+            factory = _get(self, '_factory')
+            return f'<lazy {getattr(factory, "__qualname__", factory)}, not created>'
+        return f'<lazy {value!r}>'
+
+
+def _create(proxy):
+    with _get(proxy, '_lock'):
+        value = _get(proxy, '_value')
+        if value is not _UNSET:
+            return value  # another thread got there first
+        error = _get(proxy, '_error')
+        if error is not None and time.monotonic() - _get(proxy, '_failed_at') < _get(proxy, '_retry_after'):
+            # The factory's traceback, not one that grows with every access
+            raise error.with_traceback(_get(proxy, '_traceback'))
+        try:
+            value = _get(proxy, '_factory')()
+        except Exception as e:
+            proxy._error, proxy._traceback, proxy._failed_at = e, e.__traceback__, time.monotonic()
+            raise
+        proxy._value = value
+        proxy._error = proxy._traceback = None
+        return value
+
+
+def lazy(factory, retry_after=5.0):
+    """A proxy for factory(), called at the proxy's first attribute access."""
+    return _Lazy(factory, retry_after)
+
+
+def lazy_import(name):
+    """A proxy for module `name`, imported at its first attribute access."""
+    def import_module():
+        return importlib.import_module(name)
+
+    import_module.__qualname__ = f'import {name}'
+    # An import that failed won't work a second later either
+    return _Lazy(import_module, float('inf'))
+
+
+def resolve(proxy):
+    """The object behind a lazy() proxy, creating it if needed."""
+    value = _get(proxy, '_value')
+    return _create(proxy) if value is _UNSET else value
+
+
+if __name__ == '__main__':
+    import timeit
+
+    class Client:
+        def ping(self):
+            return True
+
+    direct, proxied = Client(), lazy(Client)
+    for label, client in (('direct', direct), ('through lazy()', proxied)):
+        runs = 1_000_000
+        seconds = min(timeit.repeat('client.ping', number=runs, repeat=5, globals={'client': client}))
+        print(f'attribute access, {label:<15} {seconds / runs * 1e9:6.0f} ns')
+
+    calls = []
+    barrier = threading.Barrier(64)
+
+    def slow_factory():
+        calls.append(1)
+        time.sleep(0.05)
+        return Client()
+
+    shared = lazy(slow_factory)
+
+    def first_use():
+        barrier.wait()
+        shared.ping()
+
+    threads = [threading.Thread(target=first_use) for _ in range(64)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    print(f'64 threads, first use at once {len(calls):6} factory call{"s" if len(calls) != 1 else ""}')
@@ -0,0 +1,175 @@
+"""
+PostgreSQL connections for app.py: a shared pool, and a cached health probe.
+
+psycopg2.connect() per request is a TCP handshake, a TLS handshake if
+enabled, authentication and a new backend process on the server, every
+time. All handlers now borrow from one ConnectionPool (db_pool.py) per
+process:
+
+    with db.connection() as conn:
+        ...
+
+    max_size=10           per gunicorn worker: 4 workers -> at most 40 of
+                          PostgreSQL's default max_connections=100
+    timeout=2             seconds to wait for a free connection (PoolTimeout)
+    idle_timeout=300      connections unused for 5 minutes are closed
+    health_check_interval=30
+                          a connection idle longer than that is validated
+                          (SELECT 1) before it's handed out
+    reset = rollback      no borrower sees a transaction left open by the last
+
+/db-test is hit by load balancers and Prometheus every few seconds. It no
+longer touches the database: a HealthProbe thread runs SELECT 1 through the
+pool every PROBE_INTERVAL and the endpoint returns its last result (failed
+if older than 3 intervals, i.e. the probe thread itself is stuck).
+
+Exported (multiprocess-safe, see flask_metrics.py):
+
+    db_pool_wait_seconds           histogram, time to get a connection
+                                   (includes connecting when the pool grows)
+    db_pool_timeouts_total         acquires that gave up
+    db_pool_connections_in_use     } summed over workers:
+    db_pool_connections_open       }   utilization = in_use / max
+    db_pool_connections_max        }
+"""
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import psycopg2
+import psycopg2.extensions
+from prometheus_client import Counter, Gauge, Histogram
+
+from db_pool import ConnectionPool, PoolTimeout
+from tracing import TracedCursor
+
+logger = logging.getLogger(__name__)
+
+DSN = dict(dbname='travelapp', user='postgres', password='postgres', host='db')
+CONNECT_TIMEOUT = 3
+POOL_SETTINGS = dict(
+    min_size=0,  # don't fail the app's import when the database is down; the probe opens one
+    max_size=10,
+    timeout=2.0,
+    idle_timeout=300.0,
+    health_check_interval=30.0,
+)
+PROBE_INTERVAL = 5.0
+
+WAIT = Histogram(
+    'db_pool_wait_seconds', 'Time to get a connection from the pool',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 2.5),
+)
+TIMEOUTS = Counter('db_pool_timeouts_total', 'Pool acquires that timed out')
+IN_USE = Gauge('db_pool_connections_in_use', 'Connections lent out', multiprocess_mode='livesum')
+OPEN = Gauge('db_pool_connections_open', 'Connections open (idle + in use)', multiprocess_mode='livesum')
+MAX = Gauge('db_pool_connections_max', 'Pool max_size', multiprocess_mode='livesum')
+
+
+class InstrumentedPool(ConnectionPool):
+    """ConnectionPool that reports wait time and utilization to Prometheus."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        MAX.set(self.max_size)
+        self._report()
+
+    def _report(self):
+        # Read without the pool's lock: a gauge a moment off is fine
+        IN_USE.set(self.in_use)
+        OPEN.set(self.size)
+
+    def acquire(self):
+        start = time.perf_counter()
+        try:
+            conn = super().acquire()
+        except PoolTimeout:
+            TIMEOUTS.inc()
+            raise
+        finally:
+            WAIT.observe(time.perf_counter() - start)
+        self._report()
+        return conn
+
+    def release(self, conn, discard=False):
+        super().release(conn, discard)
+        self._report()
+
+
+class _Cursor(TracedCursor, psycopg2.extensions.cursor):
+    # A span per query inside a traced request (tracing.py)
+    db_system = 'postgresql'
+
+
+def _connect():
+    return psycopg2.connect(connect_timeout=CONNECT_TIMEOUT, cursor_factory=_Cursor, **DSN)
+
+
+def ping(conn):
+    with conn.cursor() as cur:
+        cur.execute('SELECT 1')
+        cur.fetchone()
+    conn.rollback()  # SELECT opened a transaction: don't leave it idle in transaction
+
+
+def _rollback(conn):
+    # Raises on a broken connection, which makes the pool discard it
+    conn.rollback()
+
+
+def create_pool(**settings):
+    return InstrumentedPool(
+        _connect, health_check=ping, reset=_rollback, **{**POOL_SETTINGS, **settings}
+    )
+
+
+ProbeResult = namedtuple('ProbeResult', 'ok latency checked_at error')
+
+
+class HealthProbe:
+    """Checks the database every `interval` seconds on a thread; requests read `result`."""
+
+    def __init__(self, pool, interval=PROBE_INTERVAL, ping=ping):
+        self.pool = pool
+        self.interval = interval
+        self.ping = ping
+        self.result = ProbeResult(False, None, 0.0, 'not checked yet')
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        start = time.perf_counter()
+        try:
+            with self.pool.connection() as conn:
+                self.ping(conn)
+        except Exception as e:
+            result = ProbeResult(False, None, time.time(), f'{type(e).__name__}: {e}'.strip())
+        else:
+            result = ProbeResult(True, time.perf_counter() - start, time.time(), None)
+        # Log changes, not every probe
+        if result.ok and not self.result.ok:
+            logger.info('Database connection successful')
+        elif not result.ok and (self.result.ok or self.result.checked_at == 0.0):
+            logger.error('Database error: %s', result.error)
+        self.result = result  # one attribute assignment: readers never see half an update
+        return result
+
+    def healthy(self):
+        result = self.result
+        return result.ok and time.time() - result.checked_at <= 3 * self.interval
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.check()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='db-probe', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,297 @@
+"""
+Content-addressed photo storage with streaming uploads.
+
+    PUT /trips/{trip_id}/photos/{photo_id}/content      raw image bytes
+
+The body is never held in memory as a whole: chunks from the socket are
+collected into a buffer of at most WRITE_BUFFER bytes, which is hashed
+(SHA-256) and appended to a temporary file on a worker thread. hashlib and
+file writes release the GIL, and the event loop only hands buffers over.
+
+    socket ──chunks──► buffer (1 MiB) ──thread──► sha256.update + tmp.write
+                                                        │ at the end
+                              photos/ab/cd/<sha256> ◄───┘ os.replace (or dedupe)
+
+- Files are named by their hash, so the same photo uploaded twice (a retry,
+  or shared between trips) is stored once: the second temp file is dropped.
+- Thumbnails and EXIF (size, capture time, GPS) are CPU heavy: ~100 ms per
+  12MP JPEG, partly under the GIL. They run in a process pool, so they stall
+  neither the event loop nor the thread pool that serves database queries.
+
+Downloads (GET .../content, Range and If-None-Match aware) go through
+PhotoFileResponse. The ETag is the content hash: a strong validator that
+doesn't change when the file is copied or touched, unlike mtime + size.
+
+Run this file for a benchmark (concurrent upload throughput, peak RSS, and
+event loop stalls with inline vs. process pool thumbnailing):
+    python photo_store.py
+
+    32 concurrent uploads of 8 MiB   throughput   peak RSS
+    buffered (request.body())         361 MiB/s    556 MiB
+    streamed                          462 MiB/s     77 MiB
+
+    16 thumbnails of 12MP JPEGs      photos/s   max event loop stall
+    inline                             10.6           354 ms
+    process pool                        9.0             9 ms
+
+(one CPU: the pool adds no parallelism there, only isolation; with N cores
+thumbnails scale to ~N times the inline rate.)
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+from datetime import datetime
+
+from starlette.responses import FileResponse
+
+WRITE_BUFFER = 2**20
+MAX_PHOTO_BYTES = 50 * 2**20
+THUMBNAIL_SIZE = (320, 320)
+
+EXIF_IFD, GPS_IFD = 0x8769, 0x8825
+DATETIME_ORIGINAL = 36867
+
+
+class PhotoTooLarge(ValueError):
+    pass
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+class PhotoStore:
+    def __init__(self, root):
+        self.root = root
+        self._tmp = os.path.join(root, 'tmp')
+        os.makedirs(self._tmp, exist_ok=True)
+
+    def path(self, content_hash):
+        return os.path.join(self.root, content_hash[:2], content_hash[2:4], content_hash)
+
+    def thumbnail_path(self, content_hash):
+        return self.path(content_hash) + '.thumb.jpg'
+
+    async def save_stream(self, chunks, max_bytes=MAX_PHOTO_BYTES):
+        """Store an async iterable of byte chunks; returns (content_hash, size, is_new)."""
+        loop = asyncio.get_running_loop()
+        hasher = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self._tmp)
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb', buffering=0) as f:
+                def flush(data):
+                    hasher.update(data)
+                    f.write(data)
+
+                buffer = bytearray()
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise PhotoTooLarge(f'Photos are limited to {max_bytes // 2**20} MiB')
+                    buffer += chunk
+                    if len(buffer) >= WRITE_BUFFER:
+                        await loop.run_in_executor(None, flush, bytes(buffer))
+                        buffer.clear()
+                if buffer:
+                    await loop.run_in_executor(None, flush, bytes(buffer))
+            content_hash = hasher.hexdigest()
+            is_new = await loop.run_in_executor(None, self._commit, tmp_path, content_hash)
+            return content_hash, size, is_new
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _commit(self, tmp_path, content_hash):
+        path = self.path(content_hash)
+        if os.path.exists(path):
+            os.unlink(tmp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return True
+
+    def discard(self, content_hash):
+        """Remove a blob (and its thumbnail) that turned out not to be an image."""
+        for path in (self.path(content_hash), self.thumbnail_path(content_hash)):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class PhotoFileResponse(FileResponse):
+    """FileResponse for photos: Range/If-Range support comes from Starlette.
+
+    Servers implementing the ASGI pathsend extension send the file themselves
+    (sendfile, nothing copied through Python). ASGI doesn't give us the socket,
+    so with others (uvicorn) the file is read in chunks; 1 MiB chunks instead
+    of 64 KiB cut the per-chunk overhead of the thread hop and send() call
+    (a 200 MiB file through the ASGI app in-process: 0.7 -> 4.3 GiB/s).
+    """
+    chunk_size = 2**20
+
+
+def content_etag(content_hash, variant=None):
+    return f'"{content_hash}.{variant}"' if variant else f'"{content_hash}"'
+
+
+def _gps_degrees(value, ref, limit):
+    degrees, minutes, seconds = (float(v) for v in value)
+    result = degrees + minutes / 60 + seconds / 3600
+    if not abs(result) <= limit:  # NaN too: the photo index expects real coordinates
+        raise ValueError(f'GPS coordinate out of range: {result}')
+    return -result if ref in ('S', 'W') else result
+
+
+def process_photo(path, thumbnail_path, size=THUMBNAIL_SIZE):
+    """Write a JPEG thumbnail and return the image metadata. Runs in a worker process."""
+    from PIL import Image, ImageOps, UnidentifiedImageError
+
+    try:
+        with Image.open(path) as image:
+            exif = image.getexif()
+            info = {
+                'content_type': Image.MIME.get(image.format, 'application/octet-stream'),
+                'width': image.width,
+                'height': image.height,
+                'taken_at': None,
+                'lat': None,
+                'lon': None,
+            }
+            taken_at = exif.get_ifd(EXIF_IFD).get(DATETIME_ORIGINAL)
+            if taken_at:
+                try:
+                    info['taken_at'] = datetime.strptime(taken_at, '%Y:%m:%d %H:%M:%S').isoformat()
+                except ValueError:
+                    pass
+            gps = exif.get_ifd(GPS_IFD)
+            if 2 in gps and 4 in gps:
+                try:
+                    lat = _gps_degrees(gps[2], gps.get(1), 90)
+                    lon = _gps_degrees(gps[4], gps.get(3), 180)
+                    info['lat'], info['lon'] = lat, lon  # both or neither
+                except (TypeError, ValueError, ZeroDivisionError):
+                    pass
+
+            if not os.path.exists(thumbnail_path):
+                # draft() lets the JPEG decoder downscale while decoding: much faster
+                image.draft('RGB', size)
+                thumbnail = ImageOps.exif_transpose(image).convert('RGB')
+                thumbnail.thumbnail(size)
+                tmp_path = f'{thumbnail_path}.{os.getpid()}.tmp'
+                thumbnail.save(tmp_path, 'JPEG', quality=80)
+                os.replace(tmp_path, thumbnail_path)
+    except Image.DecompressionBombError:
+        # Not an OSError: declared dimensions over Pillow's pixel limit
+        raise InvalidImage('Image dimensions are too large') from None
+    except (UnidentifiedImageError, OSError):
+        raise InvalidImage('Not a supported image file') from None
+    return info
+
+
+# Benchmark
+# 32 clients upload an 8 MiB photo each at the same time, in 64 KiB chunks like
+# a socket delivers them. Buffering the whole body (await request.body()) vs.
+# streaming; each mode runs in its own process so peak RSS is comparable.
+# Then 16 real 12MP JPEGs are thumbnailed inline vs. in a process pool while a
+# ticker measures how long the event loop gets stalled.
+if __name__ == '__main__':
+    import resource
+    import shutil
+    import subprocess
+    import sys
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    CLIENTS, PHOTO_BYTES, CHUNK = 32, 8 * 2**20, 64 * 2**10
+
+    async def client_body(seed):
+        block = os.urandom(CHUNK)
+        for i in range(PHOTO_BYTES // CHUNK):
+            await asyncio.sleep(0)  # the socket hands over one chunk at a time
+            yield block if i else seed + block[len(seed):]
+
+    async def buffered(store, seed):
+        body = b''.join([chunk async for chunk in client_body(seed)])
+
+        async def once():
+            yield body
+        return await store.save_stream(once())
+
+    async def streamed(store, seed):
+        return await store.save_stream(client_body(seed))
+
+    def run_uploads(mode):
+        root = tempfile.mkdtemp()
+        store = PhotoStore(root)
+        upload = buffered if mode == 'buffered' else streamed
+
+        async def main():
+            start = time.perf_counter()
+            results = await asyncio.gather(
+                *(upload(store, str(i).encode()) for i in range(CLIENTS))
+            )
+            return time.perf_counter() - start, results
+
+        elapsed, results = asyncio.run(main())
+        assert len({h for h, _, _ in results}) == CLIENTS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f'{mode:<10}{CLIENTS * PHOTO_BYTES / 2**20 / elapsed:>10.0f} MiB/s{rss:>12.0f} MiB')
+        shutil.rmtree(root)
+
+    if len(sys.argv) > 1:
+        run_uploads(sys.argv[1])
+        sys.exit()
+
+    print(f'{CLIENTS} concurrent uploads of {PHOTO_BYTES // 2**20} MiB')
+    print(f'{"mode":<10}{"throughput":>16}{"peak RSS":>12}')
+    for mode in ('buffered', 'streamed'):
+        subprocess.run([sys.executable, __file__, mode], check=True)
+
+    from PIL import Image
+
+    root = tempfile.mkdtemp()
+    store = PhotoStore(root)
+    sources = []
+    for i in range(16):
+        path = os.path.join(root, f'source{i}.jpg')
+        Image.effect_noise((4000, 3000), 40 + i).convert('RGB').save(path, quality=90)
+        sources.append(path)
+
+    async def thumbnails(executor):
+        loop = asyncio.get_running_loop()
+        stalls = []
+
+        async def ticker():
+            while True:
+                before = loop.time()
+                await asyncio.sleep(0.001)
+                stalls.append(loop.time() - before - 0.001)
+
+        tick = asyncio.ensure_future(ticker())
+        start = time.perf_counter()
+        for i, path in enumerate(sources):
+            thumb = os.path.join(root, f'{executor is None}{i}.thumb.jpg')
+            if executor is None:
+                process_photo(path, thumb)
+                await asyncio.sleep(0)  # a handler would return here, let others run
+            else:
+                await loop.run_in_executor(executor, process_photo, path, thumb)
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.002)
+        tick.cancel()
+        return elapsed, max(stalls)
+
+    async def main():
+        elapsed, stall = await thumbnails(None)
+        print(f'{"thumbnails inline":<26}{len(sources) / elapsed:>8.1f} photos/s, '
+              f'max event loop stall {stall * 1000:.0f} ms')
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            await asyncio.get_running_loop().run_in_executor(executor, os.getpid)  # start workers
+            elapsed, stall = await thumbnails(executor)
+        print(f'{"thumbnails process pool":<26}{len(sources) / elapsed:>8.1f} photos/s, '
+              f'max event loop stall {stall * 1000:.0f} ms')
+
+    asyncio.run(main())
+    shutil.rmtree(root)
@@ -0,0 +1,156 @@
+"""
+How long a fresh worker takes to import the app, and which imports cost it.
+
+    python startup_profile.py app                     # the Flask app (gunicorn workers)
+    python startup_profile.py warmup --top 20         # the FastAPI app
+    python startup_profile.py app --budget 250        # exit status 1 above 250 ms (CI)
+    python startup_profile.py app --json startup.json # the numbers, to track over time
+
+Each run is a new interpreter (`python -c 'import app'`), so nothing is
+cached in sys.modules; the module's own top-level code (creating clients,
+starting threads) counts too, that's part of a worker's boot. The median of
+--runs is reported: the first one also pays for a cold disk cache and
+writing .pyc files. The breakdown comes from one more run with
+-X importtime, which slows imports down a little by itself.
+
+    import app: 217 ms (median of 5: 204 .. 237), interpreter start + exit 107 ms
+      direct imports (one -X importtime run) cumulative
+        flask                             185 ms
+        pg_pool                            20 ms
+        prometheus_client                  16 ms
+        redis_cache                        11 ms
+        ...
+        app (its own code)                  7 ms
+      slowest modules (self time)
+        psycopg2._psycopg                11.5 ms
+        ssl                               6.3 ms
+        ...
+
+The budget is on the median import time. Run it where the app's settings
+work (PROMETHEUS_MULTIPROC_DIR etc., as in the container): the environment
+is passed through. Servers that are down are fine as long as nothing
+connects at import, which is the point (lazy.py).
+
+Measured here, median of 9 runs, before and after the clients in app.py
+became lazy:
+
+    import app    355-370 ms  ->  230-255 ms    (`import redis` was ~80 ms of it)
+    import warmup 610 ms: fastapi ~380 ms, numpy (via trip_locations) ~95 ms
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+# Printed by the child after the import, to stdout, which the app doesn't use
+_CHILD = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print('startup_profile', time.perf_counter() - start, file=sys.__stdout__, flush=True)
+"""
+
+
+def parse_importtime(text):
+    """[(depth, module, self_us, cumulative_us)] from -X importtime output, in its order."""
+    rows = []
+    for line in text.splitlines():
+        match = _LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append(((len(indent) - 1) // 2, name, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def breakdown(rows, module):
+    """Direct imports of `module` and every module it pulled in (slowest first)."""
+    # Children are printed before their parent: walk back from the module's line
+    end = max(i for i, row in enumerate(rows) if row[1] == module and row[0] == 0)
+    depth = rows[end][0]
+    i = end
+    while i > 0 and rows[i - 1][0] > depth:
+        i -= 1
+    pulled = rows[i:end]
+    direct = [row for row in pulled if row[0] == depth + 1]
+    return (
+        rows[end],
+        sorted(direct, key=lambda row: -row[3]),
+        sorted(pulled, key=lambda row: -row[2]),
+    )
+
+
+def run_once(module, importtime=False, python=sys.executable):
+    """(import seconds, process seconds, -X importtime rows) of one new interpreter."""
+    command = [python, '-X', 'importtime'] if importtime else [python]
+    start = time.perf_counter()
+    result = subprocess.run(command + ['-c', _CHILD.format(module=module)], capture_output=True, text=True)
+    total = time.perf_counter() - start
+    marker = [line for line in result.stdout.splitlines() if line.startswith('startup_profile ')]
+    if result.returncode != 0 or not marker:
+        sys.stderr.write(result.stderr[-4000:])
+        raise SystemExit(f'importing {module} failed (exit status {result.returncode})')
+    return float(marker[-1].split()[1]), total, parse_importtime(result.stderr) if importtime else None
+
+
+def profile(module, runs=5):
+    # Timed without -X importtime (writing a line per module slows imports
+    # down), then once more with it for the breakdown
+    timings = sorted(run_once(module)[:2] for _ in range(runs))
+    import_seconds, total = timings[len(timings) // 2]
+    own, direct, pulled = breakdown(run_once(module, importtime=True)[2], module)
+    return {
+        'module': module,
+        'runs': runs,
+        'import_ms': import_seconds * 1e3,
+        'import_ms_min': timings[0][0] * 1e3,
+        'import_ms_max': timings[-1][0] * 1e3,
+        # Process start to exit, minus the import: the interpreter starting,
+        # and shutting down (atexit handlers included)
+        'interpreter_ms': (total - import_seconds) * 1e3,
+        'own_ms': own[2] / 1e3,
+        'direct': [{'module': r[1], 'cumulative_ms': r[3] / 1e3} for r in direct],
+        'slowest': [{'module': r[1], 'self_ms': r[2] / 1e3} for r in pulled],
+    }
+
+
+def report(result, top):
+    print(f"import {result['module']}: {result['import_ms']:.0f} ms "
+          f"(median of {result['runs']}: {result['import_ms_min']:.0f} .. {result['import_ms_max']:.0f}), "
+          f"interpreter start + exit {result['interpreter_ms']:.0f} ms")
+    print(f"  direct imports (one -X importtime run){'cumulative':>11}")
+    for row in result['direct'][:top]:
+        print(f"    {row['module']:<30}{row['cumulative_ms']:>7.0f} ms")
+    print(f"    {result['module'] + ' (its own code)':<30}{result['own_ms']:>7.0f} ms")
+    print('  slowest modules (self time)')
+    for row in result['slowest'][:top]:
+        print(f"    {row['module']:<30}{row['self_ms']:>7.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('module', help='module to import, e.g. app or warmup')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='rows per table')
+    parser.add_argument('--budget', type=float, help='fail (exit status 1) if the median import takes longer, ms')
+    parser.add_argument('--json', metavar='FILE', help='also write the result as JSON')
+    args = parser.parse_args(argv)
+
+    # The module is imported from the current directory, like gunicorn does
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), os.environ.get('PYTHONPATH')]))
+    result = profile(args.module, args.runs)
+    report(result, args.top)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.budget is not None and result['import_ms'] > args.budget:
+        print(f"over budget: {result['import_ms']:.0f} ms > {args.budget:.0f} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
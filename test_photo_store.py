@@ -0,0 +1,51 @@
+import io
+import struct
+import zlib
+
+import pytest
+from PIL import Image
+
+from photo_store import InvalidImage, process_photo
+
+
+def bomb_png(width=100_000, height=100_000):
+    """A tiny PNG whose header declares width x height pixels."""
+    buffer = io.BytesIO()
+    Image.new('RGB', (1, 1)).save(buffer, 'PNG')
+    data = bytearray(buffer.getvalue())
+    # IHDR data starts after the signature (8), length (4) and type (4)
+    data[16:24] = struct.pack('>II', width, height)
+    data[29:33] = struct.pack('>I', zlib.crc32(bytes(data[12:29])))
+    return bytes(data)
+
+
+def test_declared_dimensions_over_the_pixel_limit(tmp_path):
+    path = tmp_path / 'bomb.png'
+    path.write_bytes(bomb_png())
+    with pytest.raises(InvalidImage):
+        process_photo(str(path), str(tmp_path / 'bomb.thumb.jpg'))
+    assert not (tmp_path / 'bomb.thumb.jpg').exists()
+
+
+def test_small_image(tmp_path):
+    path = tmp_path / 'photo.png'
+    Image.new('RGB', (40, 30)).save(path)
+    info = process_photo(str(path), str(tmp_path / 'photo.thumb.jpg'))
+    assert (info['width'], info['height']) == (40, 30)
+
+
+def gps_jpeg(path, lat, lon):
+    exif = Image.Exif()
+    exif.get_ifd(0x8825).update({1: 'N', 2: (lat, 0.0, 0.0), 3: 'E', 4: (lon, 0.0, 0.0)})
+    Image.new('RGB', (40, 30)).save(path, 'JPEG', exif=exif)
+
+
+def test_gps_coordinates_out_of_range_are_dropped(tmp_path):
+    path = tmp_path / 'photo.jpg'
+    gps_jpeg(path, 48.5, 2.25)
+    info = process_photo(str(path), str(tmp_path / 'photo.thumb.jpg'))
+    assert (info['lat'], info['lon']) == (48.5, 2.25)
+
+    gps_jpeg(path, 48.5, 200.0)
+    info = process_photo(str(path), str(tmp_path / 'photo.thumb.jpg'))
+    assert (info['lat'], info['lon']) == (None, None)
@@ -0,0 +1,204 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    # warmup.py keeps its database, tracks and photos in the current directory
+    monkeypatch.chdir(tmp_path)
+    import warmup
+
+    with TestClient(warmup.app) as client:
+        yield client
+
+
+def trip_json(days):
+    start = datetime(2024, 1, 1)
+    return {
+        "user_id": 1, "title": f"{days} days",
+        "start_date": start.isoformat(), "end_date": (start + timedelta(days=days)).isoformat(),
+    }
+
+
+def test_concurrent_updates_keep_stats_exact(client):
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    trip_id = client.post("/trips/", json=trip_json(1)).json()["id"]
+
+    # Every update reads the row the previous one wrote: if two read the same
+    # old row, the running stats subtract it twice and drift
+    barrier = threading.Barrier(16)
+
+    def update(days):
+        barrier.wait()
+        assert client.put(f"/trips/{trip_id}", json=trip_json(days)).status_code == 200
+
+    threads = [threading.Thread(target=update, args=(days,)) for days in range(2, 18)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    running = client.get("/trips/stats/").json()
+    exact = client.get("/trips/stats/", params={"exact": True}).json()
+    assert running["total_trips"] == exact["total_trips"] == 1
+    assert running["avg_duration"] == pytest.approx(exact["avg_duration"])
+
+
+def test_update_missing_trip(client):
+    assert client.put("/trips/999", json=trip_json(1)).status_code == 404
+    # The transaction was rolled back: the next write doesn't find one open
+    assert client.post("/trips/", json=trip_json(1)).status_code == 200
+
+
+def test_location_batch_size_is_capped(client):
+    from trip_locations import MAX_BODY_BYTES
+
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    trip_id = client.post("/trips/", json=trip_json(1)).json()["id"]
+    url = f"/trips/{trip_id}/locations:batch"
+    too_large = b" " * (MAX_BODY_BYTES + 1)
+    # Content-Length given: rejected before reading
+    assert client.post(url, content=too_large).status_code == 413
+
+    # Chunked, no Content-Length: rejected once the bytes read pass the cap
+    def chunks():
+        for start in range(0, len(too_large), 2**20):
+            yield too_large[start:start + 2**20]
+
+    assert client.post(url, content=chunks()).status_code == 413
+
+    ok = client.post(url, json={"timestamp": [int(time.time())], "lat": [48.85], "lon": [2.35]})
+    assert ok.status_code == 200 and ok.json()["inserted"] == 1
+
+
+def test_points_too_old_for_the_rollups_are_rejected(client):
+    from trip_rollups import oldest_accepted
+
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    trip_id = client.post("/trips/", json=trip_json(1)).json()["id"]
+    # Retention would delete its raw point before its hour is rolled up again
+    oldest = oldest_accepted()
+    response = client.post(f"/trips/{trip_id}/locations:batch", json={
+        "timestamp": [oldest - 1, oldest + 60], "lat": [48.85, 48.86], "lon": [2.35, 2.35],
+    })
+    assert response.json() == {"accepted": 1, "inserted": 1, "duplicates": 0, "rejected": 1}
+
+
+def test_simplified_track_hit_does_not_read_the_track(client, monkeypatch):
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    trip_id = client.post("/trips/", json=trip_json(1)).json()["id"]
+    start = int(time.time()) - 3600
+    client.post(f"/trips/{trip_id}/locations:batch", json={
+        "timestamp": [start + 60 * i for i in range(50)],
+        "lat": [48.85 + 0.001 * i for i in range(50)],
+        "lon": [2.35] * 50,
+    })
+    tracks = client.app.state.tracks
+    scans = []
+    scan = tracks.scan
+    monkeypatch.setattr(tracks, "scan", lambda *args, **kwargs: scans.append(1) or scan(*args, **kwargs))
+
+    url = f"/trips/{trip_id}/track/simplified"
+    first = client.get(url, params={"zoom": 12}).json()
+    assert client.get(url, params={"zoom": 12}).json() == first
+    assert first["points"] == 50
+    assert len(scans) == 1
+
+
+def test_stats_without_trailing_slash_is_not_a_trip_id(client):
+    response = client.get("/trips/stats", follow_redirects=False)
+    assert response.status_code == 307
+    assert response.headers["location"].endswith("/trips/stats/")
+    assert client.get("/trips/stats").json()["total_trips"] == 0
+
+
+def test_decompression_bomb_upload_is_rejected_and_discarded(client):
+    from test_photo_store import bomb_png
+
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    trip_id = client.post("/trips/", json=trip_json(1)).json()["id"]
+    photo_id = client.post(
+        f"/trips/{trip_id}/photos/", json={"trip_id": trip_id, "filename": "bomb.png"}
+    ).json()["id"]
+    response = client.put(f"/trips/{trip_id}/photos/{photo_id}/content", content=bomb_png())
+    assert response.status_code == 415
+    store = client.app.state.photos
+    blobs = [name for _, _, names in os.walk(store.root) for name in names]
+    assert blobs == []
+
+
+def test_mixed_naive_and_aware_dates_keep_stats_exact(client):
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    trip = {"user_id": 1, "title": "mixed",
+            "start_date": "2024-01-01T00:00:00", "end_date": "2024-01-03T00:00:00Z"}
+    assert client.post("/trips/", json=trip).status_code == 200
+    trip["end_date"] = "2024-01-03T02:00:00+02:00"
+    assert client.post("/trips/", json=trip).status_code == 200
+
+    running = client.get("/trips/stats/").json()
+    exact = client.get("/trips/stats/", params={"exact": True}).json()
+    assert running["total_trips"] == exact["total_trips"] == 2
+    assert running["avg_duration"] == pytest.approx(exact["avg_duration"]) == pytest.approx(2.0)
+
+    # What the lifespan does at startup
+    from trip_stats import TripStatsEngine
+    import sqlite3
+    conn = sqlite3.connect("travel.db")
+    conn.row_factory = sqlite3.Row
+    engine = TripStatsEngine()
+    engine.load(conn)
+    assert engine.snapshot()["avg_duration"] == pytest.approx(2.0)
+
+
+def test_fast_list_matches_validated_list_on_aware_dates(client):
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    for start, end in (
+        ("2024-01-01T00:00:00Z", "2024-01-03T00:00:00.250000+02:00"),
+        ("2024-01-01T00:00:00", "2024-01-02T00:00:00"),
+    ):
+        trip = {"user_id": 1, "title": "t", "start_date": start, "end_date": end}
+        created = client.post("/trips/", json=trip).json()
+
+    fast = client.get("/trips/")
+    validated = client.get("/trips/", params={"validate": True})
+    assert fast.content == validated.content
+    assert fast.json()[0]["start_date"] == "2024-01-01T00:00:00Z"
+    assert client.get(f"/trips/{created['id']}").json() == fast.json()[-1]
+
+
+def test_user_loader_runs_one_batch_at_a_time():
+    import asyncio
+    from dataloader import DataLoader
+
+    running, most = 0, 0
+
+    async def batch_load(keys):
+        # Like db.run: the connection is busy until the query returns
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return {key: key for key in keys}
+
+    async def page():
+        loader = DataLoader(batch_load)
+        users = await loader.load_many(range(1200))
+        await loader.close()
+        return loader, users
+
+    loader, users = asyncio.run(page())
+    assert users == list(range(1200))
+    assert loader.batches == 3 and most == 1
+
+
+def test_track_every_zero_is_invalid(client):
+    client.post("/users/", json={"email": "a@example.com", "name": "A"})
+    trip_id = client.post("/trips/", json=trip_json(1)).json()["id"]
+    assert client.get(f"/trips/{trip_id}/track", params={"every": 0}).status_code == 422
+    assert client.get(f"/trips/{trip_id}/track", params={"every": 60}).status_code == 200
@@ -0,0 +1,324 @@
+"""
+Per-trip analytics: distance, speeds, moving time and elevation.
+
+    GET /trips/{trip_id}/analytics
+
+All metrics are computed on whole NumPy columns, never point by point:
+
+    hop_m      = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    dt         = diff(timestamp)
+    speed      = hop_m / dt
+    moving     = speed >= MOVING_SPEED and dt <= MAX_GAP
+    climb      = diff(altitude, skipping points without one)
+
+- distance_m counts every hop, gaps included: a flight with the phone off
+  is still travelled distance. moving_s only counts hops of at most MAX_GAP
+  seconds at walking speed or faster.
+- max_speed_mps ignores hops longer than MAX_GAP and hops from/to points
+  less accurate than MAX_ACCURACY, where one bad fix makes up hundreds of km/h.
+- Elevation gain/loss is the sum of raw altitude changes; phone altitude is
+  noisy, so on flat ground this overestimates by a few meters per hour.
+
+The summary of each trip is stored in trip_analytics, together with its
+last point. A batch that continues the trip (every timestamp after that
+point) is folded in without reading the trip again; a batch that goes back
+in time triggers a recompute from trip_locations. Once raw points start
+expiring (trip_rollups.RETENTION), a recompute would lose them, so late
+points then only count from the last one on. The stored summary survives
+retention: a trip keeps its totals after its raw points are gone.
+
+Run this file for a benchmark (a year of 5 minute points, one trip):
+    python trip_analytics.py
+
+    read the trip from SQLite (load_track)    ~175 ms
+    summary, per-point Python loop            ~180 ms
+    summary, vectorized                         ~9 ms
+    record_points, one 12-point batch          0.3 ms
+
+Reading the rows costs more than any summary: that's why the summary is
+stored and continued, rather than recomputed per request.
+"""
+import numpy as np
+
+from trip_rollups import haversine_m, raw_cutoff
+
+MOVING_SPEED = 0.5  # m/s, ~2 km/h: slower than that is GPS jitter around a stop
+MAX_GAP = 900  # seconds; longer hops are gaps in tracking, not movement
+MAX_ACCURACY = 100  # meters
+
+ANALYTICS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trip_analytics (
+    trip_id INTEGER PRIMARY KEY,
+    points INTEGER NOT NULL,
+    first_ts INTEGER NOT NULL,
+    last_ts INTEGER NOT NULL,
+    distance_m REAL NOT NULL,
+    moving_s INTEGER NOT NULL,
+    max_speed_mps REAL NOT NULL,
+    elevation_gain_m REAL NOT NULL,
+    elevation_loss_m REAL NOT NULL,
+    -- The last point, to continue from with the next batch
+    last_lat REAL NOT NULL,
+    last_lon REAL NOT NULL,
+    last_accuracy REAL,
+    last_altitude REAL  -- last point that had an altitude
+);
+"""
+
+_STATE_SQL = 'SELECT * FROM trip_analytics WHERE trip_id = ?'
+_TOTALS = ('points', 'distance_m', 'moving_s', 'elevation_gain_m', 'elevation_loss_m')
+
+
+def ensure_analytics(conn):
+    conn.executescript(ANALYTICS_SCHEMA)
+    conn.commit()
+
+
+def load_track(conn, trip_id):
+    """All stored points of a trip as NumPy columns (NULL -> NaN)."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(
+        'SELECT timestamp, lat, lon, accuracy, altitude FROM trip_locations '
+        'WHERE trip_id = ? ORDER BY timestamp',
+        (trip_id,),
+    ).fetchall()
+    table = np.array(rows, dtype=np.float64).reshape(-1, 5)
+    return {
+        'timestamp': table[:, 0].astype(np.int64),
+        'lat': table[:, 1],
+        'lon': table[:, 2],
+        'accuracy': table[:, 3],
+        'altitude': table[:, 4],
+    }
+
+
+def _nan(value):
+    return np.nan if value is None else value
+
+
+def _none(value):
+    return None if value != value else float(value)
+
+
+def summarize(columns, state=None):
+    """Fold time-ordered points into a summary; state is the summary of earlier points."""
+    n = len(columns['timestamp'])
+    if n == 0:
+        return state
+    ts = np.asarray(columns['timestamp'], dtype=np.int64)
+    lat = np.asarray(columns['lat'], dtype=np.float64)
+    lon = np.asarray(columns['lon'], dtype=np.float64)
+    accuracy = np.asarray(columns['accuracy'], dtype=np.float64)
+    altitude = np.asarray(columns['altitude'], dtype=np.float64)
+    if state is not None:
+        # Continue from the previous last point: its hop to the first new point counts now
+        ts = np.concatenate(([state['last_ts']], ts))
+        lat = np.concatenate(([state['last_lat']], lat))
+        lon = np.concatenate(([state['last_lon']], lon))
+        accuracy = np.concatenate(([_nan(state['last_accuracy'])], accuracy))
+        altitude = np.concatenate(([_nan(state['last_altitude'])], altitude))
+
+    dt = np.diff(ts)  # > 0: timestamps are unique per trip
+    hop = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    speed = hop / dt
+    connected = dt <= MAX_GAP
+    moving = connected & (speed >= MOVING_SPEED)
+    precise = ~(accuracy > MAX_ACCURACY)  # unknown accuracy (NaN) is trusted
+    trusted = connected & precise[:-1] & precise[1:]
+    known = altitude[~np.isnan(altitude)]
+    climb = np.diff(known)
+
+    totals = {name: state[name] for name in _TOTALS} if state else dict.fromkeys(_TOTALS, 0)
+    return {
+        'points': totals['points'] + n,
+        'first_ts': state['first_ts'] if state else int(ts[0]),
+        'last_ts': int(ts[-1]),
+        'distance_m': totals['distance_m'] + float(hop.sum()),
+        'moving_s': totals['moving_s'] + int(dt[moving].sum()),
+        'max_speed_mps': max(state['max_speed_mps'] if state else 0.0,
+                             float(speed[trusted].max(initial=0.0))),
+        'elevation_gain_m': totals['elevation_gain_m'] + float(climb[climb > 0].sum()),
+        'elevation_loss_m': totals['elevation_loss_m'] - float(climb[climb < 0].sum()),
+        'last_lat': float(lat[-1]),
+        'last_lon': float(lon[-1]),
+        'last_accuracy': _none(accuracy[-1]),
+        'last_altitude': float(known[-1]) if len(known) else (state or {}).get('last_altitude'),
+    }
+
+
+def _store(conn, trip_id, state):
+    names = ', '.join(state)
+    conn.execute(
+        f'INSERT OR REPLACE INTO trip_analytics (trip_id, {names}) '
+        f'VALUES (?, {", ".join("?" * len(state))})',
+        (trip_id, *state.values()),
+    )
+
+
+def _load_state(conn, trip_id):
+    row = conn.execute(_STATE_SQL, (trip_id,)).fetchone()
+    if row is None:
+        return None
+    return {name: row[name] for name in row.keys() if name != 'trip_id'}
+
+
+def record_points(conn, trip_id, columns, now=None):
+    """Update a trip's summary after insert_batch() stored `columns` (time-ordered)."""
+    if len(columns['timestamp']) == 0:
+        return
+    # IMMEDIATE: two batches of the same trip must not both read the old summary
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        state = _load_state(conn, trip_id)
+        if state is None:
+            state = summarize(load_track(conn, trip_id))
+        elif columns['timestamp'][0] > state['last_ts']:
+            state = summarize(columns, state)
+        elif state['first_ts'] >= raw_cutoff(now):
+            state = summarize(load_track(conn, trip_id))  # late points, history complete
+        else:
+            newer = columns['timestamp'] > state['last_ts']
+            state = summarize({name: values[newer] for name, values in columns.items()}, state)
+        if state is not None:
+            _store(conn, trip_id, state)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def get_analytics(conn, trip_id):
+    """The trip's summary, computed and stored on first use; None if it has no points."""
+    state = _load_state(conn, trip_id)
+    if state is None:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            state = _load_state(conn, trip_id)  # another request may have been first
+            if state is None:
+                state = summarize(load_track(conn, trip_id))
+                if state is not None:
+                    _store(conn, trip_id, state)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+    return state
+
+
+def summary_json(state):
+    """The public part of a summary, with derived averages."""
+    if state is None:
+        return {
+            'points': 0, 'start': None, 'end': None, 'duration_s': 0, 'distance_m': 0.0,
+            'moving_time_s': 0, 'max_speed_mps': 0.0, 'avg_moving_speed_mps': None,
+            'elevation_gain_m': 0.0, 'elevation_loss_m': 0.0,
+        }
+    moving = state['moving_s']
+    return {
+        'points': state['points'],
+        'start': state['first_ts'],
+        'end': state['last_ts'],
+        'duration_s': state['last_ts'] - state['first_ts'],
+        'distance_m': round(state['distance_m'], 1),
+        'moving_time_s': moving,
+        'max_speed_mps': round(state['max_speed_mps'], 2),
+        # Distance over moving time; the distance includes gaps, so this is an
+        # overestimate for trips with long tracking gaps
+        'avg_moving_speed_mps': round(state['distance_m'] / moving, 2) if moving else None,
+        'elevation_gain_m': round(state['elevation_gain_m'], 1),
+        'elevation_loss_m': round(state['elevation_loss_m'], 1),
+    }
+
+
+# Benchmark
+# One trip, a year of points at 5 minute cadence (~105k), with altitude and
+# accuracy: a per-point Python loop (what iterating over rows would do), the
+# vectorized summary, and folding in one hour-long batch.
+if __name__ == '__main__':
+    import math
+    import sqlite3
+    import time
+
+    from trip_locations import ensure_locations, insert_batch
+
+    def loop_summary(rows):
+        distance = moving = max_speed = gain = loss = 0.0
+        prev = prev_alt = None
+        for ts, lat, lon, accuracy, altitude in rows:
+            if prev is not None:
+                p_ts, p_lat, p_lon, p_acc = prev
+                phi1, phi2 = math.radians(p_lat), math.radians(lat)
+                h = (math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2)
+                     * math.sin(math.radians(lon - p_lon) / 2) ** 2)
+                hop = 2 * 6_371_008.8 * math.asin(min(1.0, math.sqrt(h)))
+                dt = ts - p_ts
+                distance += hop
+                if dt <= MAX_GAP:
+                    if hop / dt >= MOVING_SPEED:
+                        moving += dt
+                    if (p_acc is None or p_acc <= MAX_ACCURACY) and (accuracy is None or accuracy <= MAX_ACCURACY):
+                        max_speed = max(max_speed, hop / dt)
+            if altitude is not None:
+                if prev_alt is not None:
+                    gain += max(altitude - prev_alt, 0)
+                    loss += max(prev_alt - altitude, 0)
+                prev_alt = altitude
+            prev = (ts, lat, lon, accuracy)
+        return distance, moving, max_speed, gain, loss
+
+    rng = np.random.default_rng(7)
+    n = 365 * 288
+    ts = 1_700_000_000 + np.arange(n, dtype=np.int64) * 300
+    ts[n // 2:] += 3600  # a tracking gap
+    track = {
+        'timestamp': ts,
+        'lat': 45 + np.cumsum(rng.normal(0, 2e-3, n)),
+        'lon': 7 + np.cumsum(rng.normal(0, 2e-3, n)),
+        'accuracy': np.where(rng.random(n) < 0.01, 500.0, rng.uniform(3, 30, n)),
+        'altitude': np.where(rng.random(n) < 0.1, np.nan, 800 + np.cumsum(rng.normal(0, 3, n))),
+    }
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    ensure_locations(conn)
+    ensure_analytics(conn)
+    last = n - 12
+    insert_batch(conn, 1, {name: values[:last] for name, values in track.items()})
+
+    def best_of(fn, repeat=3):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+        return best * 1000, result
+
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(
+        'SELECT timestamp, lat, lon, accuracy, altitude FROM trip_locations '
+        'WHERE trip_id = 1 ORDER BY timestamp'
+    ).fetchall()
+    loop_ms, expected = best_of(lambda: loop_summary(rows), repeat=1)
+    read_ms, columns = best_of(lambda: load_track(conn, 1))
+    compute_ms, state = best_of(lambda: summarize(columns))
+    got = tuple(state[name] for name in (
+        'distance_m', 'moving_s', 'max_speed_mps', 'elevation_gain_m', 'elevation_loss_m'))
+    assert np.allclose(got, expected), (got, expected)
+
+    _store(conn, 1, state)
+    conn.commit()
+    batch = {name: values[last:] for name, values in track.items()}
+    insert_batch(conn, 1, batch)
+    start = time.perf_counter()
+    record_points(conn, 1, batch, now=int(ts[-1]))
+    incremental_ms = (time.perf_counter() - start) * 1000
+    whole = summarize(load_track(conn, 1))
+    folded = _load_state(conn, 1)
+    assert all(math.isclose(folded[k], whole[k], rel_tol=1e-9) for k in _TOTALS), (folded, whole)
+
+    print(f'{n:,} points, one trip')
+    print(f'{"read the trip from SQLite (load_track)":<44}{read_ms:>8.0f} ms')
+    print(f'{"summary, per-point Python loop":<44}{loop_ms:>8.0f} ms')
+    print(f'{"summary, vectorized":<44}{compute_ms:>8.0f} ms')
+    print(f'{"record_points, one 12-point batch":<44}{incremental_ms:>8.1f} ms')
@@ -0,0 +1,272 @@
+"""
+In-process spatial index for photos and trip positions.
+
+The Postgres schema has GiST indexes on photos/trip_locations coordinates;
+the SQLite app has nothing, so "photos in this map view" or "photos near me"
+would scan every row. We keep a uniform lat/lon grid in memory instead:
+
+    cell (ix, iy) = (floor((lon + 180) / size), floor((lat + 90) / size))
+    cells: {(ix, iy): {id: (lat, lon, value)}}     only non-empty cells exist
+
+- within(bbox): visit the cells overlapping the box, then filter the points
+  in them exactly. Boxes crossing the antimeridian (min_lon > max_lon) are
+  split in two. For huge boxes we walk the non-empty cells instead, so a
+  "whole world" query costs O(occupied cells), not O(cells on earth).
+- nearby(lat, lon, k): search rings of cells around the query point, keep
+  the k closest (haversine) in a heap, and stop as soon as nothing outside
+  the visited rings can be closer than the current k-th result.
+- insert/remove are O(1) dict operations, so the index is maintained as
+  uploads arrive; it is loaded from the database at startup.
+
+A grid was chosen over an R-tree: updates don't need rebalancing and the
+code is short. The price is a fixed resolution: with very dense hot spots a
+cell holds many points, so pick `cell_degrees` for the densest area
+(0.01 deg is ~1.1 km).
+
+Run this file for a benchmark on 1M points (grid vs. full scan):
+    python trip_geo.py
+
+    query                            full scan      grid     hits
+    bbox city center 2x2 km            50 ms      0.13 ms     379
+    bbox city 20x20 km                 50 ms       17 ms   14,267
+    bbox empty ocean 100x100 km        63 ms      2.4 ms        1
+    10 nearest, in a city            1569 ms      1.5 ms       10
+    10 nearest, middle of nowhere    1850 ms       44 ms       10
+
+Inserts run at ~120k points/s, so loading 1M photos at startup takes ~8 s.
+"""
+import heapq
+import math
+import threading
+
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance in meters."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    h = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(h)))
+
+
+def parse_bbox(text):
+    """'min_lon,min_lat,max_lon,max_lat' (GeoJSON order) -> floats; raises ValueError."""
+    parts = text.split(',')
+    if len(parts) != 4:
+        raise ValueError('bbox must be min_lon,min_lat,max_lon,max_lat')
+    min_lon, min_lat, max_lon, max_lat = map(float, parts)
+    if not (-180 <= min_lon <= 180 and -180 <= max_lon <= 180):
+        raise ValueError('bbox longitudes must be between -180 and 180')
+    if not -90 <= min_lat <= max_lat <= 90:
+        raise ValueError('bbox latitudes must be between -90 and 90, min <= max')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+class GridIndex:
+    """Points (id -> lat, lon, value) bucketed in a uniform lat/lon grid."""
+
+    def __init__(self, cell_degrees=0.01):
+        self.cell_degrees = cell_degrees
+        self._lon_cells = math.ceil(360 / cell_degrees)
+        self._lat_cells = math.ceil(180 / cell_degrees)
+        self._cells = {}  # (ix, iy) -> {id: (lat, lon, value)}
+        self._keys = {}  # id -> (ix, iy), to find a point's cell on remove
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _ix(self, lon):
+        return int((lon + 180) // self.cell_degrees) % self._lon_cells
+
+    def _iy(self, lat):
+        return min(int((lat + 90) // self.cell_degrees), self._lat_cells - 1)
+
+    def insert(self, id, lat, lon, value=None):
+        """Add a point, or move it if the id is already indexed."""
+        key = (self._ix(lon), self._iy(lat))
+        with self._lock:
+            old = self._keys.get(id)
+            if old is not None and old != key:
+                self._discard(id, old)
+            self._cells.setdefault(key, {})[id] = (lat, lon, value)
+            self._keys[id] = key
+
+    def remove(self, id):
+        with self._lock:
+            key = self._keys.get(id)
+            if key is not None:
+                self._discard(id, key)
+
+    def _discard(self, id, key):
+        cell = self._cells[key]
+        del cell[id]
+        if not cell:
+            del self._cells[key]
+        del self._keys[id]
+
+    def get(self, id):
+        """(lat, lon, value) of an indexed point, or None."""
+        with self._lock:
+            key = self._keys.get(id)
+            return None if key is None else self._cells[key][id]
+
+    def within(self, min_lon, min_lat, max_lon, max_lat, limit=None):
+        """Points inside the box as [(id, lat, lon, value)]; min_lon > max_lon crosses 180."""
+        if min_lon <= max_lon:
+            lon_ranges = [(min_lon, max_lon)]
+        else:
+            lon_ranges = [(min_lon, 180.0), (-180.0, max_lon)]
+        results = []
+        with self._lock:
+            for lo, hi in lon_ranges:
+                for cell in self._cells_in(lo, min_lat, hi, max_lat):
+                    for id, (lat, lon, value) in cell.items():
+                        if min_lat <= lat <= max_lat and lo <= lon <= hi:
+                            results.append((id, lat, lon, value))
+                            if limit is not None and len(results) >= limit:
+                                return results
+        return results
+
+    def _cells_in(self, min_lon, min_lat, max_lon, max_lat):
+        x0, x1 = int((min_lon + 180) // self.cell_degrees), int((max_lon + 180) // self.cell_degrees)
+        y0, y1 = self._iy(min_lat), self._iy(max_lat)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self._cells):
+            # Mostly empty box: cheaper to walk the non-empty cells
+            return [
+                cell for (ix, iy), cell in self._cells.items()
+                if y0 <= iy <= y1 and x0 <= ix <= x1
+            ]
+        cells = []
+        for ix in range(x0, x1 + 1):
+            for iy in range(y0, y1 + 1):
+                cell = self._cells.get((ix % self._lon_cells, iy))
+                if cell:
+                    cells.append(cell)
+        return cells
+
+    def nearby(self, lat, lon, k=10, max_distance=None):
+        """The k closest points as [(distance_m, id, lat, lon, value)], closest first."""
+        cx, cy = self._ix(lon), self._iy(lat)
+        cell_rad = math.radians(self.cell_degrees)
+        best = []  # max-heap on distance: (-distance, id, lat, lon, value)
+        visited = set()
+
+        def consider(cell):
+            for id, (plat, plon, value) in cell.items():
+                distance = haversine(lat, lon, plat, plon)
+                if max_distance is not None and distance > max_distance:
+                    continue
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, id, plat, plon, value))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, id, plat, plon, value))
+
+        with self._lock:
+            r = 0
+            while True:
+                ring = self._ring(cx, cy, r)
+                if len(ring) > len(self._cells) or 2 * r + 1 >= self._lon_cells:
+                    # The rings got bigger than the data: finish with the non-empty cells
+                    for key, cell in self._cells.items():
+                        if key not in visited:
+                            consider(cell)
+                    break
+                for key in ring:
+                    cell = self._cells.get(key)
+                    if cell:
+                        visited.add(key)
+                        consider(cell)
+                # Anything not visited yet is more than r cells away in lat or lon.
+                # hav(d) >= hav(dlat) and hav(d) >= cos^2(lat_max) * hav(dlon), so:
+                lat_bound = EARTH_RADIUS_M * r * cell_rad
+                lat_max = min(math.pi / 2, abs(math.radians(lat)) + (r + 1) * cell_rad)
+                lon_bound = 2 * EARTH_RADIUS_M * math.asin(
+                    math.cos(lat_max) * math.sin(min(math.pi, r * cell_rad) / 2)
+                )
+                bound = min(lat_bound, lon_bound)
+                if len(best) == k and -best[0][0] <= bound:
+                    break
+                if max_distance is not None and bound > max_distance:
+                    break
+                r += 1
+        return sorted((-d, id, plat, plon, value) for d, id, plat, plon, value in best)
+
+    def _ring(self, cx, cy, r):
+        """Keys of the cells exactly r cells away (Chebyshev) from (cx, cy)."""
+        if r == 0:
+            return [(cx, cy)]
+        keys = []
+        for dx in range(-r, r + 1):
+            for dy in (-r, r):
+                keys.append((cx + dx, cy + dy))
+        for dy in range(-r + 1, r):
+            for dx in (-r, r):
+                keys.append((cx + dx, cy + dy))
+        return [
+            (x % self._lon_cells, y) for x, y in keys if 0 <= y < self._lat_cells
+        ]
+
+
+# Benchmark
+# 1M photos: 80% around 50 cities, 20% anywhere. Map-view boxes and
+# "10 nearest" queries against the grid and against a full scan.
+if __name__ == '__main__':
+    import random
+    import time
+
+    POINTS = 1_000_000
+    rng = random.Random(5)
+    cities = [(rng.uniform(-60, 70), rng.uniform(-180, 180)) for _ in range(50)]
+
+    def random_point():
+        if rng.random() < 0.8:
+            lat, lon = rng.choice(cities)
+            return (max(-90, min(90, lat + rng.gauss(0, 0.05))),
+                    (lon + rng.gauss(0, 0.05) + 180) % 360 - 180)
+        return rng.uniform(-90, 90), rng.uniform(-180, 180)
+
+    points = [random_point() for _ in range(POINTS)]
+    index = GridIndex()
+    start = time.perf_counter()
+    for i, (lat, lon) in enumerate(points):
+        index.insert(i, lat, lon)
+    elapsed = time.perf_counter() - start
+    print(f'{POINTS:,} points, {len(index._cells):,} non-empty cells, '
+          f'insert {POINTS / elapsed:,.0f}/s')
+
+    def timed(fn, repeat=20):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            result = fn()
+        return (time.perf_counter() - start) / repeat, result
+
+    def scan_within(min_lon, min_lat, max_lon, max_lat):
+        return [i for i, (lat, lon) in enumerate(points)
+                if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon]
+
+    def scan_nearby(lat, lon, k):
+        return heapq.nsmallest(k, ((haversine(lat, lon, plat, plon), i)
+                                   for i, (plat, plon) in enumerate(points)))
+
+    lat, lon = cities[0]
+    print(f'{"query":<38}{"full scan":>12}{"grid":>12}{"hits":>8}')
+    for label, box in (
+        ('bbox city center 2x2 km', (lon - 0.01, lat - 0.01, lon + 0.01, lat + 0.01)),
+        ('bbox city 20x20 km', (lon - 0.1, lat - 0.1, lon + 0.1, lat + 0.1)),
+        ('bbox empty ocean 100x100 km', (-140.5, -40.5, -139.5, -39.5)),
+    ):
+        scan_time, expected = timed(lambda: scan_within(*box), repeat=1)
+        grid_time, found = timed(lambda: index.within(*box))
+        assert sorted(r[0] for r in found) == sorted(expected)
+        print(f'{label:<38}{scan_time * 1000:>9.1f} ms{grid_time * 1000:>9.2f} ms{len(found):>8}')
+
+    for label, (qlat, qlon) in (
+        ('10 nearest, in a city', (lat, lon)),
+        ('10 nearest, middle of nowhere', (-40.0, -140.0)),
+    ):
+        scan_time, expected = timed(lambda: scan_nearby(qlat, qlon, 10), repeat=1)
+        grid_time, found = timed(lambda: index.nearby(qlat, qlon, 10))
+        assert [r[1] for r in found] == [i for _, i in expected]
+        print(f'{label:<38}{scan_time * 1000:>9.1f} ms{grid_time * 1000:>9.2f} ms{len(found):>8}')
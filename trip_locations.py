@@ -0,0 +1,306 @@
+"""
+Bulk GPS point ingestion for trip_locations.
+
+Millions of travellers send a location every 5 minutes, and offline phones
+upload hours of points at once when they get signal again. One HTTP request
++ one INSERT + one commit per point doesn't survive that, so clients send
+batches:
+
+    POST /trips/{trip_id}/locations:batch
+    Content-Encoding: gzip                      (optional, also deflate)
+    {"timestamp": [1688292000, 1688292300, ...],   unix seconds
+     "lat":       [48.8566, 48.8570, ...],
+     "lon":       [2.3522, 2.3530, ...],
+     "accuracy":  [10.5, null, ...],                optional, meters
+     "altitude":  [35.0, 36.0, ...]}                optional, meters
+
+- Columnar arrays compress much better than a list of objects (the keys
+  aren't repeated, neighbouring values look alike).
+- Validation is vectorized with NumPy: one pass over whole columns instead
+  of a Python loop per point. Invalid points are rejected, the rest is kept.
+- Inserts use one multi-row `INSERT ... VALUES (...), (...), ...` per chunk,
+  all chunks in one transaction.
+- Idempotent: UNIQUE(trip_id, timestamp) + ON CONFLICT DO NOTHING, so a client
+  that retries a batch (it never got our response) doesn't create duplicates.
+
+Run this file for a load benchmark in points/second:
+    python trip_locations.py
+"""
+import json
+import time
+import zlib
+from itertools import chain, islice, repeat
+
+import numpy as np
+
+LOCATIONS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trip_locations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    trip_id INTEGER NOT NULL REFERENCES trips(id),
+    lat REAL NOT NULL,
+    lon REAL NOT NULL,
+    timestamp INTEGER NOT NULL,  -- unix seconds
+    accuracy REAL,
+    altitude REAL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE UNIQUE INDEX IF NOT EXISTS idx_trip_locations_trip_ts ON trip_locations(trip_id, timestamp);
+"""
+
+MAX_BATCH_POINTS = 50_000
+MAX_DECODED_BYTES = 32 * 2**20  # protects against gzip bombs
+MAX_BODY_BYTES = MAX_DECODED_BYTES  # as sent, compressed or not
+MIN_TIMESTAMP = 946684800  # 2000-01-01, anything older is a broken clock
+MAX_CLOCK_SKEW = 24 * 3600  # allow phones whose clock runs a bit ahead
+
+# SQLite allows 32766 bound parameters per statement, 6 per row
+COLUMNS = ('trip_id', 'timestamp', 'lat', 'lon', 'accuracy', 'altitude')
+CHUNK_ROWS = 5000
+
+
+class InvalidBatch(ValueError):
+    """The batch as a whole can't be decoded (bad encoding, JSON, shapes)."""
+
+
+class BatchTooLarge(InvalidBatch):
+    """The request body is over MAX_BODY_BYTES."""
+
+
+def ensure_locations(conn):
+    conn.executescript(LOCATIONS_SCHEMA)
+    conn.commit()
+
+
+async def read_body(chunks, max_bytes=MAX_BODY_BYTES):
+    """Read an async iterable of byte chunks, giving up as soon as it passes max_bytes."""
+    body = bytearray()
+    async for chunk in chunks:
+        body += chunk
+        if len(body) > max_bytes:
+            raise BatchTooLarge(f'Batches are limited to {max_bytes // 2**20} MiB')
+    return bytes(body)
+
+
+def decode_body(body, content_encoding=None):
+    """Decompress and parse the request body into a dict of lists."""
+    encoding = (content_encoding or 'identity').lower()
+    try:
+        if encoding == 'gzip':
+            decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            decoder = zlib.decompressobj()
+        elif encoding == 'identity':
+            decoder = None
+        else:
+            raise InvalidBatch(f'Unsupported Content-Encoding: {content_encoding}')
+        if decoder is not None:
+            body = decoder.decompress(body, MAX_DECODED_BYTES)
+            if decoder.unconsumed_tail:
+                raise InvalidBatch('Decoded batch is too large')
+        payload = json.loads(body)
+    except (zlib.error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise InvalidBatch(f'Malformed batch: {e}') from e
+    if not isinstance(payload, dict):
+        raise InvalidBatch('Batch must be a JSON object of columns')
+    return payload
+
+
+def _column(payload, name, n, required):
+    values = payload.get(name)
+    if values is None:
+        if required:
+            raise InvalidBatch(f'Missing column: {name}')
+        return np.full(n, np.nan)
+    if not isinstance(values, list) or len(values) != n:
+        raise InvalidBatch(f'Column {name} must be a list of {n} values')
+    try:
+        # null -> NaN, so missing values flow through the vectorized checks
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError) as e:
+        raise InvalidBatch(f'Column {name} must be numeric') from e
+
+
+def validate_batch(payload, now=None, oldest=MIN_TIMESTAMP):
+    """Vectorized validation. Returns (columns, rejected) with valid, deduplicated points.
+
+    Rejects points with a missing/out of range coordinate, a timestamp outside
+    [oldest (default 2000-01-01), now + skew] or a negative accuracy. Within
+    the batch the first point per timestamp wins.
+    """
+    ts_values = payload.get('timestamp')
+    if not isinstance(ts_values, list):
+        raise InvalidBatch('Missing column: timestamp')
+    n = len(ts_values)
+    if n > MAX_BATCH_POINTS:
+        raise InvalidBatch(f'At most {MAX_BATCH_POINTS} points per batch')
+
+    ts = _column(payload, 'timestamp', n, required=True)
+    lat = _column(payload, 'lat', n, required=True)
+    lon = _column(payload, 'lon', n, required=True)
+    accuracy = _column(payload, 'accuracy', n, required=False)
+    altitude = _column(payload, 'altitude', n, required=False)
+
+    now = time.time() if now is None else now
+    with np.errstate(invalid='ignore'):  # comparisons with NaN are just False
+        valid = (
+            np.isfinite(ts) & (ts >= oldest) & (ts <= now + MAX_CLOCK_SKEW)
+            & np.isfinite(lat) & (np.abs(lat) <= 90)
+            & np.isfinite(lon) & (np.abs(lon) <= 180)
+            & ~(accuracy < 0)
+            & ~np.isinf(altitude)
+        )
+    ts = ts[valid].astype(np.int64)
+    # Duplicate timestamps inside the batch: keep the first one (and sort by time)
+    ts, first = np.unique(ts, return_index=True)
+    columns = {
+        'timestamp': ts,
+        'lat': lat[valid][first],
+        'lon': lon[valid][first],
+        'accuracy': accuracy[valid][first],
+        'altitude': altitude[valid][first],
+    }
+    return columns, n - len(ts)
+
+
+def _build_insert_sql(rows):
+    placeholders = '(' + ', '.join('?' * len(COLUMNS)) + ')'
+    return (
+        f"INSERT INTO trip_locations ({', '.join(COLUMNS)}) VALUES "
+        + ', '.join(repeat(placeholders, rows))
+        + ' ON CONFLICT(trip_id, timestamp) DO NOTHING'
+    )
+
+
+# Only the full chunk's statement is kept: caching one per remainder length
+# could hold CHUNK_ROWS strings of up to ~100 KB each
+_FULL_CHUNK_SQL = _build_insert_sql(CHUNK_ROWS)
+
+
+def _insert_sql(rows):
+    return _FULL_CHUNK_SQL if rows == CHUNK_ROWS else _build_insert_sql(rows)
+
+
+def insert_batch(conn, trip_id, columns):
+    """Insert validated points in one transaction; returns the number of new rows."""
+    n = len(columns['timestamp'])
+    # tolist() converts whole columns to Python numbers at C speed.
+    # NaN accuracy/altitude end up as NULL: SQLite stores NaN as NULL.
+    rows = zip(
+        repeat(trip_id, n),
+        columns['timestamp'].tolist(),
+        columns['lat'].tolist(),
+        columns['lon'].tolist(),
+        columns['accuracy'].tolist(),
+        columns['altitude'].tolist(),
+    )
+    before = conn.total_changes
+    try:
+        while chunk := list(islice(rows, CHUNK_ROWS)):
+            conn.execute(_insert_sql(len(chunk)), list(chain.from_iterable(chunk)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return conn.total_changes - before
+
+
+def columns_to_json(columns):
+    """NumPy columns -> JSON-ready lists, with NaN (missing) as null."""
+    return {
+        name: [None if v != v else v for v in np.asarray(values).tolist()]
+        for name, values in columns.items()
+    }
+
+
+# Benchmark
+# Ingest 1M points (5 minute cadence, 200 trips) three ways: one INSERT +
+# commit per point (the naive API), executemany, and the batch path above
+# (gzip decode + vectorized validation + multi-row inserts).
+if __name__ == '__main__':
+    import gzip
+    import os
+    import sqlite3
+    import tempfile
+
+    TRIPS, POINTS_PER_TRIP, BATCH = 200, 5000, 5000
+    rng = np.random.default_rng(7)
+
+    def make_batch(trip, offset):
+        ts = 1688292000 + (offset + np.arange(BATCH)) * 300
+        lat = 48.85 + np.cumsum(rng.normal(0, 1e-3, BATCH))
+        lon = 2.35 + np.cumsum(rng.normal(0, 1e-3, BATCH))
+        payload = {
+            'timestamp': ts.tolist(),
+            'lat': np.round(lat, 6).tolist(),
+            'lon': np.round(lon, 6).tolist(),
+            'accuracy': np.round(rng.uniform(3, 30, BATCH), 1).tolist(),
+            'altitude': np.round(30 + np.cumsum(rng.normal(0, 0.5, BATCH)), 1).tolist(),
+        }
+        return gzip.compress(json.dumps(payload).encode())
+
+    bodies = [
+        (trip, make_batch(trip, offset))
+        for trip in range(1, TRIPS + 1)
+        for offset in range(0, POINTS_PER_TRIP, BATCH)
+    ]
+    total = TRIPS * POINTS_PER_TRIP
+    raw = sum(len(json.dumps(decode_body(b, 'gzip'))) for _, b in bodies[:10])
+    gz = sum(len(b) for _, b in bodies[:10])
+    print(f'{total:,} points, payload JSON {raw / 10 / BATCH:.1f} B/point, gzip {gz / 10 / BATCH:.1f} B/point')
+
+    def fresh_db():
+        path = os.path.join(tempfile.mkdtemp(), 'ingest.db')
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        ensure_locations(conn)
+        return conn
+
+    decoded = [(trip, validate_batch(decode_body(body, 'gzip'))[0]) for trip, body in bodies]
+
+    # Naive: a row per INSERT, a commit per point; only on a sample, it's slow
+    conn = fresh_db()
+    sample = 20_000
+    start = time.perf_counter()
+    done = 0
+    for trip, columns in decoded:
+        for i in range(len(columns['timestamp'])):
+            conn.execute(
+                'INSERT INTO trip_locations (trip_id, timestamp, lat, lon, accuracy, altitude) '
+                'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(trip_id, timestamp) DO NOTHING',
+                (trip, int(columns['timestamp'][i]), float(columns['lat'][i]),
+                 float(columns['lon'][i]), float(columns['accuracy'][i]), float(columns['altitude'][i])),
+            )
+            conn.commit()
+            done += 1
+            if done == sample:
+                break
+        if done == sample:
+            break
+    print(f'{"per-point insert + commit":<34}{sample / (time.perf_counter() - start):>12,.0f} points/s')
+
+    conn = fresh_db()
+    start = time.perf_counter()
+    for trip, columns in decoded:
+        conn.executemany(
+            'INSERT INTO trip_locations (trip_id, timestamp, lat, lon, accuracy, altitude) '
+            'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(trip_id, timestamp) DO NOTHING',
+            zip(repeat(trip), columns['timestamp'].tolist(), columns['lat'].tolist(),
+                columns['lon'].tolist(), columns['accuracy'].tolist(), columns['altitude'].tolist()),
+        )
+        conn.commit()
+    print(f'{"executemany per batch":<34}{total / (time.perf_counter() - start):>12,.0f} points/s')
+
+    conn = fresh_db()
+    start = time.perf_counter()
+    inserted = 0
+    for trip, body in bodies:
+        columns, _ = validate_batch(decode_body(body, 'gzip'))
+        inserted += insert_batch(conn, trip, columns)
+    elapsed = time.perf_counter() - start
+    print(f'{"batch path (decode+validate+insert)":<34}{total / elapsed:>12,.0f} points/s')
+
+    # Re-sending every batch must not insert anything (idempotent retries)
+    start = time.perf_counter()
+    again = sum(insert_batch(conn, trip, columns) for trip, columns in decoded)
+    print(f'{"re-sent batches (all duplicates)":<34}{total / (time.perf_counter() - start):>12,.0f} points/s, inserted {again}')
+    assert inserted == total and again == 0
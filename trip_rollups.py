@@ -0,0 +1,384 @@
+"""
+Rollups and retention for trip_locations (DB/timeseries-db.md: "built-in
+downsampling", "appropriate retention policies").
+
+Raw points arrive every 5 minutes per traveller and nobody looks at
+last year's trips point by point. A background job compacts them:
+
+    raw points ── older than ROLLUP_DELAY ──► 15 minute + hourly rollups
+        │                                     (centroid, points, distance)
+        └── older than RETENTION[0] ──► deleted
+    15 minute rollups ── older than RETENTION[900] ──► deleted
+    hourly rollups    ── kept forever
+
+- Rollups are built window by window (at most ROLLUP_WINDOW of raw points
+  per step) from a watermark: every bucket before it is rolled up. Steps
+  are upserts, so a crash halfway just redoes the window.
+- ROLLUP_DELAY leaves room for offline phones uploading late. Points that
+  still arrive behind the watermark mark their hour dirty and the next run
+  recomputes it from raw. That needs the hour's raw points, so ingest
+  refuses points older than oldest_accepted(): raw retention minus one
+  ROLLUP_DELAY, the background job's time to get to the hour.
+- Deletes remove at most DELETE_BATCH rows per transaction, so ingest
+  never waits long for the write lock.
+- distance_m is the path length: each hop between consecutive points of a
+  trip counts in the bucket of the point it ends at. The centroid is the
+  mean lat/lon (fine for 15 min - 1 hour of movement; it would be wrong
+  for a bucket spanning the antimeridian).
+
+locations() picks the resolution for a time span: raw points if there are
+few enough and they are still retained, else 15 minute, else hourly
+buckets. Recent data that isn't rolled up yet is aggregated on the fly, so
+any resolution covers the whole span.
+"""
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+RESOLUTIONS = (900, 3600)  # 15 minutes, 1 hour
+# Seconds a raw point / rollup is kept, per resolution (0 = raw); None = forever
+RETENTION = {0: 30 * 86400, 900: 365 * 86400, 3600: None}
+ROLLUP_DELAY = 86400
+ROLLUP_WINDOW = 3600  # one hour of raw points (all trips) per transaction
+DELETE_BATCH = 5000
+EARTH_RADIUS_M = 6_371_008.8
+
+ROLLUPS_SCHEMA = """
+-- Rollup windows and retention deletes select raw points by time
+CREATE INDEX IF NOT EXISTS idx_trip_locations_timestamp ON trip_locations(timestamp);
+
+CREATE TABLE IF NOT EXISTS trip_location_rollups (
+    trip_id INTEGER NOT NULL,
+    resolution INTEGER NOT NULL,  -- bucket size in seconds
+    bucket INTEGER NOT NULL,      -- unix seconds, start of the bucket
+    lat REAL NOT NULL,            -- centroid
+    lon REAL NOT NULL,
+    points INTEGER NOT NULL,
+    distance_m REAL NOT NULL,
+    first_ts INTEGER NOT NULL,
+    last_ts INTEGER NOT NULL,
+    PRIMARY KEY (trip_id, resolution, bucket)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_trip_location_rollups_bucket ON trip_location_rollups(resolution, bucket);
+
+CREATE TABLE IF NOT EXISTS trip_location_rollup_state (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+-- Hours that got points after they were rolled up
+CREATE TABLE IF NOT EXISTS trip_location_rollup_dirty (
+    trip_id INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,
+    PRIMARY KEY (trip_id, bucket)
+) WITHOUT ROWID;
+"""
+
+ROLLUP_COLUMNS = ('timestamp', 'lat', 'lon', 'points', 'distance_m')
+
+
+def ensure_rollups(conn):
+    conn.executescript(ROLLUPS_SCHEMA)
+    conn.commit()
+
+
+def get_watermark(conn):
+    """Every bucket before this timestamp is rolled up (None: nothing yet)."""
+    row = conn.execute(
+        "SELECT value FROM trip_location_rollup_state WHERE key = 'watermark'"
+    ).fetchone()
+    return row[0] if row else None
+
+
+def _set_watermark(conn, value):
+    conn.execute(
+        "INSERT INTO trip_location_rollup_state (key, value) VALUES ('watermark', ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (value,)
+    )
+
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Vectorized great-circle distance in meters."""
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    h = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+def _array(conn, sql, params, width):
+    """Query result as a float array, skipping the connection's Row factory."""
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    rows = cursor.execute(sql, params).fetchall()
+    return np.array(rows, dtype=float).reshape(-1, width)
+
+
+def _fetch_raw(conn, start, end, trip_id=None):
+    """Raw points in [start, end) sorted by trip and time, with each trip's point before start."""
+    sql = "SELECT trip_id, timestamp, lat, lon FROM trip_locations WHERE timestamp >= ? AND timestamp < ?"
+    params = [start, end]
+    if trip_id is not None:
+        sql += " AND trip_id = ?"
+        params.append(trip_id)
+    trips, ts, lat, lon = _array(conn, sql + " ORDER BY trip_id, timestamp", params, 4).T
+    trips, ts = trips.astype(np.int64), ts.astype(np.int64)
+
+    # The hop into the first point of the window starts at the trip's previous point
+    prev_lat, prev_lon = np.roll(lat, 1), np.roll(lon, 1)
+    first = np.flatnonzero(np.diff(trips, prepend=-1))
+    for i in first.tolist():
+        before = conn.execute(
+            "SELECT lat, lon FROM trip_locations WHERE trip_id = ? AND timestamp < ? "
+            "ORDER BY timestamp DESC LIMIT 1",
+            (int(trips[i]), start)
+        ).fetchone()
+        prev_lat[i], prev_lon[i] = before if before else (lat[i], lon[i])
+    hops = haversine_m(prev_lat, prev_lon, lat, lon)
+    return trips, ts, lat, lon, hops
+
+
+def aggregate(trips, ts, lat, lon, hops, resolution):
+    """Per (trip, bucket) centroid, point count, distance; inputs sorted by trip and time."""
+    buckets = ts // resolution * resolution
+    if len(ts) == 0:
+        empty = np.array([], dtype=np.int64)
+        return {'trip_id': empty, 'bucket': empty, 'lat': empty, 'lon': empty,
+                'points': empty, 'distance_m': empty, 'first_ts': empty, 'last_ts': empty}
+    # Sorted by (trip, time), so each (trip, bucket) is a contiguous run
+    change = np.diff(trips, prepend=trips[0] - 1) | np.diff(buckets, prepend=buckets[0] - 1)
+    starts = np.flatnonzero(change)
+    ends = np.append(starts[1:], len(ts)) - 1
+    counts = np.diff(np.append(starts, len(ts)))
+    return {
+        'trip_id': trips[starts],
+        'bucket': buckets[starts],
+        'lat': np.add.reduceat(lat, starts) / counts,
+        'lon': np.add.reduceat(lon, starts) / counts,
+        'points': counts,
+        'distance_m': np.add.reduceat(hops, starts),
+        'first_ts': ts[starts],
+        'last_ts': ts[ends],
+    }
+
+
+def rollup_window(conn, start, end, trip_id=None):
+    """(Re)compute every rollup in [start, end), start/end aligned to hours. Returns raw points read."""
+    trips, ts, lat, lon, hops = _fetch_raw(conn, start, end, trip_id)
+    for resolution in RESOLUTIONS:
+        rows = aggregate(trips, ts, lat, lon, hops, resolution)
+        conn.executemany(
+            "INSERT OR REPLACE INTO trip_location_rollups "
+            "(trip_id, resolution, bucket, lat, lon, points, distance_m, first_ts, last_ts) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            zip(rows['trip_id'].tolist(), [resolution] * len(rows['bucket']),
+                rows['bucket'].tolist(), rows['lat'].tolist(), rows['lon'].tolist(),
+                rows['points'].tolist(), rows['distance_m'].tolist(),
+                rows['first_ts'].tolist(), rows['last_ts'].tolist())
+        )
+    return len(ts)
+
+
+def rollup_step(conn, now=None):
+    """Roll up the next window after the watermark. Returns False when caught up."""
+    now = time.time() if now is None else now
+    horizon = int(now - ROLLUP_DELAY) // 3600 * 3600
+    watermark = get_watermark(conn)
+    if watermark is None:
+        oldest = conn.execute("SELECT MIN(timestamp) FROM trip_locations").fetchone()[0]
+        if oldest is None:
+            return False
+        watermark = oldest // 3600 * 3600
+    if watermark >= horizon:
+        return False
+    end = min(watermark + ROLLUP_WINDOW, horizon)
+    try:
+        if not rollup_window(conn, watermark, end):
+            # Nothing in this window: jump to the hour of the next point
+            following = conn.execute(
+                "SELECT MIN(timestamp) FROM trip_locations WHERE timestamp >= ?", (end,)
+            ).fetchone()[0]
+            end = horizon if following is None else max(end, min(horizon, following // 3600 * 3600))
+        _set_watermark(conn, end)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return end < horizon
+
+
+def mark_late(conn, trip_id, timestamps):
+    """Called after ingest: hours behind the watermark that got new points get recomputed."""
+    watermark = get_watermark(conn)
+    if watermark is None or len(timestamps) == 0 or int(timestamps[0]) >= watermark:
+        return 0  # timestamps are sorted: nothing is late
+    hours = np.unique(timestamps[timestamps < watermark] // 3600 * 3600).tolist()
+    conn.executemany(
+        "INSERT OR IGNORE INTO trip_location_rollup_dirty (trip_id, bucket) VALUES (?, ?)",
+        ((trip_id, hour) for hour in hours)
+    )
+    conn.commit()
+    return len(hours)
+
+
+def recompute_dirty(conn, now=None, limit=100):
+    """Recompute up to `limit` dirty hours. Returns how many were processed."""
+    now = time.time() if now is None else now
+    raw_cutoff = now - RETENTION[0]
+    dirty = conn.execute(
+        "SELECT trip_id, bucket FROM trip_location_rollup_dirty LIMIT ?", (limit,)
+    ).fetchall()
+    try:
+        for trip_id, bucket in dirty:
+            # Older raw points are (being) deleted: recomputing would lose them
+            if bucket >= raw_cutoff:
+                rollup_window(conn, bucket, bucket + 3600, trip_id)
+            conn.execute(
+                "DELETE FROM trip_location_rollup_dirty WHERE trip_id = ? AND bucket = ?",
+                (trip_id, bucket)
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(dirty)
+
+
+def delete_expired(conn, now=None, batch=DELETE_BATCH):
+    """Delete one bounded batch of expired raw points or rollups. Returns rows deleted."""
+    now = time.time() if now is None else now
+    watermark = get_watermark(conn) or 0
+    for resolution, keep in RETENTION.items():
+        if keep is None:
+            continue
+        cutoff = int(now - keep)
+        if resolution == 0:
+            # Never drop raw points that aren't rolled up yet
+            cursor = conn.execute(
+                "DELETE FROM trip_locations WHERE id IN ("
+                "SELECT id FROM trip_locations WHERE timestamp < ? LIMIT ?)",
+                (min(cutoff, watermark), batch)
+            )
+        else:
+            cursor = conn.execute(
+                "DELETE FROM trip_location_rollups WHERE (trip_id, resolution, bucket) IN ("
+                "SELECT trip_id, resolution, bucket FROM trip_location_rollups "
+                "WHERE resolution = ? AND bucket < ? LIMIT ?)",
+                (resolution, cutoff, batch)
+            )
+        conn.commit()
+        if cursor.rowcount:
+            return cursor.rowcount
+    return 0
+
+
+def raw_cutoff(now=None):
+    """Raw points before this timestamp may already be deleted."""
+    return (time.time() if now is None else now) - RETENTION[0]
+
+
+def oldest_accepted(now=None):
+    """Ingest rejects points before this timestamp (the start of an hour).
+
+    Their hour couldn't be recomputed before retention deletes its raw
+    points (recompute_dirty skips those): the rollups would never count them.
+    """
+    cutoff = int(raw_cutoff(now)) + ROLLUP_DELAY
+    return -(-cutoff // 3600) * 3600
+
+
+def pick_resolution(conn, trip_id, start, end, max_points, now=None):
+    """0 (raw) if few enough raw points are still retained, else the finest rollup that fits."""
+    if start >= raw_cutoff(now):
+        count = conn.execute(
+            "SELECT COUNT(*) FROM (SELECT 1 FROM trip_locations "
+            "WHERE trip_id = ? AND timestamp >= ? AND timestamp < ? LIMIT ?)",
+            (trip_id, start, end, max_points + 1)
+        ).fetchone()[0]
+        if count <= max_points:
+            return 0
+    now = time.time() if now is None else now
+    for resolution in RESOLUTIONS:
+        keep = RETENTION[resolution]
+        if (keep is None or start >= now - keep) and (end - start) / resolution <= max_points:
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+def locations(conn, trip_id, start=None, end=None, max_points=1000, now=None):
+    """A trip's track over [start, end) at the resolution that fits max_points."""
+    if start is None or end is None:
+        low, high = conn.execute(
+            "SELECT MIN(low), MAX(high) FROM ("
+            "SELECT MIN(timestamp) AS low, MAX(timestamp) AS high FROM trip_locations WHERE trip_id = ? "
+            "UNION ALL SELECT MIN(first_ts), MAX(last_ts) FROM trip_location_rollups "
+            "WHERE trip_id = ? AND resolution = 3600)",
+            (trip_id, trip_id)
+        ).fetchone()
+        if low is None:
+            return 0, {name: np.array([]) for name in ROLLUP_COLUMNS}
+        start = low if start is None else start
+        end = high + 1 if end is None else end
+
+    resolution = pick_resolution(conn, trip_id, start, end, max_points, now)
+    if resolution == 0:
+        points = _array(
+            conn,
+            "SELECT timestamp, lat, lon FROM trip_locations "
+            "WHERE trip_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+            (trip_id, start, end), 3
+        )
+        return 0, {
+            'timestamp': points[:, 0].astype(np.int64), 'lat': points[:, 1], 'lon': points[:, 2],
+            'points': np.ones(len(points), dtype=np.int64),
+            'distance_m': np.full(len(points), np.nan),
+        }
+
+    first_bucket = start // resolution * resolution
+    watermark = get_watermark(conn) or first_bucket
+    columns = _array(
+        conn,
+        "SELECT bucket, lat, lon, points, distance_m FROM trip_location_rollups "
+        "WHERE trip_id = ? AND resolution = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+        (trip_id, resolution, first_bucket, min(end, watermark)), 5
+    )
+    # Not rolled up yet (newer than the watermark): aggregate the raw points now
+    if end > watermark:
+        fresh = aggregate(*_fetch_raw(conn, max(first_bucket, watermark), end, trip_id), resolution)
+        columns = np.vstack([columns, np.column_stack([
+            fresh['bucket'], fresh['lat'], fresh['lon'], fresh['points'], fresh['distance_m']
+        ]).reshape(-1, 5)])
+    return resolution, {
+        'timestamp': columns[:, 0].astype(np.int64), 'lat': columns[:, 1], 'lon': columns[:, 2],
+        'points': columns[:, 3].astype(np.int64), 'distance_m': columns[:, 4],
+    }
+
+
+async def maintain(db, tracks=None, interval=300):
+    """Background job: roll up, recompute late hours, apply retention; forever.
+
+    Every step is a separate db.run() call and transaction, so API queries
+    interleave with the job instead of waiting for a whole pass.
+    """
+    while True:
+        try:
+            while await db.run(rollup_step):
+                pass
+            while await db.run(recompute_dirty):
+                pass
+            deleted = 0
+            while n := await db.run(delete_expired):
+                deleted += n
+            if tracks is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, tracks.drop_before, int(raw_cutoff())
+                )
+            if deleted:
+                logger.info('retention: deleted %d expired rows', deleted)
+        except Exception:
+            logger.exception('location rollup pass failed, retrying in %ss', interval)
+        await asyncio.sleep(interval)
@@ -0,0 +1,221 @@
+"""
+Full-text trip search with SQLite FTS5.
+
+`title LIKE '%paris%'` can't use a B-tree index (the pattern starts with a
+wildcard), so every search scans the whole trips table. FTS5 keeps an
+inverted index: token -> list of rows containing it, so a search only reads
+the posting lists of the query tokens.
+
+    trips (source of truth) ──triggers──► trips_fts (external content FTS5 index)
+
+- External content table (content='trips'): the index stores only tokens,
+  the text itself stays in `trips`, so we don't store it twice.
+- Triggers keep the index in sync on INSERT / UPDATE / DELETE of trips.
+- prefix='2 3': extra index for 2 and 3 character prefixes, so prefix queries
+  (`par*`) stay fast even for very short prefixes.
+- bm25() ranks results; title matches weigh more than description matches.
+
+Run this file for a benchmark on 1M trips (LIKE vs. FTS5):
+    python trip_search.py
+
+    query                        LIKE ... LIMIT 50     FTS5 ranked
+    place "paris" (~200 hits)          46 ms              0.6 ms
+    prefix "reyk*"                     57 ms              1.6 ms
+    count all hits, rare place        227 ms              0.3 ms
+    common word (~90k hits)           0.2 ms              174 ms
+
+The last row is the trade-off of ranking: bm25 has to score every match
+before it can return the best 50, while LIKE stops at the first 50 rows it
+finds. The index roughly doubles the database size (179 MB -> 378 MB).
+"""
+import re
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS trips_fts USING fts5(
+    title,
+    description,
+    content='trips',
+    content_rowid='id',
+    prefix='2 3',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER IF NOT EXISTS trips_fts_ai AFTER INSERT ON trips BEGIN
+    INSERT INTO trips_fts(rowid, title, description)
+    VALUES (new.id, new.title, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trips_fts_ad AFTER DELETE ON trips BEGIN
+    INSERT INTO trips_fts(trips_fts, rowid, title, description)
+    VALUES ('delete', old.id, old.title, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trips_fts_au AFTER UPDATE OF title, description ON trips BEGIN
+    INSERT INTO trips_fts(trips_fts, rowid, title, description)
+    VALUES ('delete', old.id, old.title, old.description);
+    INSERT INTO trips_fts(rowid, title, description)
+    VALUES (new.id, new.title, new.description);
+END;
+"""
+
+# bm25 weights per column: (title, description)
+TITLE_WEIGHT, DESCRIPTION_WEIGHT = 10.0, 1.0
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def ensure_fts(conn):
+    """Create the index and triggers; index existing trips the first time."""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trips_fts'"
+    ).fetchone()
+    conn.executescript(FTS_SCHEMA)
+    if not exists:
+        conn.execute("INSERT INTO trips_fts(trips_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
+def fts_query(text, prefix=True):
+    """Turn user input into a safe FTS5 query, or None if there's nothing to search.
+
+    Every token is quoted, so FTS5 syntax in the input (AND, NEAR, *, ", :) is
+    searched literally instead of being interpreted. Tokens are ANDed; with
+    prefix=True the last token also matches words it is a prefix of, which is
+    what search-as-you-type wants ("eur" -> "europe").
+    """
+    tokens = _TOKEN.findall(text)
+    if not tokens:
+        return None
+    phrases = [f'"{token}"' for token in tokens]
+    if prefix:
+        phrases[-1] += '*'
+    return ' '.join(phrases)
+
+
+def search_sql(q=None, title=None, start_date=None, end_date=None, prefix=True, limit=50, offset=0):
+    """Build the search query and params.
+
+    q searches title and description, title searches the title column only.
+    Returns (None, None) if the text filters have no searchable tokens.
+    """
+    match = []
+    if q:
+        query = fts_query(q, prefix)
+        if query is None:
+            return None, None
+        match.append(f'({query})')
+    if title:
+        query = fts_query(title, prefix)
+        if query is None:
+            return None, None
+        match.append(f'title : ({query})')
+
+    params = []
+    if match:
+        sql = (
+            "SELECT trips.* FROM trips_fts "
+            "JOIN trips ON trips.id = trips_fts.rowid "
+            "WHERE trips_fts MATCH ?"
+        )
+        params.append(' AND '.join(match))
+    else:
+        sql = "SELECT trips.* FROM trips WHERE 1=1"
+
+    if start_date:
+        sql += " AND trips.start_date >= ?"
+        params.append(start_date)
+    if end_date:
+        sql += " AND trips.end_date <= ?"
+        params.append(end_date)
+
+    if match:
+        sql += f" ORDER BY bm25(trips_fts, {TITLE_WEIGHT}, {DESCRIPTION_WEIGHT})"
+    else:
+        sql += " ORDER BY trips.start_date DESC"
+    sql += " LIMIT ? OFFSET ?"
+    params += [limit, offset]
+    return sql, params
+
+
+# Benchmark
+# 1M trips with titles/descriptions drawn from a small travel vocabulary.
+# We compare the old LIKE scan with FTS5 for a common word, places and a prefix.
+if __name__ == '__main__':
+    import os
+    import random
+    import sqlite3
+    import tempfile
+    import time
+
+    TRIPS = 1_000_000
+
+    PLACES = [
+        'paris', 'rome', 'bangkok', 'singapore', 'nairobi', 'lima', 'cusco', 'tokyo',
+        'kyoto', 'lisbon', 'porto', 'berlin', 'prague', 'vienna', 'budapest', 'hanoi',
+        'bali', 'sydney', 'auckland', 'reykjavik', 'marrakesh', 'cairo', 'istanbul',
+    ] + [f'village{i}' for i in range(5000)]
+    WORDS = [
+        'trip', 'adventure', 'tour', 'backpacking', 'road', 'hiking', 'food', 'beach',
+        'mountains', 'wildlife', 'photography', 'family', 'honeymoon', 'weekend',
+        'across', 'exploring', 'summer', 'winter', 'with', 'friends', 'and', 'the',
+    ]
+
+    path = os.path.join(tempfile.mkdtemp(), 'search-bench.db')
+    conn = sqlite3.connect(path)
+    conn.executescript("""
+        CREATE TABLE trips (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+            title TEXT NOT NULL, description TEXT,
+            start_date TIMESTAMP, end_date TIMESTAMP
+        );
+    """)
+    rng = random.Random(42)
+
+    def trips():
+        for i in range(TRIPS):
+            place = rng.choice(PLACES)
+            title = f'{place.title()} {rng.choice(WORDS)} {rng.choice(WORDS)}'
+            description = ' '.join(rng.choice(WORDS) for _ in range(12)) + f' in {rng.choice(PLACES)}'
+            day = rng.randint(1, 28)
+            yield (i % 50_000, title, description, f'2023-06-{day:02d} 00:00:00', f'2023-07-{day:02d} 00:00:00')
+
+    start = time.perf_counter()
+    conn.executemany(
+        'INSERT INTO trips (user_id, title, description, start_date, end_date) VALUES (?, ?, ?, ?, ?)',
+        trips(),
+    )
+    conn.commit()
+    print(f'inserted {TRIPS:,} trips in {time.perf_counter() - start:.1f}s')
+    size_before = os.path.getsize(path)
+
+    start = time.perf_counter()
+    ensure_fts(conn)
+    print(f'built FTS5 index in {time.perf_counter() - start:.1f}s, '
+          f'db {size_before / 2**20:.0f} MB -> {os.path.getsize(path) / 2**20:.0f} MB')
+
+    def timed(sql, params, repeat=3):
+        best = float('inf')
+        for _ in range(repeat):
+            t = time.perf_counter()
+            rows = conn.execute(sql, params).fetchall()
+            best = min(best, time.perf_counter() - t)
+        return best, len(rows)
+
+    print(f'{"query":<28}{"LIKE scan":>14}{"FTS5":>12}{"rows (limit 50)":>18}')
+    for label, text, prefix in (
+        ('common word "adventure"', 'adventure', False),
+        ('place "paris"', 'paris', False),
+        ('rare place "village4321"', 'village4321', False),
+        ('prefix "reyk*"', 'reyk', True),
+    ):
+        like_sql = "SELECT * FROM trips WHERE title LIKE ? LIMIT 50"
+        like_time, _ = timed(like_sql, (f'%{text}%',))
+        sql, params = search_sql(title=text, prefix=prefix)
+        fts_time, n = timed(sql, params)
+        print(f'{label:<28}{like_time * 1000:>11.1f} ms{fts_time * 1000:>9.1f} ms{n:>18}')
+
+    # LIKE ... LIMIT 50 stops at the first 50 hits; counting all matches has to scan everything
+    like_time, _ = timed("SELECT COUNT(*) FROM trips WHERE title LIKE ?", ('%village4321%',), repeat=1)
+    fts_time, _ = timed("SELECT COUNT(*) FROM trips_fts WHERE trips_fts MATCH ?", ('title : "village4321"',), repeat=1)
+    print(f'{"count all, rare place":<28}{like_time * 1000:>11.1f} ms{fts_time * 1000:>9.1f} ms')
+    conn.close()
@@ -0,0 +1,215 @@
+"""
+Trajectory simplification for map rendering.
+
+A month-long trip has ~10k points (one per 5 minutes), a map tile at zoom 5
+can't show more than a few hundred of them. Shipping all of them wastes
+bandwidth and client CPU. We simplify the track with Douglas-Peucker:
+
+    1. keep the first and last point
+    2. find the point farthest from the segment between them
+    3. if it's farther than `tolerance`, keep it and recurse on both halves,
+       otherwise drop everything in between
+
+The recursion is done breadth-first: each round computes step 2 for all open
+segments at once, in one vectorized NumPy pass over their points.
+Coordinates are projected to local meters first (equirectangular around the
+track's mean latitude), so the tolerance is in meters everywhere on earth.
+
+Zoom levels map to a tolerance of `pixels` screen pixels:
+    meters per pixel = 156543.03 * cos(latitude) / 2^zoom   (Web Mercator, 256px tiles)
+
+Results are cached per (trip, tolerance bucket). Buckets are half-octaves
+(tolerance 2^(k/2) meters); a request is served with its bucket's lower
+bound, i.e. slightly more detail than asked, so nearby tolerances share one
+cache entry. New points for a trip invalidate all its buckets.
+
+Run this file for throughput numbers on 100k-point tracks:
+    python trip_simplify.py
+"""
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+EARTH_RADIUS_M = 6_371_008.8
+METERS_PER_PIXEL_ZOOM0 = 156_543.03392
+
+
+def project(lat, lon):
+    """Lat/lon degrees -> x/y meters, equirectangular around the mean latitude."""
+    lat0 = math.radians(float(np.mean(lat))) if len(lat) else 0.0
+    x = np.radians(lon) * EARTH_RADIUS_M * math.cos(lat0)
+    y = np.radians(lat) * EARTH_RADIUS_M
+    return x, y
+
+
+def _segment_distances(x, y, x0, y0, x1, y1):
+    """Distance of every (x, y) to its segment (x0, y0)-(x1, y1), all arrays."""
+    dx, dy = x1 - x0, y1 - y0
+    length2 = dx * dx + dy * dy
+    # Zero-length segment (the traveller came back to the same spot): t = 0
+    t = np.divide((x - x0) * dx + (y - y0) * dy, length2,
+                  out=np.zeros_like(length2), where=length2 > 0)
+    t = np.clip(t, 0.0, 1.0)
+    return np.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+
+
+def douglas_peucker(x, y, tolerance):
+    """Indices of the points to keep, in order.
+
+    Level by level instead of one segment at a time: every iteration handles
+    all open segments in one vectorized pass, so the Python loop runs once per
+    recursion depth (~log n for real tracks) instead of once per kept point.
+    """
+    n = len(x)
+    if n <= 2:
+        return np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    firsts, lasts = np.array([0]), np.array([n - 1])
+    while len(firsts):
+        inner = lasts - firsts - 1
+        has_inner = inner > 0
+        firsts, lasts, inner = firsts[has_inner], lasts[has_inner], inner[has_inner]
+        if not len(firsts):
+            break
+        # Flatten the interior points of all segments into one array
+        starts = np.cumsum(inner) - inner  # where each segment begins in the flat array
+        segment = np.repeat(np.arange(len(firsts)), inner)
+        index = np.arange(inner.sum()) - starts[segment] + firsts[segment] + 1
+        f, l = firsts[segment], lasts[segment]
+        distances = _segment_distances(x[index], y[index], x[f], y[f], x[l], y[l])
+        # Farthest point per segment
+        farthest = np.maximum.reduceat(distances, starts)
+        candidates = np.where(distances == farthest[segment], index, -1)
+        split = np.maximum.reduceat(candidates, starts)
+
+        refine = farthest > tolerance
+        split = split[refine]
+        keep[split] = True
+        firsts = np.concatenate([firsts[refine], split])
+        lasts = np.concatenate([split, lasts[refine]])
+    return np.flatnonzero(keep)
+
+
+def zoom_tolerance(zoom, latitude, pixels=1.0):
+    """Tolerance in meters so that dropped detail is below `pixels` at this zoom."""
+    return pixels * METERS_PER_PIXEL_ZOOM0 * math.cos(math.radians(latitude)) / 2 ** zoom
+
+
+def tolerance_bucket(tolerance):
+    """Half-octave bucket of a tolerance in meters, and the tolerance it's served with."""
+    bucket = math.floor(2 * math.log2(max(tolerance, 0.01)))
+    return bucket, 2 ** (bucket / 2)
+
+
+def simplify(track, tolerance):
+    """Simplify a track (dict of columns with lat/lon); returns the kept rows."""
+    if len(track['lat']) == 0:
+        return track
+    x, y = project(track['lat'], track['lon'])
+    keep = douglas_peucker(x, y, tolerance)
+    return {name: values[keep] for name, values in track.items()}
+
+
+class SimplifiedTrackCache:
+    """LRU cache of simplified tracks keyed by (trip_id, tolerance bucket).
+
+    Each cached trip also keeps the (points, mean latitude) of its full
+    track: a zoom level's tolerance depends on the latitude, and a hit must
+    not have to read the track to find its bucket.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._buckets = {}  # trip_id -> set of cached buckets, for invalidation
+        self._info = {}  # trip_id -> (points, mean latitude), while it has buckets
+        self._versions = {}  # trip_id -> bumped on every invalidation
+        self._lock = threading.Lock()
+
+    def version(self, trip_id):
+        with self._lock:
+            return self._versions.get(trip_id, 0)
+
+    def info(self, trip_id):
+        """(points, mean latitude) of the trip's track, or None if nothing is cached."""
+        with self._lock:
+            return self._info.get(trip_id)
+
+    def get(self, trip_id, bucket):
+        with self._lock:
+            key = (trip_id, bucket)
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, trip_id, bucket, value, version, info):
+        """Store a result computed from data at `version`; dropped if it's stale now."""
+        with self._lock:
+            if self._versions.get(trip_id, 0) != version:
+                return
+            self._entries[(trip_id, bucket)] = value
+            self._entries.move_to_end((trip_id, bucket))
+            self._buckets.setdefault(trip_id, set()).add(bucket)
+            self._info[trip_id] = info
+            while len(self._entries) > self.max_entries:
+                (old_trip, old_bucket), _ = self._entries.popitem(last=False)
+                buckets = self._buckets[old_trip]
+                buckets.discard(old_bucket)
+                if not buckets:
+                    del self._buckets[old_trip], self._info[old_trip]
+
+    def invalidate(self, trip_id):
+        with self._lock:
+            self._versions[trip_id] = self._versions.get(trip_id, 0) + 1
+            self._info.pop(trip_id, None)
+            for bucket in self._buckets.pop(trip_id, ()):
+                self._entries.pop((trip_id, bucket), None)
+
+
+def track_info(track):
+    """(points, mean latitude) of a track, as SimplifiedTrackCache keeps them."""
+    points = len(track['lat'])
+    return points, float(track['lat'].mean()) if points else 0.0
+
+
+# Benchmark
+# A 100k-point random-walk track (about a year at 5 minute cadence), simplified
+# at typical map zoom levels.
+if __name__ == '__main__':
+    import time
+
+    POINTS = 100_000
+    rng = np.random.default_rng(11)
+    # Random walk with some momentum, like a real traveller
+    heading = np.cumsum(rng.normal(0, 0.3, POINTS))
+    step = rng.uniform(0, 2e-3, POINTS)
+    track = {
+        'timestamp': 1688292000 + np.arange(POINTS) * 300,
+        'lat': 48.85 + np.cumsum(step * np.sin(heading)),
+        'lon': 2.35 + np.cumsum(step * np.cos(heading)),
+    }
+    latitude = float(np.mean(track['lat']))
+
+    print(f'{POINTS:,} points')
+    print(f'{"zoom":>5}{"tolerance":>12}{"kept":>9}{"time":>11}{"points/s":>14}')
+    for zoom in (4, 8, 12, 16):
+        _, tolerance = tolerance_bucket(zoom_tolerance(zoom, latitude))
+        best = float('inf')
+        for _ in range(3):
+            start = time.perf_counter()
+            result = simplify(track, tolerance)
+            best = min(best, time.perf_counter() - start)
+        print(f'{zoom:>5}{tolerance:>10.1f} m{len(result["lat"]):>9,}{best * 1000:>8.1f} ms'
+              f'{POINTS / best:>14,.0f}')
+
+    cache = SimplifiedTrackCache()
+    bucket, tolerance = tolerance_bucket(zoom_tolerance(10, latitude))
+    cache.put(1, bucket, simplify(track, tolerance), cache.version(1), track_info(track))
+    start = time.perf_counter()
+    for _ in range(10_000):
+        cache.get(1, bucket)
+    print(f'cache hit: {(time.perf_counter() - start) / 10_000 * 1e6:.2f} us')
@@ -0,0 +1,175 @@
+"""
+Incrementally maintained trip statistics.
+
+`/trips/stats/` used to run COUNT(*), AVG(...) and COUNT(DISTINCT user_id)
+over the whole trips table on every call: O(n) per request. Instead we keep
+running aggregates and update them on every trip write:
+
+    insert  ──► count += 1, duration_sum += d, user_trips[user] += 1, sketch.add(d)
+    delete  ──► the same with -1
+    update  ──► delete(old) + insert(new)
+
+Reading the stats is then O(1) (percentiles are O(number of sketch buckets)).
+
+- Unique users: an exact multiset {user_id: number of trips}. A HyperLogLog
+  would use less memory, but it can't forget a user when their last trip is
+  deleted; the multiset costs one dict entry per user with trips.
+- Duration percentiles: a DDSketch-style histogram with logarithmic buckets.
+  Any quantile is within `relative_accuracy` (1%) of the true value, and
+  unlike most sketches a bucket count can be decremented, so deletes work.
+- Exact mode: `exact_stats(conn)` runs the original SQL, to audit the engine.
+
+The engine lives in one process and only sees writes made through it. It is
+loaded from the database at startup; with several worker processes, or
+writes that bypass the API, audit with exact mode or reload it.
+"""
+import math
+from datetime import datetime, timezone
+
+EXACT_STATS_SQL = """
+    SELECT
+        COUNT(*) as total_trips,
+        AVG(JULIANDAY(end_date) - JULIANDAY(start_date)) as avg_duration,
+        COUNT(DISTINCT user_id) as unique_users
+    FROM trips
+"""
+
+
+def exact_stats(conn):
+    return dict(conn.execute(EXACT_STATS_SQL).fetchone())
+
+
+def _to_datetime(value):
+    """A naive UTC datetime, as JULIANDAY reads the value; None where it gives NULL."""
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            # fromisoformat() only takes "Z" from Python 3.11
+            value = datetime.fromisoformat(value[:-1] + '+00:00' if value.endswith('Z') else value)
+        except ValueError:
+            return None
+    # JULIANDAY converts offsets to UTC and takes naive values as UTC: mixing
+    # both in one trip must not raise (naive - aware is a TypeError)
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def trip_duration_days(trip):
+    """Same as JULIANDAY(end_date) - JULIANDAY(start_date); None if a date is missing."""
+    start, end = _to_datetime(trip['start_date']), _to_datetime(trip['end_date'])
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds() / 86400
+
+
+class DurationSketch:
+    """Quantile sketch with relative error guarantees that supports removal.
+
+    Value v > 0 goes into bucket ceil(log_gamma(v)), gamma = (1 + a) / (1 - a).
+    Every value in a bucket is within a factor of (1 +- a) of the bucket's
+    representative, so quantiles are accurate to `a` relative error. Values
+    below `min_value` (same-day trips, bad data) share a zero bucket.
+    """
+
+    def __init__(self, relative_accuracy=0.01, min_value=1e-3):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.buckets = {}  # bucket index -> count
+        self.zero_count = 0
+        self.count = 0
+
+    def _key(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def add(self, value, n=1):
+        if value < self.min_value:
+            self.zero_count += n
+        else:
+            key = self._key(value)
+            new = self.buckets.get(key, 0) + n
+            if new:
+                self.buckets[key] = new
+            else:
+                del self.buckets[key]
+        self.count += n
+
+    def remove(self, value):
+        self.add(value, -1)
+
+    def quantile(self, q):
+        if self.count <= 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                # Representative value of the bucket (gamma^(key-1), gamma^key]
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+
+class TripStatsEngine:
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._reset()
+
+    def _reset(self):
+        self.total_trips = 0
+        self.duration_sum = 0.0
+        self.duration_count = 0  # trips that have both dates (AVG skips NULLs)
+        self.user_trips = {}  # user_id -> number of trips
+        self.durations = DurationSketch(self.relative_accuracy)
+
+    def _apply(self, trip, sign):
+        # Everything that can fail first: a half-applied trip would make the
+        # running numbers drift from exact_stats for good
+        duration = trip_duration_days(trip)
+        self.total_trips += sign
+
+        user_id = trip['user_id']
+        remaining = self.user_trips.get(user_id, 0) + sign
+        if remaining > 0:
+            self.user_trips[user_id] = remaining
+        else:
+            self.user_trips.pop(user_id, None)
+
+        if duration is not None:
+            self.duration_sum += sign * duration
+            self.duration_count += sign
+            self.durations.add(duration, sign)
+
+    def on_insert(self, trip):
+        self._apply(trip, 1)
+
+    def on_delete(self, trip):
+        self._apply(trip, -1)
+
+    def on_update(self, old, new):
+        self._apply(old, -1)
+        self._apply(new, 1)
+
+    def load(self, conn):
+        """Rebuild the aggregates from the table (startup, or after drift)."""
+        self._reset()
+        for trip in conn.execute('SELECT user_id, start_date, end_date FROM trips'):
+            self.on_insert(trip)
+
+    def snapshot(self, percentiles=False):
+        stats = {
+            'total_trips': self.total_trips,
+            'avg_duration': (
+                self.duration_sum / self.duration_count if self.duration_count else None
+            ),
+            'unique_users': len(self.user_trips),
+        }
+        if percentiles:
+            for name, q in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                stats[f'duration_{name}'] = self.durations.quantile(q)
+        return stats
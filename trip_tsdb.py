@@ -0,0 +1,363 @@
+"""
+Embedded columnar time-series store for trip tracks.
+
+trip_locations is a row table: every point costs a full row (rowid, trip_id,
+8 bytes per float, created_at...) plus a B-tree index entry, and reading a
+track means visiting every row. Time-series databases (see DB/timeseries-db.md)
+do better by storing each column separately, in time chunks, encoded so that
+neighbouring values compress well. This is a small version of that idea:
+
+    tracks/
+      <trip_id>/
+        <chunk_start>.chunk     one file per trip per day (CHUNK_SECONDS)
+
+Inside a chunk every column is its own contiguous array:
+
+    timestamp   delta-of-delta     a regular 5 min cadence becomes all zeros -> int8
+    lat, lon    delta of 1e-7 deg  neighbouring points are close -> int16/int32
+    altitude    XOR with previous  float32 bit patterns (Gorilla-style), NaN kept as-is
+    accuracy    XOR with previous
+
+Each column uses the narrowest integer type that fits its encoded values, and
+starts at an 8-byte aligned offset, so the file can be memory-mapped and the
+columns read with np.frombuffer without copying or parsing. Decoding is
+vectorized: cumsum() undoes deltas, bitwise_xor.accumulate() undoes XOR.
+
+Lat/lon are stored at 1e-7 degree resolution (~1 cm), altitude and accuracy
+as float32; that's more precision than a phone GPS has.
+
+Chunks are immutable files: append() merges new points into the chunk and
+atomically replaces it (write temp file + os.replace), so readers never see
+a half-written chunk.
+
+Run this file for compression and query benchmarks against the row table:
+    python trip_tsdb.py
+
+    1M points (100 trips)       row table + index    track store
+    size                        81.6 MB (86 B/pt)    14.8 MB (15.5 B/pt)
+    range scan, 1 week          2.3 ms               1.0 ms
+    hourly downsample, a trip   7.1 ms               4.0 ms
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+
+import numpy as np
+
+MAGIC = b'TRKCHNK1'
+CHUNK_SECONDS = 24 * 3600
+COORD_SCALE = 10_000_000  # 1e-7 degrees
+FIELDS = ('timestamp', 'lat', 'lon', 'altitude', 'accuracy')
+LOCK_STRIPES = 64  # writers of trips in the same stripe wait for each other
+
+_INT_TYPES = (np.int8, np.int16, np.int32, np.int64)
+_UINT_TYPES = (np.uint8, np.uint16, np.uint32)
+
+
+def _narrowest(values, types):
+    if len(values) == 0:
+        return types[0]
+    lo, hi = values.min(), values.max()
+    for dtype in types:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return types[-1]
+
+
+# Column encodings: each returns (array to store, header fields) and back
+
+def _encode_dod(ts):
+    deltas = np.diff(ts, prepend=ts[0])
+    dod = np.diff(deltas, prepend=0)
+    return dod.astype(_narrowest(dod, _INT_TYPES)), {'first': int(ts[0])}
+
+
+def _decode_dod(stored, meta):
+    return np.cumsum(np.cumsum(stored, dtype=np.int64)) + meta['first']
+
+
+def _encode_coord(values):
+    fixed = np.round(values * COORD_SCALE).astype(np.int64)
+    deltas = np.diff(fixed, prepend=fixed[0])
+    return deltas.astype(_narrowest(deltas, _INT_TYPES)), {'first': int(fixed[0])}
+
+
+def _decode_coord(stored, meta):
+    return (np.cumsum(stored, dtype=np.int64) + meta['first']) / COORD_SCALE
+
+
+def _encode_xor(values):
+    bits = values.astype(np.float32).view(np.uint32)
+    xored = np.bitwise_xor(bits, np.concatenate(([np.uint32(0)], bits[:-1])))
+    return xored.astype(_narrowest(xored, _UINT_TYPES)), {}
+
+
+def _decode_xor(stored, meta):
+    bits = np.bitwise_xor.accumulate(stored.astype(np.uint32))
+    return bits.view(np.float32).astype(np.float64)
+
+
+ENCODINGS = {
+    'timestamp': ('dod', _encode_dod, _decode_dod),
+    'lat': ('delta', _encode_coord, _decode_coord),
+    'lon': ('delta', _encode_coord, _decode_coord),
+    'altitude': ('xor', _encode_xor, _decode_xor),
+    'accuracy': ('xor', _encode_xor, _decode_xor),
+}
+
+
+def write_chunk(path, columns):
+    """Encode sorted, deduplicated columns into a chunk file (atomically)."""
+    header = {'n': len(columns['timestamp']), 'columns': {}}
+    arrays = []
+    offset = 0
+    for name in FIELDS:
+        encoding, encode, _ = ENCODINGS[name]
+        stored, meta = encode(columns[name])
+        header['columns'][name] = dict(
+            meta, encoding=encoding, dtype=stored.dtype.str, offset=offset
+        )
+        arrays.append(stored)
+        offset += -(-stored.nbytes // 8) * 8  # next column starts 8-byte aligned
+
+    header_bytes = json.dumps(header).encode()
+    data_start = -(-(len(MAGIC) + 4 + len(header_bytes)) // 8) * 8
+    tmp = f'{path}.tmp{threading.get_ident()}'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + struct.pack('<I', len(header_bytes)) + header_bytes)
+        for name, stored in zip(FIELDS, arrays):
+            f.seek(data_start + header['columns'][name]['offset'])
+            f.write(stored.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp, path)
+
+
+def read_chunk(path, fields=FIELDS):
+    """Memory-map a chunk file and decode the requested columns."""
+    with open(path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a track chunk')
+        (header_len,) = struct.unpack_from('<I', mm, len(MAGIC))
+        header_end = len(MAGIC) + 4 + header_len
+        header = json.loads(mm[len(MAGIC) + 4:header_end])
+        data_start = -(-header_end // 8) * 8
+        n = header['n']
+        columns = {}
+        for name in fields:
+            meta = header['columns'][name]
+            # Zero-copy view into the mapped file; decoding makes the real arrays
+            stored = np.frombuffer(
+                mm, dtype=np.dtype(meta['dtype']), count=n, offset=data_start + meta['offset']
+            )
+            columns[name] = ENCODINGS[name][2](stored, meta)
+            del stored
+        return columns
+    finally:
+        mm.close()
+
+
+def _concat(parts, fields=FIELDS):
+    if not parts:
+        return {name: np.empty(0, dtype=np.int64 if name == 'timestamp' else np.float64)
+                for name in fields}
+    return {name: np.concatenate([p[name] for p in parts]) for name in fields}
+
+
+class TrackStore:
+    def __init__(self, root, chunk_seconds=CHUNK_SECONDS):
+        self.root = root
+        self.chunk_seconds = chunk_seconds
+        # One writer per trip at a time. A fixed set of locks, not one per trip
+        # ever written: that would grow with every trip the process sees
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        os.makedirs(root, exist_ok=True)
+
+    def _lock(self, trip_id):
+        return self._locks[int(trip_id) % len(self._locks)]
+
+    def _trip_ids(self):
+        # Skip anything that isn't a trip directory (.DS_Store, editor files)
+        return [int(name) for name in os.listdir(self.root) if name.isdigit()]
+
+    def _trip_dir(self, trip_id):
+        return os.path.join(self.root, str(int(trip_id)))
+
+    def _chunk_starts(self, trip_id):
+        try:
+            names = os.listdir(self._trip_dir(trip_id))
+        except FileNotFoundError:
+            return []
+        return sorted(
+            int(name[:-6]) for name in names if name.endswith('.chunk') and name[:-6].isdigit()
+        )
+
+    def _chunk_path(self, trip_id, chunk_start):
+        return os.path.join(self._trip_dir(trip_id), f'{chunk_start}.chunk')
+
+    def append(self, trip_id, columns):
+        """Add points (a dict of arrays, any order); existing timestamps are kept."""
+        ts = np.asarray(columns['timestamp'], dtype=np.int64)
+        if len(ts) == 0:
+            return
+        new = {
+            name: np.asarray(columns[name], dtype=np.int64 if name == 'timestamp' else np.float64)
+            for name in FIELDS
+        }
+        chunk_of = ts // self.chunk_seconds * self.chunk_seconds
+        os.makedirs(self._trip_dir(trip_id), exist_ok=True)
+        with self._lock(trip_id):
+            for chunk_start in np.unique(chunk_of).tolist():
+                mask = chunk_of == chunk_start
+                part = {name: values[mask] for name, values in new.items()}
+                path = self._chunk_path(trip_id, chunk_start)
+                if os.path.exists(path):
+                    # Existing points first, so np.unique keeps them on duplicates
+                    part = _concat([read_chunk(path), part])
+                _, first = np.unique(part['timestamp'], return_index=True)
+                write_chunk(path, {name: values[first] for name, values in part.items()})
+
+    def scan(self, trip_id, start=None, end=None, fields=FIELDS):
+        """Points with start <= timestamp < end, in time order."""
+        if 'timestamp' not in fields:
+            fields = ('timestamp',) + tuple(fields)
+        parts = []
+        for chunk_start in self._chunk_starts(trip_id):
+            if end is not None and chunk_start >= end:
+                break
+            if start is not None and chunk_start + self.chunk_seconds <= start:
+                continue
+            part = read_chunk(self._chunk_path(trip_id, chunk_start), fields)
+            ts = part['timestamp']
+            lo = 0 if start is None else np.searchsorted(ts, start, 'left')
+            hi = len(ts) if end is None else np.searchsorted(ts, end, 'left')
+            if hi > lo:
+                parts.append({name: values[lo:hi] for name, values in part.items()})
+        return _concat(parts, fields)
+
+    def downsample(self, trip_id, every, start=None, end=None):
+        """Average position/altitude per `every` seconds bucket, plus point counts."""
+        points = self.scan(trip_id, start, end, ('timestamp', 'lat', 'lon', 'altitude'))
+        ts = points['timestamp']
+        if len(ts) == 0:
+            return {'timestamp': [], 'lat': [], 'lon': [], 'altitude': [], 'count': []}
+        buckets = ts // every * every
+        # ts is sorted, so each bucket is a contiguous run: reduceat sums the runs
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        counts = np.diff(np.append(starts, len(ts)))
+        altitude = points['altitude']
+        has_alt = ~np.isnan(altitude)
+        alt_counts = np.add.reduceat(has_alt, starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            alt_mean = np.add.reduceat(np.where(has_alt, altitude, 0.0), starts) / alt_counts
+        return {
+            'timestamp': buckets[starts],
+            'lat': np.add.reduceat(points['lat'], starts) / counts,
+            'lon': np.add.reduceat(points['lon'], starts) / counts,
+            'altitude': alt_mean,
+            'count': counts,
+        }
+
+    def drop_before(self, cutoff):
+        """Retention: delete the chunks whose points are all older than cutoff."""
+        dropped = 0
+        for trip_id in self._trip_ids():
+            with self._lock(trip_id):
+                for chunk_start in self._chunk_starts(trip_id):
+                    if chunk_start + self.chunk_seconds > cutoff:
+                        break
+                    os.unlink(self._chunk_path(trip_id, chunk_start))
+                    dropped += 1
+        return dropped
+
+    def size_bytes(self, trip_id=None):
+        trips = [trip_id] if trip_id is not None else self._trip_ids()
+        return sum(
+            os.path.getsize(self._chunk_path(trip, start))
+            for trip in trips
+            for start in self._chunk_starts(trip)
+        )
+
+
+# Benchmark
+# 100 trips x 10k points (5 minute cadence with jitter, a random walk for the
+# position) in the trip_locations row table vs. the track store.
+if __name__ == '__main__':
+    import sqlite3
+    import tempfile
+    import time
+
+    from trip_locations import ensure_locations, insert_batch
+
+    TRIPS, POINTS = 100, 10_000
+    rng = np.random.default_rng(3)
+    workdir = tempfile.mkdtemp()
+
+    def make_track():
+        ts = 1688292000 + np.arange(POINTS) * 300 + rng.integers(-2, 3, POINTS)
+        return {
+            'timestamp': ts,
+            'lat': np.round(48.85 + np.cumsum(rng.normal(0, 3e-4, POINTS)), 6),
+            'lon': np.round(2.35 + np.cumsum(rng.normal(0, 3e-4, POINTS)), 6),
+            'altitude': np.round(30 + np.cumsum(rng.normal(0, 0.5, POINTS)), 1),
+            'accuracy': np.round(rng.uniform(3, 30, POINTS), 1),
+        }
+
+    tracks = {trip: make_track() for trip in range(1, TRIPS + 1)}
+    total = TRIPS * POINTS
+
+    db_path = os.path.join(workdir, 'rows.db')
+    conn = sqlite3.connect(db_path)
+    ensure_locations(conn)
+    for trip, columns in tracks.items():
+        insert_batch(conn, trip, columns)
+    conn.execute('VACUUM')
+    row_bytes = os.path.getsize(db_path)
+
+    store = TrackStore(os.path.join(workdir, 'tracks'))
+    start = time.perf_counter()
+    for trip, columns in tracks.items():
+        store.append(trip, columns)
+    write_time = time.perf_counter() - start
+    store_bytes = store.size_bytes()
+
+    print(f'{total:,} points')
+    print(f'row table (with index)   {row_bytes / 2**20:8.1f} MB  {row_bytes / total:6.1f} B/point')
+    print(f'track store              {store_bytes / 2**20:8.1f} MB  {store_bytes / total:6.1f} B/point'
+          f'  ({row_bytes / store_bytes:.1f}x smaller, written in {write_time:.2f}s)')
+
+    def best_of(fn, repeat=5):
+        best = float('inf')
+        for _ in range(repeat):
+            t = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - t)
+        return best, result
+
+    t0 = 1688292000 + 7 * 86400
+    t1 = t0 + 7 * 86400  # one week of one trip
+    sql_time, rows = best_of(lambda: conn.execute(
+        'SELECT timestamp, lat, lon, altitude, accuracy FROM trip_locations '
+        'WHERE trip_id = ? AND timestamp >= ? AND timestamp < ? ORDER BY timestamp',
+        (42, t0, t1)).fetchall())
+    store_time, points = best_of(lambda: store.scan(42, t0, t1))
+    assert len(rows) == len(points['timestamp'])
+    print(f'range scan, 1 week       row table {sql_time * 1000:7.2f} ms   store {store_time * 1000:7.2f} ms'
+          f'   ({len(rows)} points)')
+
+    sql_time, rows = best_of(lambda: conn.execute(
+        'SELECT timestamp / 3600 * 3600, AVG(lat), AVG(lon), AVG(altitude), COUNT(*) '
+        'FROM trip_locations WHERE trip_id = ? GROUP BY timestamp / 3600', (42,)).fetchall())
+    store_time, buckets = best_of(lambda: store.downsample(42, 3600))
+    assert len(rows) == len(buckets['timestamp'])
+    print(f'hourly downsample, trip  row table {sql_time * 1000:7.2f} ms   store {store_time * 1000:7.2f} ms'
+          f'   ({len(rows)} buckets)')
+
+    restored = store.scan(42)
+    assert np.array_equal(restored['timestamp'], tracks[42]['timestamp'])
+    assert np.allclose(restored['lat'], tracks[42]['lat'], atol=1e-7)
+    assert np.allclose(restored['altitude'], tracks[42]['altitude'], atol=1e-4)
@@ -1,12 +1,171 @@
 from fastapi import FastAPI
 
-from typing import List, Optional
-from pydantic import BaseModel
-from datetime import datetime
-import sqlite3
-from fastapi import HTTPException, Depends, status
+from typing import List, Optional, Tuple
+from pydantic import BaseModel, field_validator
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, Depends, Query, Request, Response, status
 
-app = FastAPI()
+from async_db import AsyncConnection, AsyncSQLite, sqlite_pool
+from trip_search import ensure_fts, search_sql
+from trip_stats import TripStatsEngine, exact_stats
+from trip_locations import (
+    MAX_BODY_BYTES, BatchTooLarge, InvalidBatch, columns_to_json, decode_body, ensure_locations,
+    insert_batch, read_body, validate_batch
+)
+from trip_tsdb import TrackStore
+from trip_rollups import ensure_rollups, locations, maintain, mark_late, oldest_accepted
+from trip_analytics import ensure_analytics, get_analytics, record_points, summary_json
+from trip_simplify import (
+    SimplifiedTrackCache, simplify, tolerance_bucket, track_info, zoom_tolerance
+)
+from trip_geo import GridIndex, parse_bbox
+from fast_json import RowEncoder, dumps
+from dataloader import DataLoader
+from photo_store import (
+    MAX_PHOTO_BYTES, InvalidImage, PhotoFileResponse, PhotoStore, PhotoTooLarge,
+    content_etag, process_photo
+)
+from http_cache import CACHE_CONTROL, VersionMap, etag_matches, revision_etag
+from tracing import FileExporter, TailSampling, Tracer, TracingMiddleware, set_tracer
+from profiler import ContinuousProfiler, profile_fastapi
+
+DATABASE = 'travel.db'
+TRACKS_DIR = 'tracks'
+PHOTOS_DIR = 'photos'
+TRACES_FILE = 'traces.jsonl'
+PROFILES_DIR = 'profiles'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    email TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    revision INTEGER NOT NULL DEFAULT 1,  -- bumped on every update, for ETags
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS trips (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    title TEXT NOT NULL,
+    description TEXT,
+    start_date TIMESTAMP,
+    end_date TIMESTAMP,
+    revision INTEGER NOT NULL DEFAULT 1,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_trips_user_id ON trips(user_id);
+
+CREATE TABLE IF NOT EXISTS photos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    trip_id INTEGER NOT NULL REFERENCES trips(id),
+    filename TEXT NOT NULL,
+    lat REAL,
+    lon REAL,
+    taken_at TIMESTAMP,
+    content_hash TEXT,  -- sha256 of the file, see photo_store.py
+    size INTEGER,
+    content_type TEXT,
+    width INTEGER,
+    height INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_photos_trip_id ON photos(trip_id);
+"""
+
+# Columns added after the first release, for databases created before
+ADDED_COLUMNS = {
+    "users": [("revision", "INTEGER NOT NULL DEFAULT 1")],
+    "trips": [("revision", "INTEGER NOT NULL DEFAULT 1")],
+    "photos": [
+        ("lat", "REAL"), ("lon", "REAL"), ("content_hash", "TEXT"), ("size", "INTEGER"),
+        ("content_type", "TEXT"), ("width", "INTEGER"), ("height", "INTEGER"),
+    ],
+}
+
+def init_db(pool):
+    with pool.connection() as conn:
+        conn.executescript(SCHEMA)
+        conn.commit()
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+            for name, type_ in columns:
+                if name not in existing:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {type_}")
+        conn.commit()
+        ensure_fts(conn)
+        ensure_locations(conn)
+        ensure_rollups(conn)
+        ensure_analytics(conn)
+
+def load_geo_indexes(conn, photos, positions):
+    """Fill the spatial indexes: every photo, and the latest position of every trip."""
+    for row in conn.execute("SELECT id, trip_id, lat, lon FROM photos WHERE lat IS NOT NULL"):
+        photos.insert(row["id"], row["lat"], row["lon"], row["trip_id"])
+    # SQLite returns the other columns of the MAX(timestamp) row (bare columns)
+    for row in conn.execute(
+        "SELECT trip_id, lat, lon, MAX(timestamp) AS timestamp FROM trip_locations GROUP BY trip_id"
+    ):
+        positions.insert(row["trip_id"], row["lat"], row["lon"], row["timestamp"])
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connections are opened once, here, for the lifetime of the app: requests
+    # borrow them from the pool and never pay the connect cost themselves.
+    pool = sqlite_pool(DATABASE, min_size=8, max_size=16)
+    init_db(pool)
+    app.state.db = AsyncSQLite(pool, max_workers=8)
+    # One full scan at startup, then the trip endpoints keep the stats up to date
+    app.state.trip_stats = TripStatsEngine()
+    await app.state.db.run(app.state.trip_stats.load)
+    # Columnar copy of trip_locations for fast track reads (trip_tsdb.py)
+    app.state.tracks = TrackStore(TRACKS_DIR)
+    # Douglas-Peucker results per (trip, tolerance bucket), see trip_simplify.py
+    app.state.simplified = SimplifiedTrackCache()
+    # Spatial indexes for map queries (trip_geo.py): photo id -> trip_id, and
+    # trip id -> timestamp of its latest known position
+    app.state.photo_index = GridIndex()
+    app.state.position_index = GridIndex()
+    await app.state.db.run(load_geo_indexes, app.state.photo_index, app.state.position_index)
+    # Photo files, and the processes that thumbnail them (photo_store.py).
+    # spawn: forking a process that already runs threads can copy held locks.
+    app.state.photos = PhotoStore(PHOTOS_DIR)
+    # Latest revision of recently seen users/trips, for 304s (http_cache.py)
+    app.state.versions = VersionMap()
+    app.state.photo_workers = ProcessPoolExecutor(
+        max_workers=os.cpu_count() or 1, mp_context=multiprocessing.get_context("spawn")
+    )
+    # Rollups and retention of old location points (trip_rollups.py)
+    app.state.rollups = asyncio.create_task(maintain(app.state.db, app.state.tracks))
+    try:
+        yield
+    finally:
+        app.state.rollups.cancel()
+        app.state.photo_workers.shutdown(cancel_futures=True)
+        app.state.db.close()
+        tracer.shutdown()
+
+# Tracing (tracing.py): a span per request and per SQLite query. 1% of
+# requests are traced, plus every one that fails or takes over 500 ms.
+tracer = set_tracer(Tracer(
+    "travel-api", FileExporter(TRACES_FILE), sample_ratio=0.01, tail=TailSampling(latency=0.5)
+))
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(TracingMiddleware)
+# Sampling profiler (profiler.py), off unless DEBUG_PROFILE is set:
+# GET /debug/profile?seconds=10. With PROFILE_CONTINUOUS also set, 10 samples
+# a second all the time, one file per minute in PROFILES_DIR.
+if os.environ.get("DEBUG_PROFILE"):
+    continuous = None
+    if os.environ.get("PROFILE_CONTINUOUS"):
+        continuous = ContinuousProfiler(dump_dir=PROFILES_DIR).start()
+    profile_fastapi(app, continuous)
 
 
 @app.get("/")
@@ -29,142 +188,645 @@ class Trip(BaseModel):
     start_date: datetime
     end_date: datetime
 
+    @field_validator("start_date", "end_date")
+    @classmethod
+    def to_utc(cls, value):
+        # Stored in UTC: SQLite's date functions (the stats' JULIANDAY) can't
+        # read every offset Python writes, e.g. one with seconds (+05:30:15)
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value
+
+# List endpoints encode rows straight to JSON, checked once per query shape
+# instead of validating every row (fast_json.py)
+trip_encoder = RowEncoder(Trip)
+search_encoder = RowEncoder()
+user_encoder = RowEncoder(User)
+
 class Photo(BaseModel):
     id: Optional[int] = None
     trip_id: int
     filename: str
-    coordinates: Optional[tuple] = None
+    coordinates: Optional[Tuple[float, float]] = None  # (lat, lon)
     taken_at: Optional[datetime] = None
 
+    @field_validator("coordinates")
+    @classmethod
+    def check_coordinates(cls, value):
+        if value is not None and not (-90 <= value[0] <= 90 and -180 <= value[1] <= 180):
+            raise ValueError("coordinates must be (lat, lon) with -90 <= lat <= 90, -180 <= lon <= 180")
+        return value
+
+def photo_from_row(row):
+    photo = dict(row)
+    lat, lon = photo.pop("lat"), photo.pop("lon")
+    photo["coordinates"] = None if lat is None else (lat, lon)
+    return photo
+
 # Database connection
-def get_db():
-    conn = sqlite3.connect('travel.db')
-    try:
-        conn.row_factory = sqlite3.Row
+# sqlite3 blocks, so queries run on a bounded thread pool and the endpoints
+# await them instead of stalling the event loop. Each request checks one pooled
+# connection out and returns it when the response is done. Endpoints that wait
+# on the client for long (uploads) use app.state.db.run() per query instead.
+async def get_db(request: Request):
+    async with request.app.state.db.connection() as conn:
         yield conn
-    finally:
-        conn.close()
 
 # Authentication middleware (simplified)
-async def get_current_user(db: sqlite3.Connection = Depends(get_db)):
-    # In real app, would verify JWT token
+async def get_current_user():
+    # In real app, would verify JWT token (no database needed for that)
     return {"id": 1, "email": "test@example.com"}
 
+# Batched user lookups (dataloader.py)
+# One loader per request: user ids asked for in the same tick are fetched with
+# one IN query and memoized until the response is sent.
+async def get_user_loader(db: AsyncConnection = Depends(get_db)):
+    async def load_users(ids):
+        rows = await db.run(
+            user_encoder.query_dicts,
+            f"SELECT * FROM users WHERE id IN ({', '.join('?' * len(ids))})",
+            ids
+        )
+        return {row["id"]: row for row in rows}
+    loader = DataLoader(load_users)
+    yield loader
+    # Before get_db's teardown puts the connection back in the pool
+    await loader.close()
+
+async def expand_users(items, users: DataLoader):
+    """Add "user" to every item that has a user_id, with one query for all of them."""
+    for item, user in zip(items, await users.load_many([item["user_id"] for item in items])):
+        item["user"] = user
+    return items
+
+def check_expand(expand, validate):
+    if expand not in (None, "user"):
+        raise HTTPException(status_code=422, detail="expand supports: user")
+    if expand and validate:
+        raise HTTPException(status_code=422, detail="expand can't be combined with validate")
+
+# Conditional GET
+# Rows carry a revision; responses get an ETag built from it. If the client
+# sends the current ETag back and the version map knows the revision, the 304
+# is answered before any database work (http_cache.py).
+def versioned(request: Request, response: Response, kind: str, row):
+    """Record the row's revision and set ETag/Cache-Control on the response."""
+    request.app.state.versions.set(kind, row["id"], row["revision"])
+    response.headers["ETag"] = revision_etag(kind, row["id"], row["revision"])
+    response.headers["Cache-Control"] = CACHE_CONTROL
+
+def not_modified(etag: str):
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": CACHE_CONTROL})
+
+async def get_versioned(request: Request, response: Response, kind: str, id: int, sql: str):
+    """Fetch a versioned row, or a 304 Response if the client's copy is current."""
+    if_none_match = request.headers.get("if-none-match")
+    etag = request.app.state.versions.not_modified(kind, id, if_none_match)
+    if etag:
+        return not_modified(etag)
+    # Borrow a connection only for this query: 304s above don't need one
+    row = await request.app.state.db.fetchone(sql, (id,))
+    if row is None:
+        return None
+    versioned(request, response, kind, row)
+    if etag_matches(if_none_match, response.headers["ETag"]):
+        return not_modified(response.headers["ETag"])
+    return row
+
 # CRUD Operations
 @app.post("/users/", response_model=User, status_code=status.HTTP_201_CREATED)
-async def create_user(user: User, db: sqlite3.Connection = Depends(get_db)):
-    cursor = db.cursor()
-    cursor.execute(
+async def create_user(
+    user: User,
+    request: Request,
+    response: Response,
+    db: AsyncConnection = Depends(get_db)
+):
+    row = await db.write(
         "INSERT INTO users (email, name) VALUES (?, ?) RETURNING *",
         (user.email, user.name)
     )
-    db.commit()
-    return dict(cursor.fetchone())
+    versioned(request, response, "user", row)
+    return dict(row)
 
 @app.get("/users/{user_id}", response_model=User)
-async def get_user(user_id: int, db: sqlite3.Connection = Depends(get_db)):
-    cursor = db.cursor()
-    result = cursor.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = result.fetchone()
-    if not user:
+async def get_user(user_id: int, request: Request, response: Response):
+    user = await get_versioned(
+        request, response, "user", user_id, "SELECT * FROM users WHERE id = ?"
+    )
+    if user is None:
         raise HTTPException(status_code=404, detail="User not found")
+    if isinstance(user, Response):
+        return user
     return dict(user)
 
 # Trips endpoints
 @app.post("/trips/", response_model=Trip)
 async def create_trip(
     trip: Trip,
+    request: Request,
+    response: Response,
     current_user = Depends(get_current_user),
-    db: sqlite3.Connection = Depends(get_db)
+    db: AsyncConnection = Depends(get_db)
 ):
-    cursor = db.cursor()
-    cursor.execute(
+    row = await db.write(
         """INSERT INTO trips (user_id, title, description, start_date, end_date)
         VALUES (?, ?, ?, ?, ?) RETURNING *""",
         (current_user["id"], trip.title, trip.description, 
             trip.start_date, trip.end_date)
     )
-    db.commit()
-    return dict(cursor.fetchone())
+    request.app.state.trip_stats.on_insert(row)
+    versioned(request, response, "trip", row)
+    return dict(row)
+
+@app.get("/trips/{trip_id:int}", response_model=Trip)
+async def get_trip(trip_id: int, request: Request, response: Response):
+    trip = await get_versioned(
+        request, response, "trip", trip_id, "SELECT * FROM trips WHERE id = ?"
+    )
+    if trip is None:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    if isinstance(trip, Response):
+        return trip
+    return dict(trip)
+
+@app.put("/trips/{trip_id:int}", response_model=Trip)
+async def update_trip(
+    trip_id: int,
+    trip: Trip,
+    request: Request,
+    response: Response,
+    current_user = Depends(get_current_user),
+    db: AsyncConnection = Depends(get_db)
+):
+    def _update(conn):
+        # Read the old row in the same transaction, the stats need both versions.
+        # IMMEDIATE: sqlite3 only begins one implicitly before the UPDATE, and
+        # two concurrent updates must not both read the same old row
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            old = conn.execute(
+                "SELECT * FROM trips WHERE id = ? AND user_id = ?",
+                (trip_id, current_user["id"])
+            ).fetchone()
+            if old is None:
+                conn.rollback()
+                return None, None
+            new = conn.execute(
+                """UPDATE trips
+                SET title = ?, description = ?, start_date = ?, end_date = ?,
+                    revision = revision + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? RETURNING *""",
+                (trip.title, trip.description, trip.start_date, trip.end_date, trip_id)
+            ).fetchone()
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return old, new
+
+    old, new = await db.run(_update)
+    if old is None:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    request.app.state.trip_stats.on_update(old, new)
+    versioned(request, response, "trip", new)
+    return dict(new)
+
+@app.delete("/trips/{trip_id:int}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_trip(
+    trip_id: int,
+    request: Request,
+    current_user = Depends(get_current_user),
+    db: AsyncConnection = Depends(get_db)
+):
+    row = await db.write(
+        "DELETE FROM trips WHERE id = ? AND user_id = ? RETURNING *",
+        (trip_id, current_user["id"])
+    )
+    if row is None:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    request.app.state.trip_stats.on_delete(row)
+    request.app.state.position_index.remove(trip_id)
+    request.app.state.versions.delete("trip", trip_id)
 
 @app.get("/trips/", response_model=List[Trip])
 async def list_trips(
     skip: int = 0,
     limit: int = 10,
-    db: sqlite3.Connection = Depends(get_db)
+    validate: bool = False,
+    expand: Optional[str] = None,
+    db: AsyncConnection = Depends(get_db),
+    users: DataLoader = Depends(get_user_loader)
 ):
-    cursor = db.cursor()
-    cursor.execute(
+    # response_model still documents the schema; validate=true runs every row
+    # through it like before, to audit the fast path. expand=user embeds each
+    # trip's owner.
+    check_expand(expand, validate)
+    if expand:
+        trips = await db.run(
+            trip_encoder.query_dicts, "SELECT * FROM trips LIMIT ? OFFSET ?", (limit, skip)
+        )
+        return Response(content=dumps(await expand_users(trips, users)), media_type="application/json")
+    if not validate:
+        body = await db.run(
+            trip_encoder.query, "SELECT * FROM trips LIMIT ? OFFSET ?", (limit, skip)
+        )
+        return Response(content=body, media_type="application/json")
+    rows = await db.fetchall(
         "SELECT * FROM trips LIMIT ? OFFSET ?",
         (limit, skip)
     )
-    return [dict(row) for row in cursor.fetchall()]
+    return [dict(row) for row in rows]
 
 # Search endpoint with filtering
+# Text filters go through the trips_fts full-text index (see trip_search.py)
+# instead of `title LIKE '%x%'`, which had to scan the whole table.
 @app.get("/search/trips/")
 async def search_trips(
     start_date: Optional[datetime] = None,
     end_date: Optional[datetime] = None,
     title: Optional[str] = None,
-    db: sqlite3.Connection = Depends(get_db)
-):
-    query = "SELECT * FROM trips WHERE 1=1"
-    params = []
-    
-    if start_date:
-        query += " AND start_date >= ?"
-        params.append(start_date)
-    if end_date:
-        query += " AND end_date <= ?"
-        params.append(end_date)
-    if title:
-        query += " AND title LIKE ?"
-        params.append(f"%{title}%")
-        
-    cursor = db.cursor()
-    cursor.execute(query, params)
-    return [dict(row) for row in cursor.fetchall()]
+    q: Optional[str] = None,
+    prefix: bool = True,
+    skip: int = 0,
+    limit: int = 50,
+    validate: bool = False,
+    expand: Optional[str] = None,
+    db: AsyncConnection = Depends(get_db),
+    users: DataLoader = Depends(get_user_loader)
+):
+    # q searches title and description, title only the title; results are
+    # ranked by relevance, and the last word matches as a prefix ("eur" -> "europe")
+    query, params = search_sql(q, title, start_date, end_date, prefix, limit, skip)
+    check_expand(expand, validate)
+    if query is None:
+        return []
+
+    if expand:
+        trips = await db.run(search_encoder.query_dicts, query, params)
+        return Response(content=dumps(await expand_users(trips, users)), media_type="application/json")
+    if not validate:
+        body = await db.run(search_encoder.query, query, params)
+        return Response(content=body, media_type="application/json")
+    rows = await db.fetchall(query, params)
+    return [dict(row) for row in rows]
 
 # File upload endpoint
 @app.post("/trips/{trip_id}/photos/")
 async def upload_photo(
     trip_id: int,
     photo: Photo,
+    request: Request,
     current_user = Depends(get_current_user),
-    db: sqlite3.Connection = Depends(get_db)
+    db: AsyncConnection = Depends(get_db)
 ):
     # Verify trip belongs to user
-    cursor = db.cursor()
-    cursor.execute(
+    trip = await db.fetchone(
         "SELECT * FROM trips WHERE id = ? AND user_id = ?",
         (trip_id, current_user["id"])
     )
-    if not cursor.fetchone():
+    if not trip:
         raise HTTPException(
             status_code=403,
             detail="Not authorized to upload to this trip"
         )
         
-    cursor.execute(
-        """INSERT INTO photos (trip_id, filename, coordinates, taken_at)
-        VALUES (?, ?, ?, ?) RETURNING *""",
-        (trip_id, photo.filename, photo.coordinates, photo.taken_at)
+    lat, lon = photo.coordinates or (None, None)
+    row = await db.write(
+        """INSERT INTO photos (trip_id, filename, lat, lon, taken_at)
+        VALUES (?, ?, ?, ?, ?) RETURNING *""",
+        (trip_id, photo.filename, lat, lon, photo.taken_at)
     )
-    db.commit()
-    return dict(cursor.fetchone())
+    if lat is not None:
+        request.app.state.photo_index.insert(row["id"], lat, lon, trip_id)
+    return photo_from_row(row)
+
+# Photo content
+# The body is streamed to disk and hashed chunk by chunk, then thumbnailed in
+# a worker process (photo_store.py). No pooled connection is held while the
+# client is sending: on a slow link that can take minutes.
+@app.put("/trips/{trip_id}/photos/{photo_id}/content")
+async def upload_photo_content(
+    trip_id: int,
+    photo_id: int,
+    request: Request,
+    current_user = Depends(get_current_user)
+):
+    db = request.app.state.db
+    photo = await db.fetchone(
+        """SELECT photos.* FROM photos JOIN trips ON trips.id = photos.trip_id
+        WHERE photos.id = ? AND photos.trip_id = ? AND trips.user_id = ?""",
+        (photo_id, trip_id, current_user["id"])
+    )
+    if not photo:
+        raise HTTPException(status_code=404, detail="Photo not found")
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_PHOTO_BYTES:
+        raise HTTPException(status_code=413, detail="Photo is too large")
+
+    store = request.app.state.photos
+    try:
+        content_hash, size, is_new = await store.save_stream(request.stream())
+    except PhotoTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        info = await asyncio.get_running_loop().run_in_executor(
+            request.app.state.photo_workers, process_photo,
+            store.path(content_hash), store.thumbnail_path(content_hash)
+        )
+    except InvalidImage as e:
+        if is_new:
+            store.discard(content_hash)
+        raise HTTPException(status_code=415, detail=str(e))
+
+    # EXIF fills capture time and coordinates only where the client sent none
+    row = await db.write(
+        """UPDATE photos
+        SET content_hash = ?, size = ?, content_type = ?, width = ?, height = ?,
+            taken_at = COALESCE(taken_at, ?), lat = COALESCE(lat, ?), lon = COALESCE(lon, ?)
+        WHERE id = ? RETURNING *""",
+        (content_hash, size, info["content_type"], info["width"], info["height"],
+         info["taken_at"], info["lat"], info["lon"], photo_id)
+    )
+    if row["lat"] is not None:
+        request.app.state.photo_index.insert(photo_id, row["lat"], row["lon"], trip_id)
+    return photo_from_row(row)
+
+# Range requests let clients on flaky connections resume a download where it
+# broke off (Range + If-Range with the ETag) instead of starting over.
+@app.api_route("/trips/{trip_id}/photos/{photo_id}/content", methods=["GET", "HEAD"])
+async def download_photo_content(
+    trip_id: int,
+    photo_id: int,
+    request: Request,
+    thumbnail: bool = False,
+    current_user = Depends(get_current_user)
+):
+    photo = await request.app.state.db.fetchone(
+        """SELECT photos.* FROM photos JOIN trips ON trips.id = photos.trip_id
+        WHERE photos.id = ? AND photos.trip_id = ? AND trips.user_id = ?""",
+        (photo_id, trip_id, current_user["id"])
+    )
+    if not photo or photo["content_hash"] is None:
+        raise HTTPException(status_code=404, detail="Photo not found")
+
+    store = request.app.state.photos
+    if thumbnail:
+        path = store.thumbnail_path(photo["content_hash"])
+        etag = content_etag(photo["content_hash"], "thumb")
+        media_type = "image/jpeg"
+    else:
+        path = store.path(photo["content_hash"])
+        etag = content_etag(photo["content_hash"])
+        media_type = photo["content_type"]
+    # The URL's content can change (a new PUT), so revalidate, but cheaply
+    headers = {"etag": etag, "cache-control": "private, no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    try:
+        stat_result = await asyncio.get_running_loop().run_in_executor(None, os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Photo file not found")
+    return PhotoFileResponse(
+        path, media_type=media_type, headers=headers, stat_result=stat_result,
+        filename=photo["filename"], content_disposition_type="inline"
+    )
+
+# Spatial queries
+# Served from the in-memory grid indexes (trip_geo.py), then the matching
+# photo rows are read by primary key. bbox is min_lon,min_lat,max_lon,max_lat.
+async def _photos_by_id(db, ids):
+    if not ids:
+        return {}
+    rows = await db.fetchall(
+        f"SELECT * FROM photos WHERE id IN ({', '.join('?' * len(ids))})", ids
+    )
+    return {row["id"]: photo_from_row(row) for row in rows}
+
+def _bbox(bbox):
+    try:
+        return parse_bbox(bbox)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.get("/photos/within")
+async def photos_within(
+    bbox: str,
+    request: Request,
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncConnection = Depends(get_db)
+):
+    hits = request.app.state.photo_index.within(*_bbox(bbox), limit=limit)
+    photos = await _photos_by_id(db, [id for id, *_ in hits])
+    return [photos[id] for id, *_ in hits if id in photos]
+
+@app.get("/photos/nearby")
+async def photos_nearby(
+    request: Request,
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    k: int = Query(10, ge=1, le=100),
+    max_distance: Optional[float] = Query(None, gt=0),  # meters
+    db: AsyncConnection = Depends(get_db)
+):
+    hits = request.app.state.photo_index.nearby(lat, lon, k, max_distance)
+    photos = await _photos_by_id(db, [id for _, id, *_ in hits])
+    return [
+        {**photos[id], "distance_m": round(distance, 1)}
+        for distance, id, *_ in hits if id in photos
+    ]
+
+@app.get("/locations/within")
+async def locations_within(
+    bbox: str,
+    request: Request,
+    limit: int = Query(100, ge=1, le=1000)
+):
+    # Trips whose latest known position is inside the box
+    hits = request.app.state.position_index.within(*_bbox(bbox), limit=limit)
+    return [
+        {"trip_id": trip_id, "lat": lat, "lon": lon, "timestamp": timestamp}
+        for trip_id, lat, lon, timestamp in hits
+    ]
+
+@app.get("/locations/nearby")
+async def locations_nearby(
+    request: Request,
+    lat: float = Query(..., ge=-90, le=90),
+    lon: float = Query(..., ge=-180, le=180),
+    k: int = Query(10, ge=1, le=100),
+    max_distance: Optional[float] = Query(None, gt=0)
+):
+    hits = request.app.state.position_index.nearby(lat, lon, k, max_distance)
+    return [
+        {"trip_id": trip_id, "lat": plat, "lon": plon, "timestamp": timestamp,
+         "distance_m": round(distance, 1)}
+        for distance, trip_id, plat, plon, timestamp in hits
+    ]
+
+# Location tracking
+# Offline phones upload many points at once; see trip_locations.py for the format
+@app.post("/trips/{trip_id}/locations:batch")
+async def ingest_locations(
+    trip_id: int,
+    request: Request,
+    current_user = Depends(get_current_user)
+):
+    # No connection held while the phone uploads: one per query (see get_db)
+    db = request.app.state.db
+    trip = await db.fetchone(
+        "SELECT id FROM trips WHERE id = ? AND user_id = ?",
+        (trip_id, current_user["id"])
+    )
+    if not trip:
+        raise HTTPException(
+            status_code=403,
+            detail="Not authorized to track this trip"
+        )
+
+    length = request.headers.get("content-length")
+    if length and length.isdigit() and int(length) > MAX_BODY_BYTES:
+        raise HTTPException(status_code=413, detail="Batch is too large")
+    try:
+        body = await read_body(request.stream())
+    except BatchTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    # Decompressing, parsing and validating is CPU work: keep it off the event loop
+    def _decode():
+        # Too old to get into the rollups before retention deletes them (trip_rollups.py)
+        return validate_batch(
+            decode_body(body, request.headers.get("content-encoding")), oldest=oldest_accepted()
+        )
+    try:
+        columns, rejected = await asyncio.get_running_loop().run_in_executor(None, _decode)
+    except InvalidBatch as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    inserted = await db.run(insert_batch, trip_id, columns)
+    # Points older than the rollup watermark: their hours get rolled up again
+    await db.run(mark_late, trip_id, columns["timestamp"])
+    if inserted:
+        await db.run(record_points, trip_id, columns)
+    # The store dedupes on timestamp like the table does, so re-sent batches are no-ops
+    await asyncio.get_running_loop().run_in_executor(
+        None, request.app.state.tracks.append, trip_id, columns
+    )
+    request.app.state.simplified.invalidate(trip_id)
+    # Batches can arrive out of order (offline phones): only move forward in time
+    if accepted := len(columns["timestamp"]):
+        latest = int(columns["timestamp"][-1])
+        current = request.app.state.position_index.get(trip_id)
+        if current is None or current[2] < latest:
+            request.app.state.position_index.insert(
+                trip_id, float(columns["lat"][-1]), float(columns["lon"][-1]), latest
+            )
+    return {
+        "accepted": accepted,
+        "inserted": inserted,
+        "duplicates": accepted - inserted,
+        "rejected": rejected,
+    }
+
+@app.get("/trips/{trip_id}/track")
+async def get_track(
+    trip_id: int,
+    request: Request,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    every: Optional[int] = Query(None, ge=1)
+):
+    # start/end are unix seconds; every=N averages the points per N seconds
+    tracks = request.app.state.tracks
+    loop = asyncio.get_running_loop()
+    if every is not None:
+        columns = await loop.run_in_executor(None, tracks.downsample, trip_id, every, start, end)
+    else:
+        columns = await loop.run_in_executor(None, tracks.scan, trip_id, start, end)
+    return columns_to_json(columns)
+
+@app.get("/trips/{trip_id}/locations")
+async def get_locations(
+    trip_id: int,
+    start: Optional[int] = None,
+    end: Optional[int] = None,
+    max_points: int = Query(1000, ge=1, le=100_000),
+    db: AsyncConnection = Depends(get_db)
+):
+    # Raw points, or 15 minute / hourly buckets if the span has more than
+    # max_points of them (or raw points were already deleted by retention)
+    resolution, columns = await db.run(locations, trip_id, start, end, max_points)
+    return {"resolution": resolution, **columns_to_json(columns)}
+
+@app.get("/trips/{trip_id}/analytics")
+async def get_trip_analytics(trip_id: int, db: AsyncConnection = Depends(get_db)):
+    # Distance, speeds, moving time and elevation, kept up to date by
+    # ingest_locations (trip_analytics.py)
+    if not await db.fetchone("SELECT id FROM trips WHERE id = ?", (trip_id,)):
+        raise HTTPException(status_code=404, detail="Trip not found")
+    return summary_json(await db.run(get_analytics, trip_id))
+
+@app.get("/trips/{trip_id}/track/simplified")
+async def get_simplified_track(
+    trip_id: int,
+    request: Request,
+    zoom: Optional[float] = None,
+    tolerance: Optional[float] = None,
+    pixels: float = 1.0
+):
+    # Either a map zoom level (tolerance = `pixels` screen pixels at that zoom)
+    # or an explicit tolerance in meters
+    if (zoom is None) == (tolerance is None):
+        raise HTTPException(status_code=422, detail="Pass exactly one of zoom or tolerance")
+    if zoom is not None and not 0 <= zoom <= 24:
+        raise HTTPException(status_code=422, detail="zoom must be between 0 and 24")
+    if tolerance is not None and tolerance <= 0:
+        raise HTTPException(status_code=422, detail="tolerance must be > 0 meters")
+
+    tracks, cache = request.app.state.tracks, request.app.state.simplified
+    loop = asyncio.get_running_loop()
+    # Read the version before the data: if points arrive meanwhile, put() drops our result
+    version = cache.version(trip_id)
+    track = None
+    info = cache.info(trip_id)
+    if info is None and tolerance is None:
+        # The zoom's tolerance needs the track's latitude: read it now
+        track = await loop.run_in_executor(
+            None, lambda: tracks.scan(trip_id, fields=("timestamp", "lat", "lon"))
+        )
+        info = track_info(track)
+    if tolerance is None:
+        tolerance = zoom_tolerance(zoom, info[1], pixels)
+    bucket, bucket_tolerance = tolerance_bucket(tolerance)
+
+    # A hit doesn't touch the track files
+    simplified = cache.get(trip_id, bucket)
+    if simplified is None:
+        if track is None:
+            track = await loop.run_in_executor(
+                None, lambda: tracks.scan(trip_id, fields=("timestamp", "lat", "lon"))
+            )
+            info = track_info(track)
+        simplified = await loop.run_in_executor(None, simplify, track, bucket_tolerance)
+        cache.put(trip_id, bucket, simplified, version, info)
+    return {
+        "tolerance": bucket_tolerance,
+        "points": info[0],
+        "kept": len(simplified["lat"]),
+        **columns_to_json(simplified),
+    }
 
 # Aggregation endpoint
+# Served in O(1) from running aggregates (trip_stats.py). exact=true runs the
+# full-table SQL instead, to audit the running numbers.
 @app.get("/trips/stats/")
-async def get_trip_stats(db: sqlite3.Connection = Depends(get_db)):
-    cursor = db.cursor()
-    cursor.execute("""
-        SELECT 
-            COUNT(*) as total_trips,
-            AVG(JULIANDAY(end_date) - JULIANDAY(start_date)) as avg_duration,
-            COUNT(DISTINCT user_id) as unique_users
-        FROM trips
-    """)
-    return dict(cursor.fetchone())
+async def get_trip_stats(
+    request: Request,
+    exact: bool = False,
+    percentiles: bool = False,
+    db: AsyncConnection = Depends(get_db)
+):
+    if exact:
+        return await db.run(exact_stats)
+    return request.app.state.trip_stats.snapshot(percentiles)
 
 # Health check endpoint
 @app.get("/health")